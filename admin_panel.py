@@ -1,10 +1,15 @@
 import os
+from datetime import datetime
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, redirect, url_for, session as flask_session, flash
+from flask import Flask, Response, render_template, request, redirect, url_for, session as flask_session, flash, g, abort
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from db_models import Usuario, Producto, Key, inicializar_db, get_session
+from db_models import Usuario, Producto, Key, StockProducto, Difusion, SuscripcionStock, inicializar_db, configurar_engine, get_session, incrementar_version_catalogo, paginar_keyset, ajustar_saldo
+from inventario import importar_keys
+from difusiones import crear_difusion, registrar_reposicion
+from analitica import resumen_ventas
+from credenciales import LimitadorIntentos, hashear, verificar, necesita_rehash
+from exportaciones import EXPORTACIONES, FORMATOS, ESTADOS_KEY, generar_exportacion
+from metricas import MedidorSolicitudes, exportar, TIPO_CONTENIDO
 from functools import wraps
 import logging
 
@@ -12,14 +17,47 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///socios_bot.db') 
 
+POR_PAGINA = int(os.getenv('POR_PAGINA', '50'))
+# Si se define, /metrics exige el header "Authorization: Bearer <METRICS_TOKEN>".
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
 app = Flask(__name__, template_folder='templates')
 app.secret_key = os.getenv('SECRET_KEY', 'tu_clave_secreta_final_torres') 
 
-try:
-    engine = create_engine(DATABASE_URL)
-    inicializar_db(engine)
-except Exception as e:
-    logging.error(f"Error CRÍTICO al inicializar la base de datos: {e}")
+# Importar el panel no abre conexiones ni toca el esquema (eso lo hace `python migraciones.py`),
+# así que es seguro con gunicorn --preload: cada worker abre sus conexiones al atender la primera solicitud.
+configurar_engine('web')
+
+MEDIDOR_RUTAS = MedidorSolicitudes('panel_ruta', 'ruta')
+# Fallos de login recientes por username (por worker): pasado el límite se rechaza sin consultar la base. No se usa
+# la IP: detrás del router de la plataforma remote_addr es la del router y un bloqueo afectaría a todos los admins.
+LIMITE_LOGIN = LimitadorIntentos()
+
+@app.before_request
+def _iniciar_medicion():
+    g.medicion = MEDIDOR_RUTAS.iniciar()
+
+@app.teardown_request
+def _terminar_medicion(error=None):
+    medicion = g.pop('medicion', None)
+    if medicion is not None:
+        MEDIDOR_RUTAS.terminar(medicion, request.endpoint or 'desconocida', error is not None)
+
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        abort(401)
+    return Response(exportar(), mimetype=None, content_type=TIPO_CONTENIDO)
+
+def filtro_prefijo(columna, prefijo):
+    """
+    Búsqueda por prefijo como LIKE 'prefijo%' (con %, _ y \\ escapados), que distingue mayúsculas.
+    Usa índice en PostgreSQL con los índices text_pattern_ops (migración 3) y en SQLite con
+    case_sensitive_like (ver db_models._pragmas_sqlite). Un rango >= / < no sirve: con las
+    collations habituales de PostgreSQL el orden ignora mayúsculas y puntuación.
+    """
+    escapado = prefijo.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return columna.like(escapado + '%', escape='\\')
 
 def login_required(f):
     @wraps(f)
@@ -36,23 +74,30 @@ def login():
         username = request.form.get('username')
         login_key_input = request.form.get('login_key') or request.form.get('password')
 
-        db_session = get_session()
-        try:
-            usuario = db_session.query(Usuario).filter_by(
-                username=username, 
-                login_key=login_key_input, 
-                es_admin=True
-            ).first()
-
-            if usuario:
-                flask_session['logged_in'] = True
-                flask_session['username'] = usuario.username
-                flash('Inicio de sesión exitoso.', 'success')
-                return redirect(url_for('manage_users')) 
-            else:
-                flash('Credenciales incorrectas o no eres administrador.', 'danger')
-        finally:
-            db_session.close()
+        claves = (('username', username),)
+
+        espera = LIMITE_LOGIN.espera(*claves)
+        if espera:
+            flash(f'Demasiados intentos fallidos. Intenta de nuevo en {int(espera // 60) + 1} minuto(s).', 'danger')
+            return render_template('login.html'), 429
+
+        # El hash se verifica sin tener tomada una conexión del pool.
+        with get_session() as db_session:
+            credencial = db_session.query(Usuario.id, Usuario.username, Usuario.login_key).filter_by(username=username, es_admin=True).first()
+
+        if verificar(login_key_input or '', credencial.login_key if credencial else None):
+            if necesita_rehash(credencial.login_key):
+                with get_session() as db_session:
+                    db_session.query(Usuario).filter_by(id=credencial.id).update({Usuario.login_key: hashear(login_key_input)}, synchronize_session=False)
+                    db_session.commit()
+            LIMITE_LOGIN.exito(*claves)
+            flask_session['logged_in'] = True
+            flask_session['username'] = credencial.username
+            flash('Inicio de sesión exitoso.', 'success')
+            return redirect(url_for('manage_users')) 
+        else:
+            LIMITE_LOGIN.fallo(*claves)
+            flash('Credenciales incorrectas o no eres administrador.', 'danger')
     return render_template('login.html') 
 
 @app.route('/logout')
@@ -68,13 +113,52 @@ def logout():
 def manage_users():
     db_session = get_session()
     try:
-        usuarios = db_session.query(Usuario).all()
-        if len(usuarios) > 1:
-            usuarios = [u for u in usuarios if u.username != 'admin']
-        return render_template('admin_users.html', usuarios=usuarios)
+        busqueda = (request.args.get('q') or '').strip()
+        despues = request.args.get('despues')
+
+        query = db_session.query(Usuario)
+        # El admin solo se lista cuando es el único usuario registrado.
+        if db_session.query(Usuario.id).filter(Usuario.username != 'admin').first():
+            query = query.filter(Usuario.username != 'admin')
+
+        if busqueda:
+            query = query.filter(filtro_prefijo(Usuario.username, busqueda))
+            usuarios, siguiente = paginar_keyset(query, Usuario.username, despues, POR_PAGINA)
+        else:
+            usuarios, siguiente = paginar_keyset(query, Usuario.id, int(despues) if despues and despues.isdigit() else None, POR_PAGINA)
+        return render_template('admin_users.html', usuarios=usuarios, busqueda=busqueda, siguiente=siguiente)
     finally:
         db_session.close()
 
+@app.route('/create_user', methods=['GET', 'POST'])
+@login_required
+def create_user():
+    if request.method == 'POST':
+        username = request.form.get('username')
+        login_key = request.form.get('login_key')
+        saldo = float(request.form.get('saldo') or 0.00)
+        es_admin = request.form.get('es_admin') is not None
+
+        db_session = get_session()
+        try:
+            nuevo_usuario = Usuario(username=username, login_key=hashear(login_key), saldo=0.00, es_admin=es_admin)
+            db_session.add(nuevo_usuario)
+            db_session.flush()
+            if saldo:
+                ajustar_saldo(db_session, nuevo_usuario.id, saldo, descripcion='Saldo inicial')
+            db_session.commit()
+            flash(f'Socio "{username}" creado exitosamente.', 'success')
+            return redirect(url_for('manage_users'))
+        except IntegrityError:
+            db_session.rollback()
+            flash(f'El username "{username}" ya está registrado.', 'danger')
+        except Exception as e:
+            db_session.rollback()
+            flash(f'Error al crear socio: {e}', 'danger')
+        finally:
+            db_session.close()
+    return render_template('create_user.html')
+
 @app.route('/adjust_saldo/<int:user_id>', methods=['GET', 'POST'])
 @login_required
 def adjust_saldo(user_id):
@@ -88,8 +172,9 @@ def adjust_saldo(user_id):
         if request.method == 'POST':
             try:
                 monto = float(request.form.get('monto'))
-                usuario.saldo += monto
+                ajustar_saldo(db_session, usuario.id, monto, descripcion=f"Ajuste de {flask_session.get('username', 'admin')}")
                 db_session.commit()
+                db_session.refresh(usuario)
                 flash(f'Saldo de {usuario.username} ajustado en ${monto:.2f}. Nuevo saldo: ${usuario.saldo:.2f}.', 'success')
                 return redirect(url_for('manage_users'))
             except ValueError:
@@ -108,9 +193,10 @@ def adjust_saldo(user_id):
 def manage_products():
     db_session = get_session()
     try:
-        productos = db_session.query(Producto).all()
-        for p in productos:
-            p.stock_available = db_session.query(Key).filter(Key.producto_id == p.id, Key.estado == 'available').count()
+        productos = []
+        for p, disponibles in db_session.query(Producto, StockProducto.disponibles).outerjoin(StockProducto, Producto.id == StockProducto.producto_id).all():
+            p.stock_available = disponibles or 0
+            productos.append(p)
         return render_template('manage_products.html', productos=productos)
     finally:
         db_session.close()
@@ -128,6 +214,9 @@ def create_product():
         try:
             nuevo_producto = Producto(nombre=nombre, categoria=categoria, precio=precio, descripcion=descripcion)
             db_session.add(nuevo_producto)
+            db_session.flush()
+            db_session.add(StockProducto(producto_id=nuevo_producto.id, disponibles=0, usadas=0))
+            incrementar_version_catalogo(db_session)
             db_session.commit()
             flash(f'Producto "{nombre}" creado exitosamente.', 'success')
             return redirect(url_for('manage_products'))
@@ -149,23 +238,39 @@ def manage_keys(product_id):
             return redirect(url_for('manage_products'))
 
         if request.method == 'POST':
-            licencias_text = request.form.get('licencias')
-            lines = [line.strip() for line in licencias_text.split('\n') if line.strip()]
-            
-            count = 0
-            for line in lines:
-                nueva_key = Key(licencia=line, producto_id=product_id, estado='available')
-                db_session.add(nueva_key)
-                count += 1
-                
+            archivo = request.files.get('archivo')
+            if archivo and archivo.filename:
+                # El archivo se recorre línea por línea desde el stream del upload (sin leerlo completo).
+                lineas = archivo.stream
+            else:
+                lineas = (request.form.get('licencias') or '').split('\n')
+
+            resultado = importar_keys(db_session, product_id, lineas)
+            # El bot avisa a los suscriptores del producto (ver difusiones.py).
+            registrar_reposicion(db_session, product_id, resultado['insertadas'])
+            incrementar_version_catalogo(db_session)
             db_session.commit()
-            flash(f'Se agregaron {count} keys al inventario de {producto.nombre}.', 'success')
+            flash(f"Se agregaron {resultado['insertadas']} keys al inventario de {producto.nombre} "
+                  f"({resultado['duplicadas']} duplicadas, {resultado['invalidas']} inválidas omitidas).", 'success')
             return redirect(url_for('manage_keys', product_id=product_id))
 
-        available_keys = db_session.query(Key).filter_by(producto_id=product_id, estado='available').all()
-        used_keys = db_session.query(Key).filter_by(producto_id=product_id, estado='used').all()
-        
-        return render_template('manage_keys.html', producto=producto, available_keys=available_keys, used_keys=used_keys)
+        estado = request.args.get('estado', 'available')
+        if estado not in ('available', 'used'):
+            estado = 'available'
+        busqueda = (request.args.get('q') or '').strip()
+        despues = request.args.get('despues')
+
+        query = db_session.query(Key).filter(Key.producto_id == product_id, Key.estado == estado)
+        if busqueda:
+            query = query.filter(filtro_prefijo(Key.licencia, busqueda))
+            keys, siguiente = paginar_keyset(query, Key.licencia, despues, POR_PAGINA)
+        else:
+            keys, siguiente = paginar_keyset(query, Key.id, int(despues) if despues and despues.isdigit() else None, POR_PAGINA)
+
+        stock = producto.stock
+        suscriptores = db_session.query(SuscripcionStock.id).filter(SuscripcionStock.producto_id == product_id).count()
+        return render_template('manage_keys.html', producto=producto, keys=keys, estado=estado, busqueda=busqueda, siguiente=siguiente, suscriptores=suscriptores,
+                               total_disponibles=stock.disponibles if stock else 0, total_usadas=stock.usadas if stock else 0)
     finally:
         db_session.close()
         
@@ -184,7 +289,8 @@ def edit_product(product_id):
             producto.categoria = request.form.get('categoria')
             producto.precio = float(request.form.get('precio'))
             producto.descripcion = request.form.get('descripcion')
-            
+
+            incrementar_version_catalogo(db_session)
             db_session.commit()
             flash(f'Producto "{producto.nombre}" actualizado exitosamente.', 'success')
             return redirect(url_for('manage_products'))
@@ -204,7 +310,10 @@ def delete_product(product_id):
         producto = db_session.query(Producto).filter_by(id=product_id).first()
         if producto:
             db_session.query(Key).filter_by(producto_id=product_id).delete()
+            db_session.query(StockProducto).filter_by(producto_id=product_id).delete()
+            db_session.query(SuscripcionStock).filter_by(producto_id=product_id).delete()
             db_session.delete(producto)
+            incrementar_version_catalogo(db_session)
             db_session.commit()
             flash(f'Producto "{producto.nombre}" y sus Keys eliminados exitosamente.', 'success')
         else:
@@ -213,7 +322,76 @@ def delete_product(product_id):
         db_session.close()
     return redirect(url_for('manage_products'))
 
+@app.route('/broadcast', methods=['GET', 'POST'])
+@login_required
+def broadcast():
+    """Difusión a todos los socios con Telegram vinculado. Solo registra la difusión: la envía el bot."""
+    db_session = get_session()
+    try:
+        if request.method == 'POST':
+            texto = (request.form.get('texto') or '').strip()
+            if not texto or len(texto) > 4096:
+                flash('El mensaje debe tener entre 1 y 4096 caracteres.', 'danger')
+            else:
+                try:
+                    difusion = crear_difusion(db_session, texto, creada_por=flask_session.get('username'))
+                    db_session.commit()
+                    flash(f'Difusión #{difusion.id} programada. El bot la enviará respetando los límites de Telegram.', 'success')
+                    return redirect(url_for('broadcast'))
+                except Exception as e:
+                    db_session.rollback()
+                    flash(f'Error al crear la difusión: {e}', 'danger')
+
+        destinatarios = db_session.query(Usuario.id).filter(Usuario.telegram_id.isnot(None)).count()
+        difusiones = db_session.query(Difusion).order_by(Difusion.id.desc()).limit(20).all()
+        return render_template('broadcast.html', destinatarios=destinatarios, difusiones=difusiones)
+    finally:
+        db_session.close()
+
+@app.route('/ventas')
+@login_required
+def ventas():
+    db_session = get_session()
+    try:
+        return render_template('ventas.html', **resumen_ventas(db_session))
+    finally:
+        db_session.close()
+
+@app.route('/exportar')
+@login_required
+def exportaciones():
+    db_session = get_session()
+    try:
+        productos = db_session.query(Producto.id, Producto.nombre).order_by(Producto.nombre).all()
+        return render_template('exportar.html', productos=productos)
+    finally:
+        db_session.close()
+
+@app.route('/exportar/<tipo>')
+@login_required
+def exportar_datos(tipo):
+    if tipo not in EXPORTACIONES:
+        abort(404)
+    formato = request.args.get('formato', 'csv')
+    producto_id = (request.args.get('producto_id') or '').strip()
+    estado = request.args.get('estado') or None
+    usuario = (request.args.get('usuario') or '').strip() or None
+    try:
+        desde, hasta = (datetime.strptime(request.args[f], '%Y-%m-%d').date() if request.args.get(f) else None for f in ('desde', 'hasta'))
+    except ValueError:
+        abort(400)
+    if formato not in FORMATOS or (producto_id and not producto_id.isdigit()) or (estado and estado not in ESTADOS_KEY):
+        abort(400)
+
+    contenido = generar_exportacion(tipo, formato, producto_id=int(producto_id) if producto_id else None, estado=estado, usuario=usuario, desde=desde, hasta=hasta)
+    # El archivo se genera después de que la vista retorna: la ruta se mide hasta el último bloque enviado.
+    MEDIDOR_RUTAS.cancelar(g.pop('medicion'))
+    nombre = f"{tipo}_{datetime.now():%Y%m%d_%H%M%S}.{formato}"
+    return Response(MEDIDOR_RUTAS.medir_iterable(contenido, request.endpoint), content_type=FORMATOS[formato], headers={'Content-Disposition': f'attachment; filename="{nombre}"'})
+
 
 if __name__ == '__main__':
+    # Servidor de desarrollo: prepara la base local antes de arrancar.
+    inicializar_db()
     port = int(os.environ.get("PORT", 5000))
     app.run(debug=True, host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,186 @@
+"""
+Resúmenes de ventas para el dashboard del panel.
+
+Las tablas ventas_por_hora, ventas_por_dia y ventas_por_usuario se alimentan del ledger
+(movimientos, de solo inserción) de forma incremental: cada pasada lee los movimientos
+posteriores a cursor_ventas.ultimo_movimiento_id, en orden de id y por lotes, y suma sus
+compras a las filas de resumen. Actualizar cuesta lo que cuesten las compras nuevas y el
+dashboard lee filas acotadas por la ventana que muestra (24 horas, 30 días), no el historial.
+
+El bot lo ejecuta como tarea de fondo cada ANALITICA_INTERVALO segundos; `python analitica.py`
+acumula todo lo pendiente (carga inicial sobre un ledger existente, o desde cron). Pueden
+correr varios procesos a la vez: el avance condicional del cursor acumula cada lote una sola vez.
+"""
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import update, func, Integer, Float
+from sqlalchemy.dialects import postgresql, sqlite
+from db_models import Movimiento, Producto, Usuario, VentaPorHora, VentaPorDia, VentaPorUsuario, CursorVentas, TIPO_COMPRA, get_session, run_db
+
+logger = logging.getLogger(__name__)
+
+ANALITICA_LOTE = int(os.getenv('ANALITICA_LOTE', '5000'))
+ANALITICA_INTERVALO = float(os.getenv('ANALITICA_INTERVALO', '60'))
+# Solo se acumulan movimientos con al menos esta antigüedad. En Postgres el id se asigna al insertar
+# y una compra con id menor puede confirmarse después que otra con id mayor: sin margen, el cursor
+# podría pasar por encima de una compra todavía sin confirmar y no contarla nunca.
+ANALITICA_MARGEN_SEGUNDOS = int(os.getenv('ANALITICA_MARGEN_SEGUNDOS', '30'))
+
+def _acumular(session_db, modelo, filas):
+    """
+    Suma cada fila a la fila existente con la misma clave primaria, o la inserta (sin commit).
+    Las columnas numéricas se suman; el resto (p. ej. ultima_compra) toma el valor nuevo.
+    """
+    if not filas:
+        return
+    tabla = modelo.__table__
+    pk = [c.name for c in tabla.primary_key.columns]
+    sumadas = [c.name for c in tabla.columns if c.name not in pk and isinstance(c.type, (Integer, Float))]
+    dialecto = session_db.get_bind().dialect.name
+    if dialecto in ('postgresql', 'sqlite'):
+        stmt = (postgresql if dialecto == 'postgresql' else sqlite).insert(tabla)
+        valores = {c.name: (tabla.c[c.name] + stmt.excluded[c.name]) if c.name in sumadas else stmt.excluded[c.name]
+                   for c in tabla.columns if c.name not in pk}
+        session_db.execute(stmt.on_conflict_do_update(index_elements=pk, set_=valores), filas)
+        return
+    for fila in filas:
+        result = session_db.execute(
+            update(tabla).where(*[tabla.c[k] == fila[k] for k in pk])
+            .values({k: (tabla.c[k] + v) if k in sumadas else v for k, v in fila.items() if k not in pk})
+        )
+        if result.rowcount == 0:
+            session_db.execute(tabla.insert(), fila)
+
+def acumular_ventas(limite=ANALITICA_LOTE, margen=ANALITICA_MARGEN_SEGUNDOS):
+    """Acumula el próximo lote de movimientos en las tablas de ventas. Retorna cuántos movimientos procesó (0: al día)."""
+    with get_session() as session_db:
+        try:
+            ultimo = session_db.query(CursorVentas.ultimo_movimiento_id).filter(CursorVentas.id == 1).scalar()
+            if ultimo is None:
+                session_db.add(CursorVentas(id=1, ultimo_movimiento_id=0, cantidad=0, ingresos=0))
+                session_db.flush()
+                ultimo = 0
+
+            filas = (
+                session_db.query(Movimiento.id, Movimiento.tipo, Movimiento.usuario_id, Movimiento.producto_id, Movimiento.monto, Movimiento.fecha)
+                .filter(Movimiento.id > ultimo).order_by(Movimiento.id).limit(limite).all()
+            )
+            # El lote termina antes del primer movimiento demasiado reciente (ver ANALITICA_MARGEN_SEGUNDOS).
+            corte = datetime.now() - timedelta(seconds=margen)
+            recientes = next((i for i, fila in enumerate(filas) if fila.fecha > corte), None)
+            if recientes is not None:
+                filas = filas[:recientes]
+            if not filas:
+                session_db.commit()
+                return 0
+
+            por_hora, por_dia, por_usuario = {}, {}, {}
+            for fila in filas:
+                if fila.tipo != TIPO_COMPRA:
+                    continue
+                ingreso = -fila.monto
+                producto_id = fila.producto_id or 0  # 0: compra sin producto registrado en el ledger
+                for resumen, clave in ((por_hora, (fila.fecha.replace(minute=0, second=0, microsecond=0), producto_id)),
+                                       (por_dia, (fila.fecha.date(), producto_id)),
+                                       (por_usuario, fila.usuario_id)):
+                    acumulado = resumen.setdefault(clave, [0, 0.0, None])
+                    acumulado[0] += 1
+                    acumulado[1] += ingreso
+                    acumulado[2] = fila.fecha
+            cantidad = sum(c for c, _, _ in por_usuario.values())
+            ingresos = sum(i for _, i, _ in por_usuario.values())
+
+            # Avance condicional del cursor (antes de sumar): si otro proceso acumuló este lote primero, no se cuenta dos veces.
+            result = session_db.execute(
+                update(CursorVentas)
+                .where(CursorVentas.id == 1, CursorVentas.ultimo_movimiento_id == ultimo)
+                .values(ultimo_movimiento_id=filas[-1].id, cantidad=CursorVentas.cantidad + cantidad,
+                        ingresos=CursorVentas.ingresos + round(ingresos, 2), actualizado=filas[-1].fecha)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount != 1:
+                session_db.rollback()
+                return 0
+
+            _acumular(session_db, VentaPorHora, [{'hora': h, 'producto_id': p, 'cantidad': c, 'ingresos': round(i, 2)} for (h, p), (c, i, _) in por_hora.items()])
+            _acumular(session_db, VentaPorDia, [{'dia': d, 'producto_id': p, 'cantidad': c, 'ingresos': round(i, 2)} for (d, p), (c, i, _) in por_dia.items()])
+            _acumular(session_db, VentaPorUsuario, [{'usuario_id': u, 'cantidad': c, 'gastado': round(i, 2), 'ultima_compra': f} for u, (c, i, f) in por_usuario.items()])
+            session_db.commit()
+            return len(filas)
+        except Exception:
+            session_db.rollback()
+            raise
+
+async def procesar_ventas(intervalo=ANALITICA_INTERVALO, lote=ANALITICA_LOTE):
+    """Tarea de fondo del bot: mantiene al día las tablas de ventas."""
+    while True:
+        try:
+            procesados = await run_db(acumular_ventas, lote)
+        except Exception as e:
+            logger.error(f"Error acumulando ventas: {e}")
+            procesados = 0
+        # Con un lote completo hay más pendientes (carga inicial): se sigue sin esperar.
+        if procesados < lote:
+            await asyncio.sleep(intervalo)
+
+def resumen_ventas(session_db, ahora=None, dias=30, top=10):
+    """
+    Datos del dashboard. Cada consulta lee a lo sumo 24 horas o `dias` días por producto de las
+    tablas de resumen, o `top` filas del índice de compradores: no depende del tamaño del historial.
+    """
+    ahora = ahora or datetime.now()
+    hora_actual = ahora.replace(minute=0, second=0, microsecond=0)
+    desde_hora = hora_actual - timedelta(hours=23)
+    desde_dia = ahora.date() - timedelta(days=dias - 1)
+
+    cursor = session_db.query(CursorVentas).filter(CursorVentas.id == 1).first()
+
+    por_hora = dict((h, (c, i)) for h, c, i in (
+        session_db.query(VentaPorHora.hora, func.sum(VentaPorHora.cantidad), func.sum(VentaPorHora.ingresos))
+        .filter(VentaPorHora.hora >= desde_hora).group_by(VentaPorHora.hora)
+    ))
+    horas = [(h, *por_hora.get(h, (0, 0.0))) for h in (desde_hora + timedelta(hours=n) for n in range(24))]
+
+    por_dia = dict((d, (c, i)) for d, c, i in (
+        session_db.query(VentaPorDia.dia, func.sum(VentaPorDia.cantidad), func.sum(VentaPorDia.ingresos))
+        .filter(VentaPorDia.dia >= desde_dia).group_by(VentaPorDia.dia)
+    ))
+    dias_lista = [(d, *por_dia.get(d, (0, 0.0))) for d in (desde_dia + timedelta(days=n) for n in range(dias))]
+
+    ventas_producto = (
+        session_db.query(VentaPorDia.producto_id, func.sum(VentaPorDia.cantidad).label('cantidad'), func.sum(VentaPorDia.ingresos).label('ingresos'))
+        .filter(VentaPorDia.dia >= desde_dia).group_by(VentaPorDia.producto_id).subquery()
+    )
+    top_productos = (
+        session_db.query(ventas_producto.c.producto_id, Producto.nombre, ventas_producto.c.cantidad, ventas_producto.c.ingresos)
+        .outerjoin(Producto, Producto.id == ventas_producto.c.producto_id)
+        .order_by(ventas_producto.c.ingresos.desc()).limit(top).all()
+    )
+    top_compradores = (
+        session_db.query(VentaPorUsuario.usuario_id, Usuario.username, VentaPorUsuario.cantidad, VentaPorUsuario.gastado, VentaPorUsuario.ultima_compra)
+        .outerjoin(Usuario, Usuario.id == VentaPorUsuario.usuario_id)
+        .order_by(VentaPorUsuario.gastado.desc()).limit(top).all()
+    )
+
+    return {
+        'hoy': por_dia.get(ahora.date(), (0, 0.0)),
+        'ultimas_24h': (sum(c for _, c, _ in horas), sum(i for _, _, i in horas)),
+        'ultimos_dias': (sum(c for _, c, _ in dias_lista), sum(i for _, _, i in dias_lista)),
+        'historico': (cursor.cantidad, cursor.ingresos) if cursor else (0, 0.0),
+        'actualizado': cursor.actualizado if cursor else None,
+        'horas': horas,
+        'dias': dias_lista,
+        'top_productos': top_productos,
+        'top_compradores': top_compradores,
+    }
+
+
+if __name__ == '__main__':
+    # Uso: python analitica.py  (acumula todos los movimientos pendientes de DATABASE_URL)
+    logging.basicConfig(level=logging.INFO)
+    total = 0
+    while (procesados := acumular_ventas()):
+        total += procesados
+    print(f"Movimientos acumulados en las tablas de ventas: {total}.")
@@ -0,0 +1,116 @@
+"""
+Dashboard de ventas: tablas de resumen incrementales vs agregación directa sobre el ledger.
+
+Para cada tamaño de historial siembra compras repartidas en un año y mide:
+- la carga inicial de las tablas de resumen (analitica.acumular_ventas hasta quedar al día),
+- una pasada incremental después de 1000 compras nuevas,
+- el dashboard (analitica.resumen_ventas) contra las mismas cifras calculadas con GROUP BY
+  sobre movimientos, como se haría sin resúmenes.
+El dashboard debería costar lo mismo con cualquier tamaño; la agregación directa crece con el historial.
+
+Uso: python benchmarks/bench_analitica.py [tamaños...]   (por defecto 50000 500000)
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DIRECTORIO = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(DIRECTORIO, 'bench_analitica.db')}"
+
+from sqlalchemy import func
+import db_models
+from db_models import Base, Usuario, Producto, Movimiento, TIPO_COMPRA, TIPO_RECARGA, configurar_engine, get_session
+from analitica import acumular_ventas, resumen_ventas
+
+TAMANOS = [int(t) for t in sys.argv[1:]] or [50000, 500000]
+USUARIOS = 5000
+PRODUCTOS = 50
+LOTE_SIEMBRA = 20000
+REPETICIONES = 20
+
+
+def sembrar_movimientos(cantidad, desde, hasta):
+    """Inserta `cantidad` movimientos (9 de cada 10 compras) con fechas crecientes entre `desde` y `hasta`."""
+    paso = (hasta - desde) / cantidad
+    precios = {p: round(1 + p * 0.5, 2) for p in range(1, PRODUCTOS + 1)}
+    filas = []
+    for i in range(cantidad):
+        fecha = desde + paso * i
+        usuario_id = random.randint(1, USUARIOS)
+        if i % 10:
+            producto_id = random.randint(1, PRODUCTOS)
+            filas.append({'usuario_id': usuario_id, 'tipo': TIPO_COMPRA, 'monto': -precios[producto_id], 'producto_id': producto_id, 'fecha': fecha})
+        else:
+            filas.append({'usuario_id': usuario_id, 'tipo': TIPO_RECARGA, 'monto': 50.0, 'producto_id': None, 'fecha': fecha})
+        if len(filas) == LOTE_SIEMBRA or i == cantidad - 1:
+            with db_models.engine.begin() as conn:
+                conn.execute(Movimiento.__table__.insert(), filas)
+            filas = []
+
+
+def agregacion_directa(session_db, ahora):
+    """Las cifras del dashboard calculadas desde movimientos en cada vista."""
+    desde_hora = ahora.replace(minute=0, second=0, microsecond=0) - timedelta(hours=23)
+    desde_dia = datetime.combine(ahora.date() - timedelta(days=29), datetime.min.time())
+    compras = session_db.query(Movimiento).filter(Movimiento.tipo == TIPO_COMPRA)
+    compras.filter(Movimiento.fecha >= desde_hora).with_entities(func.count(Movimiento.id), func.sum(Movimiento.monto)).one()
+    compras.filter(Movimiento.fecha >= desde_dia).with_entities(func.date(Movimiento.fecha), func.count(Movimiento.id), func.sum(Movimiento.monto)).group_by(func.date(Movimiento.fecha)).all()
+    compras.filter(Movimiento.fecha >= desde_dia).with_entities(Movimiento.producto_id, func.sum(Movimiento.monto).label('m')).group_by(Movimiento.producto_id).order_by('m').limit(10).all()
+    compras.with_entities(Movimiento.usuario_id, func.sum(Movimiento.monto).label('m')).group_by(Movimiento.usuario_id).order_by('m').limit(10).all()
+    compras.with_entities(func.count(Movimiento.id), func.sum(Movimiento.monto)).one()
+
+
+def medir(funcion):
+    mejor = None
+    for _ in range(REPETICIONES):
+        with get_session() as session_db:
+            inicio = time.perf_counter()
+            funcion(session_db)
+            duracion = time.perf_counter() - inicio
+        mejor = duracion if mejor is None else min(mejor, duracion)
+    return mejor
+
+
+def main():
+    configurar_engine('script', os.environ['DATABASE_URL'])
+    Base.metadata.create_all(db_models.engine)
+    with get_session() as session_db:
+        session_db.add_all([Usuario(username=f'user{i:05d}', login_key='clave', saldo=0) for i in range(USUARIOS)])
+        session_db.add_all([Producto(nombre=f'Producto {p}', categoria='General', precio=1 + p * 0.5) for p in range(1, PRODUCTOS + 1)])
+        session_db.commit()
+
+    ahora = datetime.now()
+    sembrados = 0
+    for tamano in sorted(TAMANOS):
+        # El historial crece hacia atrás: el último mes siempre tiene la misma densidad de compras.
+        nuevos = tamano - sembrados
+        hasta = ahora - timedelta(days=365 * sembrados / max(TAMANOS)) - timedelta(minutes=5)
+        sembrar_movimientos(nuevos, hasta - timedelta(days=365 * nuevos / max(TAMANOS)), hasta)
+        sembrados = tamano
+
+        with db_models.engine.begin() as conn:
+            for tabla in ('ventas_por_hora', 'ventas_por_dia', 'ventas_por_usuario', 'cursor_ventas'):
+                conn.exec_driver_sql(f'DELETE FROM {tabla}')
+        inicio = time.perf_counter()
+        while acumular_ventas(margen=0):
+            pass
+        carga = time.perf_counter() - inicio
+
+        sembrar_movimientos(1000, ahora - timedelta(minutes=4), ahora - timedelta(minutes=1))
+        sembrados += 1000
+        inicio = time.perf_counter()
+        acumular_ventas(margen=0)
+        incremental = time.perf_counter() - inicio
+
+        resumen = medir(lambda s: resumen_ventas(s, ahora))
+        directo = medir(lambda s: agregacion_directa(s, ahora))
+        print(f"{sembrados:>8} movimientos | carga inicial {carga:6.2f}s | incremental (1000 nuevos) {incremental * 1000:6.1f} ms | "
+              f"dashboard con resúmenes {resumen * 1000:6.2f} ms | agregación directa {directo * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Tiempo de arranque de los procesos del Procfile (release, web y worker).
+
+Corre los comandos tal como están en el Procfile, sobre una base SQLite temporal:
+- release: `python migraciones.py` sobre una base vacía (una vez por deploy).
+- web: gunicorn con N workers, sin y con --preload. Mide hasta la primera respuesta de /login
+  y hasta que todos los workers terminaron de inicializarse (hook post_worker_init).
+- worker: el bot en modo webhook contra el Bot API falso, hasta que registra el webhook.
+Además mide el import en frío de admin_panel y bot_main en un intérprete nuevo.
+
+Para comparar con otra versión, pasar el directorio de un checkout de esa versión
+(p. ej. `git worktree add /tmp/antes <commit>`).
+
+Uso: python benchmarks/bench_arranque.py [workers_web] [repeticiones] [directorio_del_repo]
+"""
+import os
+import re
+import sys
+import time
+import shlex
+import tempfile
+import subprocess
+import statistics
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_bot_api import FakeBotAPI, puerto_libre, iniciar
+
+WORKERS = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+REPETICIONES = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+RAIZ = os.path.abspath(sys.argv[3]) if len(sys.argv) > 3 else os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORIO = tempfile.mkdtemp()
+ENV = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(DIRECTORIO, 'bench_arranque.db')}")
+
+
+def procfile():
+    """{proceso: comando} del Procfile del repo."""
+    with open(os.path.join(RAIZ, 'Procfile')) as f:
+        return dict(re.match(r'^(\w+):\s*(.+)$', l).groups() for l in f if re.match(r'^\w+:', l))
+
+
+def lanzar(comando, env):
+    # exec: terminate() llega al proceso del Procfile y no al shell.
+    comando = re.sub(r'^python\b', shlex.quote(sys.executable), comando)
+    return subprocess.Popen(f'exec {comando}', shell=True, cwd=RAIZ, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def esperar(condicion, limite=60):
+    fin = time.time() + limite
+    while not condicion():
+        if time.time() > fin:
+            raise RuntimeError("El proceso no arrancó a tiempo.")
+        time.sleep(0.005)
+
+
+def resumen(nombre, valores):
+    print(f"  {nombre:<36} mediana {statistics.median(valores) * 1000:7.0f} ms  (min {min(valores) * 1000:.0f} ms)")
+
+
+def medir_import(modulo):
+    valores = []
+    for _ in range(REPETICIONES):
+        inicio = time.perf_counter()
+        subprocess.run([sys.executable, '-c', f'import {modulo}'], cwd=RAIZ, env=ENV, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        valores.append(time.perf_counter() - inicio)
+    resumen(f"import {modulo}", valores)
+
+
+def medir_release(comando):
+    inicio = time.perf_counter()
+    if lanzar(comando, ENV).wait() != 0:
+        raise RuntimeError("Falló la fase release.")
+    resumen("release (base vacía)", [time.perf_counter() - inicio])
+
+
+def medir_web(comando, preload):
+    comando = comando.replace('--preload', '').strip()
+    if preload:
+        comando = comando.replace('gunicorn', 'gunicorn --preload', 1)
+    marcas = os.path.join(DIRECTORIO, 'workers.txt')
+    config = os.path.join(DIRECTORIO, 'gunicorn_bench.py')
+    with open(config, 'w') as f:
+        f.write(f"import time\ndef post_worker_init(worker):\n    with open({marcas!r}, 'a') as f: f.write(f'{{time.time()}}\\n')\n")
+
+    primera, todos = [], []
+    for _ in range(REPETICIONES):
+        if os.path.exists(marcas):
+            os.remove(marcas)
+        puerto = puerto_libre()
+        url = f'http://127.0.0.1:{puerto}/login'
+
+        def responde():
+            try:
+                return urllib.request.urlopen(url, timeout=1).status == 200
+            except OSError:
+                return False
+
+        def workers_listos():
+            return os.path.exists(marcas) and len(open(marcas).read().split()) >= WORKERS
+
+        inicio = time.time()
+        proceso = lanzar(f'{comando} --workers {WORKERS} --bind 127.0.0.1:{puerto} -c {config}', ENV)
+        try:
+            esperar(responde)
+            primera.append(time.time() - inicio)
+            esperar(workers_listos)
+            todos.append(max(float(t) for t in open(marcas).read().split()) - inicio)
+        finally:
+            proceso.terminate(); proceso.wait(10)
+    etiqueta = 'con --preload' if preload else 'sin --preload'
+    resumen(f"web {etiqueta}: primera respuesta", primera)
+    resumen(f"web {etiqueta}: {WORKERS} workers listos", todos)
+
+
+def medir_bot(comando):
+    servidor, api_port = iniciar()
+    valores = []
+    for _ in range(REPETICIONES):
+        FakeBotAPI.reiniciar()
+        puerto = puerto_libre()
+        env = dict(ENV, BOT_MODO='webhook', TOKEN='123456:FAKE', PORT=str(puerto), WEBHOOK_URL=f'http://127.0.0.1:{puerto}',
+                   TELEGRAM_API_URL=f'http://127.0.0.1:{api_port}/bot')
+        inicio = time.perf_counter()
+        proceso = lanzar(comando, env)
+        try:
+            if not FakeBotAPI.webhook_listo.wait(60):
+                raise RuntimeError("El bot no registró el webhook.")
+            valores.append(time.perf_counter() - inicio)
+        finally:
+            proceso.terminate(); proceso.wait(10)
+    servidor.shutdown()
+    resumen("worker: webhook registrado", valores)
+
+
+def main():
+    comandos = procfile()
+    print(f"{RAIZ} | {WORKERS} workers web | {REPETICIONES} repeticiones")
+    if 'release' in comandos:
+        medir_release(comandos['release'])
+    else:
+        subprocess.run([sys.executable, 'migraciones.py'], cwd=RAIZ, env=ENV, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    medir_import('admin_panel')
+    medir_import('bot_main')
+    medir_web(comandos['web'], preload=False)
+    medir_web(comandos['web'], preload=True)
+    medir_bot(comandos['worker'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark: throughput del bot con N usuarios concurrentes simulados.
+
+Compara los handlers ejecutando las consultas directamente en el event loop (antes)
+contra el pool de hilos de `db_models.run_db` (después). Se agrega una latencia
+artificial por consulta para simular el round-trip a PostgreSQL.
+
+Uso: python benchmarks/bench_async_db.py [usuarios] [latencia_ms]
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from types import SimpleNamespace
+
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'bench_async.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_FILE}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event
+import db_models
+import bot_main
+from db_models import Base, Usuario, engine, get_session
+
+USUARIOS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+LATENCIA = (float(sys.argv[2]) if len(sys.argv) > 2 else 5.0) / 1000
+
+
+class FakeMessage:
+    def __init__(self, text=''):
+        self.text = text
+
+    async def reply_text(self, *args, **kwargs):
+        await asyncio.sleep(0)
+
+
+def fake_update(telegram_id, text=''):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=telegram_id), message=FakeMessage(text))
+
+
+def sembrar():
+    Base.metadata.create_all(engine)
+    with get_session() as session_db:
+        session_db.add_all([Usuario(username=f'user{i}', login_key='clave', telegram_id=1000 + i, saldo=10) for i in range(USUARIOS)])
+        session_db.commit()
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _latencia_simulada(conn, cursor, statement, parameters, context, executemany):
+    time.sleep(LATENCIA)
+
+
+async def _run_inline(func, *args, **kwargs):
+    """Comportamiento anterior: la consulta bloquea el event loop."""
+    return func(*args, **kwargs)
+
+
+async def medir(etiqueta):
+    context = SimpleNamespace(user_data={})
+    inicio = time.perf_counter()
+    await asyncio.gather(*(bot_main.show_account(fake_update(1000 + i), context) for i in range(USUARIOS)))
+    duracion = time.perf_counter() - inicio
+    print(f"{etiqueta:<28} {USUARIOS} updates en {duracion:.2f}s -> {USUARIOS / duracion:,.0f} updates/s")
+    return duracion
+
+
+async def main():
+    sembrar()
+    original = bot_main.run_db
+    bot_main.run_db = _run_inline
+    antes = await medir('Antes (bloqueante):')
+    bot_main.run_db = original
+    despues = await medir(f'Después (run_db x{db_models.DB_EXECUTOR_WORKERS}):')
+    print(f"Mejora: {antes / despues:.1f}x")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
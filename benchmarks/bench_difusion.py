@@ -0,0 +1,91 @@
+"""
+Difusiones contra un Bot API falso: verifica límites de tasa, manejo de 429 y agrupado.
+
+Siembra N usuarios con Telegram vinculado, crea dos difusiones seguidas, arranca
+`bot_main.py` en modo webhook apuntando al Bot API falso (que responde 429 cada
+`cada_429` envíos) y espera a que todos los chats reciban ambos mensajes. Reporta la
+tasa sostenida, el pico en cualquier ventana de 1s y cuántos sendMessage hicieron falta
+(los mensajes pendientes para un mismo chat se agrupan en uno solo).
+
+Uso: python benchmarks/bench_difusion.py [usuarios] [envios_por_segundo] [cada_429]
+     Ejemplo: python benchmarks/bench_difusion.py 300 25 50
+"""
+import os
+import sys
+import time
+import bisect
+import tempfile
+import subprocess
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'bench_difusion.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_FILE}'
+sys.path.insert(0, RAIZ)
+
+from db_models import Base, Usuario, engine, get_session
+from difusiones import crear_difusion
+from fake_bot_api import FakeBotAPI, puerto_libre, iniciar
+
+USUARIOS = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+TASA = float(sys.argv[2]) if len(sys.argv) > 2 else 25
+CADA_429 = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+TEXTOS = ('📢 Reposición de stock', '💸 Nuevos precios')
+
+
+def sembrar():
+    Base.metadata.create_all(engine)
+    with get_session() as session_db:
+        session_db.add_all([Usuario(username=f'user{i}', login_key='clave', telegram_id=1000 + i, saldo=0) for i in range(USUARIOS)])
+        # Usuarios sin Telegram vinculado: no deben recibir nada.
+        session_db.add_all([Usuario(username=f'offline{i}', login_key='clave', saldo=0) for i in range(USUARIOS // 10)])
+        for texto in TEXTOS:
+            crear_difusion(session_db, texto, creada_por='bench')
+        session_db.commit()
+
+
+def pico_por_segundo(tiempos):
+    tiempos = sorted(tiempos)
+    return max(bisect.bisect_right(tiempos, t + 1.0) - i for i, t in enumerate(tiempos)) if tiempos else 0
+
+
+def main():
+    sembrar()
+    FakeBotAPI.cada_429 = CADA_429
+    servidor, api_port = iniciar()
+    bot_port = puerto_libre()
+    env = dict(os.environ, BOT_MODO='webhook', TOKEN='123456:FAKE', PORT=str(bot_port), WEBHOOK_URL=f'http://127.0.0.1:{bot_port}',
+               TELEGRAM_API_URL=f'http://127.0.0.1:{api_port}/bot', ENVIOS_POR_SEGUNDO=str(TASA), DIFUSION_INTERVALO='0.5')
+    bot = subprocess.Popen([sys.executable, os.path.join(RAIZ, 'bot_main.py')], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not FakeBotAPI.webhook_listo.wait(30):
+            raise RuntimeError("El bot no registró el webhook.")
+        inicio = time.perf_counter()
+        completos = lambda: sum(1 for t in FakeBotAPI.textos.values() if all(x in '\n\n'.join(t) for x in TEXTOS))
+        limite = time.time() + 4 * USUARIOS / TASA + 30
+        while completos() < USUARIOS and time.time() < limite:
+            time.sleep(0.1)
+        time.sleep(1)  # Margen para detectar envíos de más.
+    finally:
+        bot.terminate(); bot.wait(10)
+        servidor.shutdown()
+
+    tiempos = [t for v in FakeBotAPI.respuestas.values() for t in v]
+    duracion = max(tiempos) - inicio if tiempos else 0
+    desordenados = [c for c, t in FakeBotAPI.textos.items() if '\n\n'.join(t).find(TEXTOS[0]) > '\n\n'.join(t).find(TEXTOS[1])]
+    pico = pico_por_segundo(tiempos)
+    print(f"{USUARIOS} usuarios x {len(TEXTOS)} difusiones en {duracion:.1f}s: {len(tiempos)} sendMessage aceptados, "
+          f"{FakeBotAPI.rechazos_429} respondidos con 429 | {len(tiempos) / duracion if duracion else 0:.1f} msg/s, pico {pico} en 1s (límite {TASA:.0f}/s)")
+
+    errores = []
+    if completos() != USUARIOS: errores.append(f"solo {completos()}/{USUARIOS} chats recibieron ambas difusiones")
+    if set(FakeBotAPI.textos) - {1000 + i for i in range(USUARIOS)}: errores.append("se enviaron mensajes a chats que no son destinatarios")
+    if desordenados: errores.append(f"{len(desordenados)} chats recibieron las difusiones fuera de orden")
+    if pico > TASA + 1: errores.append(f"se superó el límite global: {pico} mensajes en 1s")
+    if CADA_429 and not FakeBotAPI.rechazos_429: errores.append("no se ejercitó el manejo de 429")
+    if errores:
+        print("FALLO:\n - " + "\n - ".join(errores)); sys.exit(1)
+    print("OK: todos los chats recibieron las difusiones en orden y sin superar el límite de tasa.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+"""
+Carga de punta a punta del bot y del panel, con umbral de regresión.
+
+Siembra usuarios, productos y keys, y mide por flujo el throughput y la latencia p50/p95/p99:
+- bot (handlers de bot_main con Updates sintéticos, hasta BOT_CONCURRENCIA a la vez como el bot real):
+  login (handle_login_key), explorar (show_buy_menu + handle_category_selection + show_account)
+  y compra (handle_final_purchase, una key por usuario);
+- panel (admin_panel con el test client de Flask, un hilo por thread de gunicorn):
+  productos (manage_products), keys (manage_keys) e importación de keys (POST a manage_keys).
+
+Todo se repite BENCH_REPETICIONES veces (por defecto 3), cada vez en un intérprete nuevo y sobre una
+base recién sembrada, y se reporta la mediana de cada cifra. Los resultados se comparan con una línea base guardada por motor de base
+de datos y cantidad de usuarios: si algún flujo
+pierde más de BENCH_TOLERANCIA de throughput o su p95 crece más que eso, el script termina con
+código 1. La línea base depende de la máquina: se genera con --guardar en la misma máquina (o runner
+de CI) donde se va a comparar, y no se versiona.
+
+El hash de las login_key usa pocas iteraciones (HASH_ITERACIONES=1000 si no se define) para que el
+flujo de login mida los handlers y la base, no PBKDF2; el costo del hash lo mide bench_login.py.
+
+Uso: python benchmarks/bench_e2e.py [usuarios] [--guardar]   (por defecto 2000 usuarios)
+     BENCH_DATABASE_URL=postgresql://... para correrlo contra PostgreSQL (borra y recrea las tablas).
+     BENCH_LINEA_BASE=ruta.json (por defecto benchmarks/linea_base_e2e.json), BENCH_TOLERANCIA=0.25.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import tempfile
+import threading
+import subprocess
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(DIRECTORIO))
+DIRECTORIO_DB = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL', f"sqlite:///{os.path.join(DIRECTORIO_DB, 'bench_e2e.db')}")
+os.environ.setdefault('HASH_ITERACIONES', '1000')
+
+import db_models
+import bot_main
+import admin_panel
+from credenciales import hashear
+from db_models import Base, Usuario, Producto, Key, StockProducto, configurar_engine, get_session, inicializar_db, leer_version_catalogo
+
+ARGUMENTOS = [a for a in sys.argv[1:] if a.isdigit()]
+USUARIOS = int(ARGUMENTOS[0]) if ARGUMENTOS else 2000
+GUARDAR = '--guardar' in sys.argv
+LINEA_BASE = os.getenv('BENCH_LINEA_BASE', os.path.join(DIRECTORIO, 'linea_base_e2e.json'))
+TOLERANCIA = float(os.getenv('BENCH_TOLERANCIA', '0.25'))
+REPETICIONES = int(os.getenv('BENCH_REPETICIONES', '3'))
+
+CATEGORIAS = ('Windows', 'Office', 'Antivirus', 'Juegos')
+PRODUCTOS_POR_CATEGORIA = 5
+HILOS_PANEL = int(os.getenv('GUNICORN_THREADS', '4'))
+SOLICITUDES_PANEL = 400
+IMPORTACIONES = 100
+KEYS_POR_IMPORTACION = 1000
+
+
+# --- Updates Sintéticos ---
+
+class Mensaje:
+    def __init__(self, texto=''):
+        self.text = texto
+        self.reply_markup = None
+
+    async def reply_text(self, *args, **kwargs):
+        await asyncio.sleep(0)
+
+    async def reply_document(self, *args, **kwargs):
+        await asyncio.sleep(0)
+
+
+class Callback:
+    def __init__(self, data):
+        self.data = data
+        self.message = Mensaje()
+
+    async def answer(self, *args, **kwargs):
+        await asyncio.sleep(0)
+
+    async def edit_message_reply_markup(self, *args, **kwargs):
+        await asyncio.sleep(0)
+
+    async def edit_message_text(self, *args, **kwargs):
+        await asyncio.sleep(0)
+
+
+def update_mensaje(telegram_id, texto):
+    mensaje = Mensaje(texto)
+    return SimpleNamespace(effective_user=SimpleNamespace(id=telegram_id), message=mensaje, effective_message=mensaje, callback_query=None)
+
+
+def update_callback(telegram_id, data):
+    query = Callback(data)
+    return SimpleNamespace(effective_user=SimpleNamespace(id=telegram_id), message=None, effective_message=query.message, callback_query=query)
+
+
+# --- Siembra ---
+
+def sembrar():
+    Base.metadata.drop_all(db_models.engine)
+    inicializar_db(db_models.engine)
+    with get_session() as session_db:
+        session_db.add_all([Usuario(username=f'user{i:05d}', login_key=hashear(f'clave{i}'), saldo=100) for i in range(USUARIOS)])
+        productos = [Producto(nombre=f'{c} {n}', categoria=c, precio=1.0 + n) for c in CATEGORIAS for n in range(PRODUCTOS_POR_CATEGORIA)]
+        session_db.add_all(productos)
+        session_db.flush()
+        producto_ids = [p.id for p in productos]
+        session_db.add_all([StockProducto(producto_id=p, disponibles=USUARIOS, usadas=0) for p in producto_ids])
+        session_db.commit()
+    with db_models.engine.begin() as conn:
+        for producto_id in producto_ids:
+            conn.execute(Key.__table__.insert(), [{'licencia': f'E2E-{producto_id:03d}-{i:07d}', 'producto_id': producto_id, 'estado': 'available'}
+                                                  for i in range(USUARIOS)])
+    return producto_ids
+
+
+# --- Medición ---
+
+def percentil(ordenadas, p):
+    return ordenadas[min(len(ordenadas) - 1, int(len(ordenadas) * p / 100))]
+
+
+def mediana(valores):
+    ordenados = sorted(valores)
+    mitad = len(ordenados) // 2
+    return ordenados[mitad] if len(ordenados) % 2 else (ordenados[mitad - 1] + ordenados[mitad]) / 2
+
+
+def resumir(latencias, duracion):
+    ordenadas = sorted(latencias)
+    return {'operaciones': len(ordenadas), 'ops_s': len(ordenadas) / duracion,
+            'p50_ms': percentil(ordenadas, 50) * 1000, 'p95_ms': percentil(ordenadas, 95) * 1000, 'p99_ms': percentil(ordenadas, 99) * 1000}
+
+
+async def flujo_bot(pasos):
+    """Corre `pasos(i)` (una corrutina por usuario simulado) con la concurrencia del bot. Retorna el resumen."""
+    limite = asyncio.Semaphore(bot_main.BOT_CONCURRENCIA)
+    latencias = []
+
+    async def usuario(i):
+        async with limite:
+            inicio = time.perf_counter()
+            await pasos(i)
+            latencias.append(time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(usuario(i) for i in range(USUARIOS)))
+    return resumir(latencias, time.perf_counter() - inicio)
+
+
+def flujo_panel(solicitudes, solicitud):
+    """Corre `solicitud(cliente, i)` para cada i en HILOS_PANEL hilos, cada uno con su cliente logueado."""
+    clientes = {}
+
+    def cliente():
+        hilo = threading.get_ident()
+        if hilo not in clientes:
+            clientes[hilo] = admin_panel.app.test_client()
+            with clientes[hilo].session_transaction() as sesion:
+                sesion['logged_in'] = True
+        return clientes[hilo]
+
+    def medir(i):
+        c = cliente()
+        inicio = time.perf_counter()
+        respuesta = solicitud(c, i)
+        duracion = time.perf_counter() - inicio
+        if respuesta.status_code >= 400:
+            raise RuntimeError(f'{respuesta.request.path} respondió {respuesta.status_code}')
+        return duracion
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=HILOS_PANEL) as pool:
+        latencias = list(pool.map(medir, range(solicitudes)))
+    return resumir(latencias, time.perf_counter() - inicio)
+
+
+async def flujos_bot(producto_ids):
+    contexto = lambda: SimpleNamespace(user_data={})
+    telegram_id = lambda i: 100000 + i
+    resultados = {}
+
+    logins = bot_main.LOGINS.valor('ok')
+    resultados['bot_login'] = await flujo_bot(lambda i: bot_main.handle_login_key(update_mensaje(telegram_id(i), f'user{i:05d} clave{i}'), contexto()))
+    if bot_main.LOGINS.valor('ok') - logins != USUARIOS:
+        raise RuntimeError(f'logins correctos: {bot_main.LOGINS.valor("ok") - logins} de {USUARIOS}')
+
+    async def explorar(i):
+        ctx = contexto()
+        await bot_main.show_buy_menu(update_mensaje(telegram_id(i), '🛒 Comprar Keys'), ctx)
+        await bot_main.handle_category_selection(update_mensaje(telegram_id(i), CATEGORIAS[i % len(CATEGORIAS)]), ctx)
+        await bot_main.show_account(update_mensaje(telegram_id(i), '👤 Mi Cuenta'), ctx)
+    resultados['bot_explorar'] = await flujo_bot(explorar)
+
+    with get_session() as session_db:
+        version = leer_version_catalogo(session_db)
+    compras = bot_main.COMPRAS.valor('ok')
+    resultados['bot_compra'] = await flujo_bot(lambda i: bot_main.handle_final_purchase(
+        update_callback(telegram_id(i), f'qty:{random.choice(producto_ids)}:{version}:1'), contexto()))
+    if bot_main.COMPRAS.valor('ok') - compras != USUARIOS:
+        raise RuntimeError(f'compras correctas: {bot_main.COMPRAS.valor("ok") - compras} de {USUARIOS}')
+    return resultados
+
+
+def flujos_panel(producto_ids):
+    resultados = {}
+    resultados['panel_productos'] = flujo_panel(SOLICITUDES_PANEL, lambda c, i: c.get('/manage_products'))
+    resultados['panel_keys'] = flujo_panel(SOLICITUDES_PANEL, lambda c, i: c.get(f'/product/{producto_ids[i % len(producto_ids)]}/keys'))
+    resultados['panel_importar_keys'] = flujo_panel(IMPORTACIONES, lambda c, i: c.post(
+        f'/product/{producto_ids[i % len(producto_ids)]}/keys',
+        data={'licencias': '\n'.join(f'IMP-{i:04d}-{n:06d}' for n in range(KEYS_POR_IMPORTACION))}))
+    return resultados
+
+
+# --- Línea Base ---
+
+def comparar(resultados, base):
+    """Lista de regresiones de `resultados` contra `base` (mismo formato) mayores a TOLERANCIA."""
+    regresiones = []
+    for flujo, actual in resultados.items():
+        anterior = base.get(flujo)
+        if not anterior:
+            continue
+        if actual['ops_s'] < anterior['ops_s'] * (1 - TOLERANCIA):
+            regresiones.append(f"{flujo}: throughput {actual['ops_s']:.1f} ops/s vs {anterior['ops_s']:.1f} en la línea base")
+        if actual['p95_ms'] > anterior['p95_ms'] * (1 + TOLERANCIA):
+            regresiones.append(f"{flujo}: p95 {actual['p95_ms']:.1f} ms vs {anterior['p95_ms']:.1f} ms en la línea base")
+    return regresiones
+
+
+def ronda():
+    """Corre en el proceso hijo: siembra la base de DATABASE_URL, corre todos los flujos e imprime {flujo: resumen} en JSON."""
+    url = os.environ['DATABASE_URL']
+    configurar_engine('script', url)
+    producto_ids = sembrar()
+
+    configurar_engine('bot', url)
+    resultados = asyncio.run(flujos_bot(producto_ids))
+    configurar_engine('web', url)
+    resultados.update(flujos_panel(producto_ids))
+    print(json.dumps(resultados))
+
+
+def main():
+    if 'ronda' in sys.argv[1:]:
+        return ronda()
+    motor = db_models.engine.dialect.name
+    rondas = []
+    for n in range(REPETICIONES):
+        url = os.getenv('BENCH_DATABASE_URL') or f"sqlite:///{os.path.join(DIRECTORIO_DB, f'bench_e2e_{n}.db')}"
+        salida = subprocess.run([sys.executable, os.path.abspath(__file__), 'ronda', str(USUARIOS)], env=dict(os.environ, DATABASE_URL=url),
+                                stdout=subprocess.PIPE, text=True, check=True)
+        rondas.append(json.loads(salida.stdout.splitlines()[-1]))
+    resultados = {flujo: {cifra: mediana([r[flujo][cifra] for r in rondas]) for cifra in rondas[0][flujo]} for flujo in rondas[0]}
+
+    print(f"{motor}, {USUARIOS} usuarios simulados (bot: concurrencia {bot_main.BOT_CONCURRENCIA}, panel: {HILOS_PANEL} hilos), "
+          f"mediana de {REPETICIONES} rondas")
+    for flujo, r in resultados.items():
+        print(f"  {flujo:<20} {r['operaciones']:>6.0f} ops | {r['ops_s']:9.1f} ops/s | "
+              f"p50 {r['p50_ms']:8.2f} ms | p95 {r['p95_ms']:8.2f} ms | p99 {r['p99_ms']:8.2f} ms")
+
+    lineas_base = {}
+    if os.path.exists(LINEA_BASE):
+        with open(LINEA_BASE) as f:
+            lineas_base = json.load(f)
+    clave = f'{motor}:{USUARIOS}'
+    if GUARDAR:
+        lineas_base[clave] = resultados
+        with open(LINEA_BASE, 'w') as f:
+            json.dump(lineas_base, f, indent=2, sort_keys=True)
+        print(f"Línea base guardada en {LINEA_BASE} ({clave}).")
+        return
+    if clave not in lineas_base:
+        print(f"Sin línea base para {clave}: correr con --guardar para crearla.")
+        return
+    regresiones = comparar(resultados, lineas_base[clave])
+    if regresiones:
+        print(f"REGRESIÓN (tolerancia {TOLERANCIA:.0%}):")
+        for regresion in regresiones:
+            print(f"  {regresion}")
+        sys.exit(1)
+    print(f"Sin regresiones contra la línea base (tolerancia {TOLERANCIA:.0%}).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Memoria y velocidad de las exportaciones del panel con distintos tamaños de inventario.
+
+Siembra N keys y exporta /exportar/keys (CSV) a través del test client de Flask, leyendo la
+respuesta bloque a bloque como lo haría un servidor. Cada medición corre en un intérprete nuevo
+y reporta el pico de memoria residente por encima de la memoria tras importar el panel, junto
+al mismo export armado en memoria (query(...).all() y un único string), como antes de los endpoints.
+
+Uso: python benchmarks/bench_exportaciones.py [tamaños...]   (por defecto 100000 1000000)
+"""
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+# El proceso principal solo siembra; cada medición recibe la URL de su base por el entorno.
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench_exportaciones.db')}")
+
+TAMANOS = [int(t) for t in sys.argv[1:] if t.isdigit()] or [100000, 1000000]
+LOTE_SIEMBRA = 50000
+
+
+def memoria_kb(campo):
+    with open('/proc/self/status') as f:
+        return next(int(l.split()[1]) for l in f if l.startswith(campo))
+
+
+def sembrar(url, cantidad):
+    from db_models import Base, Producto, Key, StockProducto, crear_engine
+    engine = crear_engine(url)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(Producto.__table__.insert(), {'id': 1, 'nombre': 'Producto', 'categoria': 'General', 'precio': 1.0})
+        conn.execute(StockProducto.__table__.insert(), {'producto_id': 1, 'disponibles': cantidad, 'usadas': 0})
+    for inicio in range(0, cantidad, LOTE_SIEMBRA):
+        with engine.begin() as conn:
+            conn.execute(Key.__table__.insert(), [{'licencia': f'KEY-{i:010d}-XXXX-YYYY-ZZZZ', 'estado': 'available', 'producto_id': 1}
+                                                  for i in range(inicio, min(cantidad, inicio + LOTE_SIEMBRA))])
+    engine.dispose()
+
+
+def medir(modo):
+    """Corre en el proceso hijo: exporta todas las keys y reporta bytes, segundos y pico de memoria."""
+    import admin_panel
+    from db_models import Key, get_session
+    base = memoria_kb('VmRSS')
+    inicio = time.perf_counter()
+    total = 0
+    if modo == 'streaming':
+        cliente = admin_panel.app.test_client()
+        with cliente.session_transaction() as sesion:
+            sesion['logged_in'] = True
+        respuesta = cliente.get('/exportar/keys?formato=csv', buffered=False)
+        for bloque in respuesta.response:
+            total += len(bloque)
+        respuesta.close()
+    else:
+        with get_session() as session_db:
+            keys = session_db.query(Key).order_by(Key.id).all()
+            texto = 'id,licencia,estado,producto_id\n' + ''.join(f'{k.id},{k.licencia},{k.estado},{k.producto_id}\n' for k in keys)
+            total = len(texto.encode())
+    print(total, time.perf_counter() - inicio, memoria_kb('VmHWM') - base)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'medir':
+        return medir(sys.argv[2])
+    directorio = tempfile.mkdtemp()
+    for cantidad in TAMANOS:
+        url = f"sqlite:///{os.path.join(directorio, f'keys_{cantidad}.db')}"
+        sembrar(url, cantidad)
+        for modo in ('en memoria', 'streaming'):
+            salida = subprocess.run([sys.executable, os.path.abspath(__file__), 'medir', modo.replace(' ', '_')], cwd=RAIZ,
+                                    env=dict(os.environ, DATABASE_URL=url), capture_output=True, text=True, check=True)
+            total, segundos, pico_kb = salida.stdout.split()[-3:]
+            print(f"{cantidad:>8} keys | {modo:<10} | {int(total) / 1e6:7.1f} MB en {float(segundos):5.2f}s | "
+                  f"pico de memoria +{int(pico_kb) / 1024:7.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Login del bot con login_key hasheada: latencia del event loop mientras se verifican hashes y
+costo de los intentos rechazados por el límite.
+
+Mide, con N logins concurrentes a través de bot_main.handle_login_key:
+- el retraso máximo de un tick de 10 ms del event loop (lo que esperan los demás handlers)
+  verificando en hash_executor (como el bot) y verificando en el propio loop, como referencia;
+- cuánto tarda y cuántas consultas SQL hace un intento cuando el usuario ya está bloqueado.
+
+Uso: python benchmarks/bench_login.py [logins_concurrentes]   (por defecto 8)
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench_login.db')}"
+
+from sqlalchemy import event
+import db_models
+import bot_main
+import credenciales
+from db_models import Base, Usuario, configurar_engine, get_session
+
+CONCURRENTES = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+TICK = 0.01
+
+
+class Mensaje:
+    def __init__(self, texto):
+        self.text = texto
+        self.respuestas = []
+
+    async def reply_text(self, texto, **kwargs):
+        self.respuestas.append(texto)
+
+
+class UpdateFalso:
+    def __init__(self, texto, telegram_id):
+        self.message = Mensaje(texto)
+        self.effective_user = type('Usuario', (), {'id': telegram_id})
+
+
+async def medir_loop(corrutina):
+    """Corre `corrutina` mientras un tick de TICK segundos mide el mayor retraso del event loop."""
+    retraso_max = 0.0
+    listo = asyncio.Event()
+
+    async def tick():
+        nonlocal retraso_max
+        while not listo.is_set():
+            inicio = time.perf_counter()
+            await asyncio.sleep(TICK)
+            retraso_max = max(retraso_max, time.perf_counter() - inicio - TICK)
+
+    tarea = asyncio.create_task(tick())
+    await asyncio.sleep(0)
+    inicio = time.perf_counter()
+    await corrutina
+    duracion = time.perf_counter() - inicio
+    listo.set()
+    await tarea
+    return duracion, retraso_max
+
+
+async def logins(offset):
+    await asyncio.gather(*(bot_main.handle_login_key(UpdateFalso(f'user{i} clave{i}', offset + i), None) for i in range(CONCURRENTES)))
+
+
+async def main():
+    configurar_engine('bot', os.environ['DATABASE_URL'])
+    Base.metadata.create_all(db_models.engine)
+    with get_session() as session_db:
+        session_db.add_all([Usuario(username=f'user{i}', login_key=credenciales.hashear(f'clave{i}'), saldo=0) for i in range(CONCURRENTES)])
+        session_db.add(Usuario(username='victima', login_key=credenciales.hashear('secreta'), saldo=0))
+        session_db.commit()
+
+    duracion, retraso = await medir_loop(logins(1000))
+    print(f"{CONCURRENTES} logins en hash_executor ({credenciales.HASH_WORKERS} hilos): {duracion:5.2f}s | retraso máximo del loop {retraso * 1000:7.1f} ms")
+
+    verificar_async = bot_main.verificar_async
+    async def en_el_loop(clave, almacenada):
+        return credenciales.verificar(clave, almacenada), None
+    bot_main.verificar_async = en_el_loop
+    duracion, retraso = await medir_loop(logins(2000))
+    bot_main.verificar_async = verificar_async
+    print(f"{CONCURRENTES} logins verificando en el loop:  {duracion:5.2f}s | retraso máximo del loop {retraso * 1000:7.1f} ms")
+
+    for _ in range(bot_main.LIMITE_LOGIN.max_intentos):
+        await bot_main.handle_login_key(UpdateFalso('victima adivinanza', 3000), None)
+    consultas = []
+    event.listen(db_models.engine, 'before_cursor_execute', lambda *args: consultas.append(1))
+    intentos = 1000
+    inicio = time.perf_counter()
+    for _ in range(intentos):
+        await bot_main.handle_login_key(UpdateFalso('victima adivinanza', 3000), None)
+    duracion = time.perf_counter() - inicio
+    print(f"{intentos} intentos bloqueados: {duracion / intentos * 1e6:6.1f} µs por intento | {len(consultas)} consultas SQL")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
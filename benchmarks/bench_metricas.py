@@ -0,0 +1,64 @@
+"""
+Costo de la instrumentación de métricas (eventos SQL y medición por solicitud).
+
+Ejecuta la misma consulta por PK contra dos engines SQLite idénticos, uno instrumentado
+y otro no, y mide el costo de envolver una solicitud con MedidorSolicitudes.medir().
+
+Uso: python benchmarks/bench_metricas.py [consultas]
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench_metricas.db')}"
+
+from sqlalchemy import create_engine, select
+from db_models import Base, Usuario
+from metricas import MedidorSolicitudes, instrumentar_engine, exportar
+
+CONSULTAS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+
+def medir_consultas(engine):
+    stmt = select(Usuario.saldo).where(Usuario.id == 1)
+    with engine.connect() as conn:
+        conn.execute(stmt).scalar()
+        inicio = time.perf_counter()
+        for _ in range(CONSULTAS):
+            conn.execute(stmt).scalar()
+        return (time.perf_counter() - inicio) / CONSULTAS
+
+
+def main():
+    directorio = tempfile.mkdtemp()
+    engines = {}
+    for nombre in ('sin métricas', 'con métricas'):
+        engine = create_engine(f"sqlite:///{os.path.join(directorio, nombre.replace(' ', '_'))}.db")
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(Usuario.__table__.insert(), {'username': 'bench', 'login_key': 'clave', 'saldo': 1})
+        engines[nombre] = engine
+    instrumentar_engine(engines['con métricas'])
+
+    # Se alternan las rondas para que el ruido afecte a ambos por igual; se toma la mejor.
+    resultados = {nombre: min(medir_consultas(engine) for _ in range(3)) for nombre, engine in engines.items()}
+    for nombre, segundos in resultados.items():
+        print(f"{nombre:<14} {segundos * 1e6:7.2f} µs por consulta")
+    print(f"costo por consulta: {(resultados['con métricas'] - resultados['sin métricas']) * 1e6:+.2f} µs")
+
+    medidor = MedidorSolicitudes('bench', 'handler')
+    inicio = time.perf_counter()
+    for _ in range(CONSULTAS):
+        with medidor.medir('handler'):
+            pass
+    print(f"costo por solicitud medida: {(time.perf_counter() - inicio) / CONSULTAS * 1e6:.2f} µs")
+
+    inicio = time.perf_counter()
+    texto = exportar()
+    print(f"exportar /metrics: {(time.perf_counter() - inicio) * 1000:.2f} ms ({len(texto.splitlines())} líneas)")
+
+
+if __name__ == '__main__':
+    main()
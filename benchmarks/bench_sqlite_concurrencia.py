@@ -0,0 +1,128 @@
+"""
+Lecturas y escrituras concurrentes sobre SQLite: engine por defecto vs crear_engine().
+
+Simula el bot (procesos que escriben: ajuste de saldo + movimiento del ledger por
+transacción) y el panel (procesos que leen páginas de usuarios y del ledger) sobre el
+mismo archivo durante unos segundos, primero con un engine como el original
+(create_engine sin pool ni pragmas, journal en modo DELETE) y luego con crear_engine()
+(WAL, synchronous=NORMAL, busy_timeout). Reporta operaciones/s y errores
+"database is locked" de cada lado.
+
+Uso: python benchmarks/bench_sqlite_concurrencia.py [segundos] [procesos_escritores] [procesos_lectores] [hilos_por_proceso]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DIRECTORIO = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(DIRECTORIO, 'inicial.db')}"
+
+SEGUNDOS = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+ESCRITORES = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+LECTORES = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+HILOS = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+USUARIOS = 2000
+
+
+def _engine(modo, url):
+    from sqlalchemy import create_engine
+    from db_models import crear_engine
+    if modo == 'original':
+        # Como db_models/admin_panel antes del cambio: sin pool explícito ni pragmas.
+        return create_engine(url, pool_pre_ping=True)
+    return crear_engine(url, 'bot')
+
+
+def sembrar(url):
+    from sqlalchemy.orm import Session
+    from db_models import Base, Usuario, TIPO_RECARGA, registrar_movimiento
+    from sqlalchemy import create_engine
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    with Session(engine) as session_db:
+        session_db.add_all([Usuario(username=f'user{i:05d}', login_key='clave', telegram_id=1000 + i, saldo=100) for i in range(USUARIOS)])
+        session_db.flush()
+        for usuario_id in range(1, USUARIOS + 1):
+            registrar_movimiento(session_db, usuario_id, TIPO_RECARGA, 100, descripcion='Saldo inicial')
+        session_db.commit()
+    engine.dispose()
+
+
+def escribir(session_db):
+    from db_models import ajustar_saldo
+    ajustar_saldo(session_db, random.randint(1, USUARIOS), -1, descripcion='bench')
+    session_db.commit()
+
+
+def leer(session_db):
+    from db_models import Usuario, Movimiento, paginar_keyset
+    paginar_keyset(session_db.query(Usuario), Usuario.id, random.randint(0, USUARIOS - 50), 50)
+    usuario_id = random.randint(1, USUARIOS)
+    paginar_keyset(session_db.query(Movimiento).filter(Movimiento.usuario_id == usuario_id, Movimiento.tipo == 'compra'), Movimiento.id, None, 10, descendente=True)
+    session_db.query(Usuario.id).filter(Usuario.telegram_id.isnot(None)).count()
+
+
+def proceso(modo, url, rol, fin, resultados):
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.exc import OperationalError
+    engine = _engine(modo, url)
+    Session = sessionmaker(bind=engine)
+    operacion = escribir if rol == 'escritor' else leer
+    conteo = {'ops': 0, 'bloqueos': 0, 'otros': 0}
+    lock = threading.Lock()
+
+    def hilo():
+        ops = bloqueos = otros = 0
+        # Todos los procesos arrancan a la vez, un segundo después de lanzados.
+        time.sleep(max(0.0, fin - SEGUNDOS - time.time()))
+        while time.time() < fin:
+            with Session() as session_db:
+                try:
+                    operacion(session_db)
+                    ops += 1
+                except OperationalError as e:
+                    session_db.rollback()
+                    if 'locked' in str(e) or 'busy' in str(e): bloqueos += 1
+                    else: otros += 1
+        with lock:
+            conteo['ops'] += ops; conteo['bloqueos'] += bloqueos; conteo['otros'] += otros
+
+    hilos = [threading.Thread(target=hilo) for _ in range(HILOS)]
+    for h in hilos: h.start()
+    for h in hilos: h.join()
+    resultados.put((rol, conteo))
+
+
+def medir(modo):
+    url = f"sqlite:///{os.path.join(DIRECTORIO, modo + '.db')}"
+    sembrar(url)
+    resultados = multiprocessing.Queue()
+    fin = time.time() + 1 + SEGUNDOS
+    procesos = [multiprocessing.Process(target=proceso, args=(modo, url, rol, fin, resultados))
+                for rol in ['escritor'] * ESCRITORES + ['lector'] * LECTORES]
+    for p in procesos: p.start()
+    totales = {'escritor': {'ops': 0, 'bloqueos': 0, 'otros': 0}, 'lector': {'ops': 0, 'bloqueos': 0, 'otros': 0}}
+    for _ in procesos:
+        rol, conteo = resultados.get()
+        for clave, valor in conteo.items():
+            totales[rol][clave] += valor
+    for p in procesos: p.join()
+    total = totales['escritor']['ops'] + totales['lector']['ops']
+    print(f"{modo:<10} total {total / SEGUNDOS:6.0f} ops/s | escrituras {totales['escritor']['ops'] / SEGUNDOS:8.0f}/s ({totales['escritor']['bloqueos']} bloqueos) | "
+          f"lecturas {totales['lector']['ops'] / SEGUNDOS:8.0f}/s ({totales['lector']['bloqueos']} bloqueos)"
+          + (f" | otros errores: {totales['escritor']['otros'] + totales['lector']['otros']}" if totales['escritor']['otros'] + totales['lector']['otros'] else ''))
+
+
+def main():
+    print(f"{ESCRITORES} procesos escritores y {LECTORES} lectores x {HILOS} hilos durante {SEGUNDOS:.0f}s")
+    for modo in ('original', 'ajustado'):
+        medir(modo)
+
+
+if __name__ == '__main__':
+    main()
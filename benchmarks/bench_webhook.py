@@ -0,0 +1,125 @@
+"""
+Harness de Telegram falso para el modo webhook: mide throughput y latencia p50/p95/p99.
+
+Levanta un Bot API falso (responde getMe/setWebhook/sendMessage con una latencia
+simulada), arranca `bot_main.py` en modo webhook apuntando a él y le envía por POST
+updates sintéticos de N usuarios. La latencia de cada update es el tiempo entre el POST
+al webhook y la llegada de la respuesta (sendMessage) al Bot API falso.
+
+Cada concurrencia se mide dos veces: con usuarios que mandan de a un mensaje y con un usuario
+extra que antes manda una ráfaga de BENCH_RAFAGA updates seguidos (por defecto 200). Como los
+updates de un usuario se procesan en orden, la ráfaga solo debería demorar a ese usuario: la
+latencia reportada es la de los demás.
+
+Uso: python benchmarks/bench_webhook.py [usuarios] [mensajes_por_usuario] [latencia_api_ms] [concurrencias...]
+     Ejemplo: python benchmarks/bench_webhook.py 200 3 20 1 32
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'bench_webhook.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_FILE}'
+sys.path.insert(0, RAIZ)
+
+from db_models import Base, Usuario, engine, get_session
+from fake_bot_api import FakeBotAPI, puerto_libre, iniciar
+
+USUARIOS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+MENSAJES = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+LATENCIA_API = (float(sys.argv[3]) if len(sys.argv) > 3 else 20.0) / 1000
+CONCURRENCIAS = [int(c) for c in sys.argv[4:]] or [1, 32]
+RAFAGA = int(os.getenv('BENCH_RAFAGA', '200'))
+# Usuario sin cuenta que manda la ráfaga (/start le responde igual).
+TELEGRAM_ID_RAFAGA = 999
+TOKEN = '123456:FAKE'
+SECRET = 'bench-secret'
+
+
+def update_sintetico(update_id, telegram_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': '/start',
+            'chat': {'id': telegram_id, 'type': 'private'},
+            'from': {'id': telegram_id, 'is_bot': False, 'first_name': f'user{telegram_id}'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+def sembrar():
+    Base.metadata.create_all(engine)
+    with get_session() as session_db:
+        session_db.add_all([Usuario(username=f'user{i}', login_key='clave', telegram_id=1000 + i, saldo=10) for i in range(USUARIOS)])
+        session_db.commit()
+
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def medir(concurrencia, api_port, rafaga=0):
+    FakeBotAPI.reiniciar()
+    bot_port = puerto_libre()
+    env = dict(os.environ, BOT_MODO='webhook', BOT_CONCURRENCIA=str(concurrencia), TOKEN=TOKEN, PORT=str(bot_port),
+               WEBHOOK_URL=f'http://127.0.0.1:{bot_port}', WEBHOOK_SECRET=SECRET, TELEGRAM_API_URL=f'http://127.0.0.1:{api_port}/bot')
+    bot = subprocess.Popen([sys.executable, os.path.join(RAIZ, 'bot_main.py')], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not FakeBotAPI.webhook_listo.wait(30):
+            raise RuntimeError("El bot no registró el webhook.")
+        time.sleep(0.5)
+
+        envios = defaultdict(list)
+        url = f'http://127.0.0.1:{bot_port}/telegram'
+
+        def enviar(update_id, telegram_id):
+            req = urllib.request.Request(url, data=json.dumps(update_sintetico(update_id, telegram_id)).encode(),
+                                         headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': SECRET})
+            envios[telegram_id].append(time.perf_counter())
+            urllib.request.urlopen(req).read()
+
+        total = USUARIOS * MENSAJES + rafaga
+        inicio = time.perf_counter()
+        for n in range(rafaga):
+            enviar(total + n + 1, TELEGRAM_ID_RAFAGA)
+        # Ronda m: un mensaje de cada usuario, así los mensajes de un mismo usuario llegan en orden.
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            for m in range(MENSAJES):
+                list(pool.map(lambda i: enviar(m * USUARIOS + i + 1, 1000 + i), range(USUARIOS)))
+
+        limite = time.time() + 120
+        while sum(len(v) for v in FakeBotAPI.respuestas.values()) < total and time.time() < limite:
+            time.sleep(0.05)
+        fin = max(t for v in FakeBotAPI.respuestas.values() for t in v)
+    finally:
+        bot.terminate(); bot.wait(10)
+
+    latencias = [(r - e) * 1000 for chat, lista in envios.items() if chat != TELEGRAM_ID_RAFAGA for e, r in zip(lista, FakeBotAPI.respuestas[chat])]
+    recibidas = sum(len(v) for v in FakeBotAPI.respuestas.values())
+    escenario = f"ráfaga de {rafaga}" if rafaga else "sin ráfaga"
+    print(f"concurrencia={concurrencia:<4} {escenario:<16} {recibidas}/{total} respuestas | {total / (fin - inicio):,.0f} updates/s | "
+          f"p50={percentil(latencias, 50):.0f}ms p95={percentil(latencias, 95):.0f}ms p99={percentil(latencias, 99):.0f}ms")
+
+
+def main():
+    sembrar()
+    FakeBotAPI.latencia = LATENCIA_API
+    servidor, api_port = iniciar()
+    print(f"{USUARIOS} usuarios x {MENSAJES} mensajes, latencia simulada del Bot API: {LATENCIA_API * 1000:.0f}ms")
+    for concurrencia in CONCURRENCIAS:
+        medir(concurrencia, api_port)
+        medir(concurrencia, api_port, RAFAGA)
+    servidor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Verifica que las consultas calientes usen índices (EXPLAIN) tras aplicar las migraciones.
+
+Las consultas no se reescriben acá: se ejecutan las funciones reales de la app (login y sesión
+del bot, productos por categoría del catálogo, historial del ledger, reclamo de keys y listado
+de keys del panel, con y sin búsqueda por prefijo) sobre una base sembrada, se registra el SQL que emiten y se hace EXPLAIN de
+cada sentencia con sus mismos parámetros. Si una de esas funciones cambia su consulta, el
+chequeo analiza la consulta nueva.
+
+Corre contra SQLite por defecto; con BENCH_DATABASE_URL=postgresql://... usa PostgreSQL
+(con enable_seqscan=off, ya que con tablas pequeñas el planner prefiere un seq scan).
+
+Uso: python benchmarks/check_query_plans.py
+"""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'query_plans.db')
+os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL', f'sqlite:///{DB_FILE}')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import db_models
+import admin_panel
+import bot_main
+import catalogo
+from compras import reclamar_keys
+from db_models import Base, Usuario, Producto, Key, StockProducto, TIPO_COMPRA, configurar_engine, get_session, registrar_movimiento
+from migraciones import migrar
+
+TELEGRAM_ID = 123
+# Solo se analizan lecturas y escrituras sobre filas existentes (no INSERT ni BEGIN/COMMIT).
+SENTENCIAS_ANALIZADAS = ('SELECT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def sembrar():
+    Base.metadata.create_all(db_models.engine)
+    migrar(db_models.engine)
+    with get_session() as session_db:
+        usuario = Usuario(username='Juan', login_key='clave', telegram_id=TELEGRAM_ID, saldo=100)
+        producto = Producto(nombre='Producto', categoria='Categoria', precio=1.0)
+        session_db.add_all([usuario, producto])
+        session_db.flush()
+        session_db.add(StockProducto(producto_id=producto.id, disponibles=200, usadas=0))
+        session_db.add_all([Key(licencia=f'PLAN-{i:04d}', producto_id=producto.id, estado='available' if i % 2 else 'used') for i in range(400)])
+        for i in range(30):
+            registrar_movimiento(session_db, usuario.id, TIPO_COMPRA, -1.0, producto_id=producto.id, licencia=f'PLAN-{i:04d}', descripcion='Producto')
+        session_db.commit()
+        return usuario.id, producto.id
+
+
+@contextmanager
+def capturar():
+    """Registra (sql, parámetros) de cada sentencia analizable que se ejecute dentro del bloque."""
+    sentencias = []
+
+    def registrar(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().split(None, 1)[0].upper() in SENTENCIAS_ANALIZADAS:
+            sentencias.append((statement, parameters))
+
+    event.listen(Engine, 'before_cursor_execute', registrar)
+    try:
+        yield sentencias
+    finally:
+        event.remove(Engine, 'before_cursor_execute', registrar)
+
+
+def reclamo(usuario_id, producto_id):
+    with get_session() as session_db:
+        reclamar_keys(session_db, producto_id, usuario_id, 2)
+        session_db.rollback()
+
+
+def panel(ruta):
+    cliente = admin_panel.app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion['logged_in'] = True
+    respuesta = cliente.get(ruta)
+    assert respuesta.status_code == 200, respuesta.status_code
+
+
+def flujos(usuario_id, producto_id):
+    """{nombre: función sin argumentos que ejecuta el camino real de la app}."""
+    return {
+        'login (lower(username))': lambda: bot_main._buscar_credencial('juan'),
+        'usuario por telegram_id': lambda: bot_main._buscar_usuario(TELEGRAM_ID),
+        'productos por categoría (con stock)': lambda: catalogo._cargar_productos('Categoria'),
+        'historial del ledger': lambda: bot_main._historial(TELEGRAM_ID, TIPO_COMPRA, None),
+        'historial del ledger (página siguiente)': lambda: bot_main._historial(TELEGRAM_ID, TIPO_COMPRA, 10**9),
+        'reclamo de keys (UPDATE)': lambda: reclamo(usuario_id, producto_id),
+        'listado de keys del panel (keyset)': lambda: panel(f'/product/{producto_id}/keys?estado=used&despues=100'),
+        'búsqueda de licencia por prefijo (panel)': lambda: panel(f'/product/{producto_id}/keys?estado=available&q=PLAN-00'),
+        'búsqueda de username por prefijo (panel)': lambda: panel('/users?q=Ju'),
+    }
+
+
+def plan(conn, sql, parametros):
+    if db_models.engine.dialect.name == 'postgresql':
+        return '\n'.join(r[0] for r in conn.exec_driver_sql(f'EXPLAIN {sql}', parametros))
+    return '\n'.join(r[-1] for r in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}', parametros))
+
+
+def es_sondeo(sql, parametros):
+    """Sondeo de existencia (.first() sin orden): se corta en la primera fila que cumple el filtro."""
+    return sql.rstrip().endswith('LIMIT ? OFFSET ?') and 'ORDER BY' not in sql and tuple(parametros)[-2:] == (1, 0)
+
+
+def usa_indice(texto, sql, parametros):
+    if db_models.engine.dialect.name == 'postgresql':
+        return 'Index' in texto and 'Seq Scan' not in texto
+    # SQLite: "SEARCH ... USING (COVERING) INDEX" / "USING INTEGER PRIMARY KEY"; nunca "SCAN <tabla>" completo,
+    # salvo un sondeo de existencia que recorre un índice cubriente (p. ej. "¿hay usuarios además del admin?").
+    if es_sondeo(sql, parametros) and texto.startswith('SCAN') and 'COVERING INDEX' in texto:
+        return True
+    return 'USING' in texto and 'SCAN' not in texto.replace('USING', '')
+
+
+def main():
+    configurar_engine('script', os.environ['DATABASE_URL'])
+    usuario_id, producto_id = sembrar()
+    fallos = []
+    for nombre, flujo in flujos(usuario_id, producto_id).items():
+        with capturar() as sentencias:
+            flujo()
+        if not sentencias:
+            print(f"[FALLO] {nombre}: no ejecutó ninguna consulta"); fallos.append(nombre); continue
+        with db_models.engine.connect() as conn:
+            if db_models.engine.dialect.name == 'postgresql':
+                conn.exec_driver_sql('SET enable_seqscan = off')
+            for sql, parametros in sentencias:
+                texto = plan(conn, sql, parametros)
+                ok = usa_indice(texto, sql, parametros)
+                print(f"[{'OK' if ok else 'FALLO'}] {nombre}: {' '.join(sql.split())[:90]}\n        {' | '.join(texto.splitlines())}")
+                if not ok:
+                    fallos.append(nombre)
+    if fallos:
+        print(f"Consultas sin índice: {sorted(set(fallos))}"); sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
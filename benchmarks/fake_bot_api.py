@@ -0,0 +1,96 @@
+"""
+Bot API de Telegram falso para los benchmarks (sin red ni token real).
+
+Responde getMe/setWebhook/sendMessage/sendDocument y registra la hora de cada mensaje por
+chat. Opcionalmente simula latencia y respuestas 429 (flood control) con retry_after.
+El bot se apunta a él con TELEGRAM_API_URL=http://127.0.0.1:<puerto>/bot.
+"""
+import json
+import time
+import socket
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    """Bot API mínimo: registra la hora y el texto de cada sendMessage por chat."""
+    latencia = 0.0
+    # Cada cuántos sendMessage se responde 429 (0 = nunca) y con qué retry_after.
+    cada_429 = 0
+    retry_after = 1
+    respuestas = defaultdict(list)
+    textos = defaultdict(list)
+    webhook_listo = threading.Event()
+    lock = threading.Lock()
+    solicitudes = 0
+    rechazos_429 = 0
+
+    @classmethod
+    def reiniciar(cls):
+        with cls.lock:
+            cls.respuestas.clear()
+            cls.textos.clear()
+            cls.solicitudes = cls.rechazos_429 = 0
+        cls.webhook_listo.clear()
+
+    def log_message(self, *args):
+        pass
+
+    def _responder(self, cuerpo, estado=200):
+        cuerpo = json.dumps(cuerpo).encode()
+        self.send_response(estado)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def do_POST(self):
+        metodo = self.path.rsplit('/', 1)[-1]
+        cuerpo = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        tipo = self.headers.get('Content-Type') or ''
+        if 'json' in tipo:
+            datos = json.loads(cuerpo or b'{}')
+        elif 'multipart' in tipo:
+            datos = {'chat_id': cuerpo.split(b'name="chat_id"\r\n\r\n', 1)[1].split(b'\r\n', 1)[0].decode()}
+        else:
+            datos = {k: v[0] for k, v in parse_qs(cuerpo.decode()).items()}
+
+        if metodo == 'getMe':
+            resultado = {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        elif metodo in ('sendMessage', 'sendDocument'):
+            time.sleep(self.latencia)
+            chat_id = int(datos['chat_id'])
+            with self.lock:
+                FakeBotAPI.solicitudes += 1
+                flood = self.cada_429 and FakeBotAPI.solicitudes % self.cada_429 == 0
+                if flood:
+                    FakeBotAPI.rechazos_429 += 1
+                else:
+                    self.respuestas[chat_id].append(time.perf_counter())
+                    self.textos[chat_id].append(datos.get('text', ''))
+            if flood:
+                return self._responder({'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {self.retry_after}',
+                                        'parameters': {'retry_after': self.retry_after}}, 429)
+            resultado = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, 'text': datos.get('text', '')}
+        else:
+            if metodo == 'setWebhook':
+                self.webhook_listo.set()
+            resultado = True
+        self._responder({'ok': True, 'result': resultado})
+
+
+def iniciar():
+    """Levanta el Bot API falso en un hilo. Retorna (servidor, puerto)."""
+    puerto = puerto_libre()
+    servidor = ThreadingHTTPServer(('127.0.0.1', puerto), FakeBotAPI)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, puerto
@@ -0,0 +1,87 @@
+"""
+Stress test: cientos de compras paralelas del mismo producto, de una o varias keys cada una.
+
+Verifica que ninguna key se venda dos veces, que ninguna compra falle mientras
+quede stock, que las compras de N keys sean todo-o-nada y que el saldo
+descontado coincida con las keys entregadas.
+
+Uso: python benchmarks/stress_compras.py [compras] [stock] [keys_por_compra]
+     BENCH_DATABASE_URL=postgresql://... para correrlo contra PostgreSQL.
+"""
+import os
+import sys
+import time
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'stress_compras.db')
+os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL', f'sqlite:///{DB_FILE}')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot_main
+from db_models import Base, Usuario, Producto, Key, StockProducto, engine, get_session, leer_version_catalogo
+
+COMPRAS = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+STOCK = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+CANTIDAD = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+PRECIO = 1.0
+
+
+def sembrar():
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with get_session() as session_db:
+        producto = Producto(nombre='Stress', categoria='Bench', precio=PRECIO)
+        session_db.add(producto); session_db.flush()
+        session_db.add_all([Usuario(username=f'buyer{i}', login_key='clave', telegram_id=5000 + i, saldo=PRECIO * CANTIDAD) for i in range(COMPRAS)])
+        session_db.add_all([Key(licencia=f'STRESS-{i:06d}', producto_id=producto.id, estado='available') for i in range(STOCK)])
+        session_db.add(StockProducto(producto_id=producto.id, disponibles=STOCK, usadas=0))
+        session_db.commit()
+
+
+def comprar(i):
+    try:
+        return bot_main._procesar_compra(5000 + i, {PRODUCTO_ID: CANTIDAD}, VERSION)
+    except Exception as e:
+        return 'error', {'detalle': str(e)}
+
+
+def main():
+    global PRODUCTO_ID, VERSION
+    sembrar()
+    with get_session() as session_db:
+        PRODUCTO_ID = session_db.query(Producto.id).scalar()
+        VERSION = leer_version_catalogo(session_db)
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        resultados = list(pool.map(comprar, range(COMPRAS)))
+    duracion = time.perf_counter() - inicio
+
+    estados = Counter(estado for estado, _ in resultados)
+    vendidas = [licencia for estado, datos in resultados if estado == 'ok' for _, licencia in datos['licencias']]
+    duplicadas = [lic for lic, n in Counter(vendidas).items() if n > 1]
+
+    with get_session() as session_db:
+        usadas = session_db.query(Key).filter_by(estado='used').count()
+        saldo_total = sum(s for (s,) in session_db.query(Usuario.saldo).all())
+        stock = session_db.query(StockProducto).one()
+
+    print(f"{COMPRAS} compras paralelas de {CANTIDAD} keys sobre {STOCK} keys en {duracion:.2f}s: {dict(estados)}")
+    esperadas = min(COMPRAS, STOCK // CANTIDAD)
+    errores = []
+    if duplicadas: errores.append(f"keys vendidas más de una vez: {duplicadas[:5]}")
+    if estados['ok'] != esperadas: errores.append(f"se esperaban {esperadas} compras exitosas y hubo {estados['ok']}")
+    if estados['error']: errores.append(f"{estados['error']} compras fallaron con error")
+    if len(vendidas) != estados['ok'] * CANTIDAD: errores.append(f"{len(vendidas)} keys entregadas para {estados['ok']} compras de {CANTIDAD}")
+    if usadas != len(vendidas): errores.append(f"{usadas} keys marcadas como usadas para {len(vendidas)} entregadas")
+    if (stock.disponibles, stock.usadas) != (STOCK - usadas, usadas): errores.append(f"contadores de stock desalineados: {stock.disponibles}/{stock.usadas}")
+    if abs(saldo_total - (COMPRAS - estados['ok']) * PRECIO * CANTIDAD) > 1e-6: errores.append(f"saldo total inconsistente: {saldo_total}")
+
+    if errores:
+        print("FALLO:\n - " + "\n - ".join(errores)); sys.exit(1)
+    print("OK: sin keys duplicadas ni compras fallidas con stock disponible.")
+
+
+if __name__ == '__main__':
+    main()
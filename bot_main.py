@@ -1,10 +1,25 @@
 import os
+import time
+import asyncio
+import inspect
 import logging
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+from io import BytesIO
+from telegram import Update, InputFile, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
+from telegram.request import HTTPXRequest
+from telegram.helpers import escape_markdown
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, ConversationHandler
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy import func
-from db_models import Usuario, Producto, Key, get_session
+from db_models import Usuario, Producto, Movimiento, CatalogoVersion, SuscripcionStock, TIPO_COMPRA, TIPO_RECARGA, configurar_engine, get_session, run_db, registrar_movimiento, paginar_keyset
+from compras import debitar_saldo, reclamar_keys
+from catalogo import catalogo_cache
+from persistencia import PersistenciaDB
+from envios import cola_envios
+from difusiones import procesar_difusiones
+from analitica import procesar_ventas
+from credenciales import LimitadorIntentos, verificar_async
+from metricas import Contador, Histograma, Medidor, MedidorSolicitudes, servir_metricas
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,7 +27,116 @@ TOKEN = os.getenv('TOKEN', '8570947665:AAFUqtimxOzs-KPhqavl53N9RRxi21bb4RM')
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# --- Modo de Ejecución ---
+# BOT_MODO=polling (por defecto) o webhook. En webhook, Telegram envía los updates a WEBHOOK_URL/WEBHOOK_PATH.
+BOT_MODO = os.getenv('BOT_MODO', 'polling')
+BOT_CONCURRENCIA = int(os.getenv('BOT_CONCURRENCIA', '32'))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Solo para pruebas locales: URL base de un Bot API falso (ver benchmarks/bench_webhook.py).
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# Puerto del endpoint /metrics (Prometheus) del bot; sin definir no se levanta.
+METRICS_PORT = os.getenv('METRICS_PORT')
+
+# Límite que se le pasa a BaseUpdateProcessor (ver ProcesadorPorUsuario): el real es BOT_CONCURRENCIA.
+SIN_LIMITE_UPDATES = 2 ** 31 - 1
+
 LOGIN_KEY, BUY_CATEGORY, BUY_PRODUCT = range(3)
+# Fallos de login recientes por telegram_id y por username: pasado el límite se rechaza sin consultar la base.
+LIMITE_LOGIN = LimitadorIntentos()
+HISTORIAL_POR_PAGINA = 10
+# Compra por cantidad: botones del menú, tope por producto y cuántas keys caben en un mensaje (más van como .txt).
+CANTIDADES = (1, 5, 10, 25, 50)
+MAX_CANTIDAD_COMPRA = int(os.getenv('MAX_CANTIDAD_COMPRA', '100'))
+KEYS_POR_MENSAJE = 20
+
+# --- Métricas ---
+MEDIDOR_HANDLERS = MedidorSolicitudes('bot_handler', 'handler')
+ESPERA_LOCK = Histograma('bot_espera_lock_usuario_segundos', 'Espera por el lock de orden por usuario antes de procesar un update.')
+TELEGRAM_API = Histograma('bot_telegram_api_segundos', 'Duración de las llamadas al Bot API.', 'metodo')
+COMPRAS = Contador('bot_compras_total', 'Compras por resultado.', 'estado')
+KEYS_VENDIDAS = Contador('bot_keys_vendidas_total', 'Keys entregadas en compras.')
+ENTREGAS_FALLIDAS = Contador('bot_entregas_fallidas_total', 'Envíos de keys de compras confirmadas que fallaron, por intento.', 'intento')
+LOGINS = Contador('bot_logins_total', 'Intentos de login por resultado.', 'estado')
+Medidor('bot_cola_envios_pendientes', 'Mensajes en la cola de envíos.', cola_envios.pendientes)
+Medidor('bot_catalogo_cache_hits', 'Aciertos acumulados del caché del catálogo.', lambda: catalogo_cache.hits)
+Medidor('bot_catalogo_cache_misses', 'Fallos acumulados del caché del catálogo.', lambda: catalogo_cache.misses)
+
+class RequestMedido(HTTPXRequest):
+    """HTTPXRequest que mide cada llamada al Bot API por método."""
+
+    async def do_request(self, url, *args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return await super().do_request(url, *args, **kwargs)
+        finally:
+            TELEGRAM_API.observar(time.perf_counter() - inicio, url.rsplit('/', 1)[-1])
+
+def _medir_callback(callback):
+    nombre = getattr(callback, '__name__', type(callback).__name__)
+    async def medido(update, context):
+        with MEDIDOR_HANDLERS.medir(nombre):
+            resultado = callback(update, context)
+            return await resultado if inspect.isawaitable(resultado) else resultado
+    return medido
+
+def instrumentar_handlers(handlers, vistos=None):
+    """Envuelve el callback de cada handler (incluidos los de los ConversationHandler) para medirlo, una vez aunque se repita en varios estados."""
+    vistos = set() if vistos is None else vistos
+    for handler in handlers:
+        if id(handler) in vistos: continue
+        vistos.add(id(handler))
+        if isinstance(handler, ConversationHandler):
+            instrumentar_handlers(handler.entry_points + [h for hs in handler.states.values() for h in hs] + handler.fallbacks, vistos)
+        else:
+            handler.callback = _medir_callback(handler.callback)
+
+class ProcesadorPorUsuario(BaseUpdateProcessor):
+    """
+    Procesa hasta `max_concurrent_updates` updates a la vez, pero los de un mismo usuario
+    en orden de llegada, para que los estados de los ConversationHandler sean consistentes.
+
+    El semáforo de BaseUpdateProcessor se toma antes de do_process_update, así que un update
+    esperando el lock de su usuario ocuparía un lugar: se le pasa un límite que no se alcanza
+    y la concurrencia real se limita con un semáforo propio que se toma ya dentro del lock.
+    Así, un usuario que manda muchos updates seguidos solo ocupa un lugar a la vez.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(SIN_LIMITE_UPDATES)
+        self._cupos = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        clave = None
+        if isinstance(update, Update):
+            clave = update.effective_user.id if update.effective_user else (update.effective_chat.id if update.effective_chat else None)
+        if clave is None:
+            async with self._cupos:
+                await coroutine
+            return
+
+        lock, pendientes = self._locks.get(clave, (None, 0))
+        if lock is None: lock = asyncio.Lock()
+        self._locks[clave] = (lock, pendientes + 1)
+        inicio = time.perf_counter()
+        try:
+            async with lock:
+                ESPERA_LOCK.observar(time.perf_counter() - inicio)
+                async with self._cupos:
+                    await coroutine
+        finally:
+            lock, pendientes = self._locks[clave]
+            if pendientes <= 1: del self._locks[clave]
+            else: self._locks[clave] = (lock, pendientes - 1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 def get_keyboard_main(is_logged_in):
     """Genera el teclado principal (Diseño idéntico al solicitado)."""
@@ -27,12 +151,105 @@ def get_keyboard_main(is_logged_in):
         ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
 
+# --- Acceso a Datos (se ejecuta en el pool de hilos vía run_db) ---
+
+def _buscar_usuario(telegram_id):
+    """Retorna el usuario vinculado al telegram_id (o None)."""
+    with get_session() as session_db:
+        return session_db.query(Usuario).filter_by(telegram_id=telegram_id).first()
+
+def _buscar_credencial(username):
+    """Retorna (id, login_key) del usuario con ese username sin distinguir mayúsculas (o None)."""
+    with get_session() as session_db:
+        return session_db.query(Usuario.id, Usuario.login_key).filter(func.lower(Usuario.username) == func.lower(username)).first()
+
+def _vincular_telegram(usuario_id, telegram_id, nuevo_hash=None):
+    """Vincula el telegram_id tras un login correcto y, si corresponde, reemplaza la login_key por su hash."""
+    with get_session() as session_db:
+        valores = {Usuario.telegram_id: telegram_id}
+        if nuevo_hash:
+            valores[Usuario.login_key] = nuevo_hash
+        session_db.query(Usuario).filter_by(id=usuario_id).update(valores, synchronize_session=False)
+        session_db.commit()
+
+def _cerrar_sesion(telegram_id):
+    """Desvincula el telegram_id del usuario."""
+    with get_session() as session_db:
+        usuario = session_db.query(Usuario).filter_by(telegram_id=telegram_id).first()
+        if usuario:
+            usuario.telegram_id = None
+            session_db.commit()
+
+def _procesar_compra(telegram_id, items, version_catalogo):
+    """
+    Compra {producto_id: cantidad} en una sola transacción, con un único débito de saldo y todo-o-nada:
+    si algún producto no tiene keys suficientes no se vende ninguna. Retorna (estado, datos): 'ok',
+    'saldo_insuficiente', 'agotado' o 'catalogo_cambiado' si el catálogo cambió desde que se mostraron
+    los botones (precios posiblemente viejos).
+    """
+    with get_session() as session_db:
+        try:
+            usuario = session_db.query(Usuario).filter_by(telegram_id=telegram_id).first()
+            # Productos por PK y versión actual del catálogo en un solo round-trip.
+            filas = session_db.query(Producto, CatalogoVersion.version).outerjoin(CatalogoVersion, CatalogoVersion.id == 1).filter(Producto.id.in_(list(items))).all()
+
+            if not usuario or len(filas) != len(items): raise Exception("User or Product not found.")
+            productos = {producto.id: producto for producto, _ in filas}
+            version_actual = filas[0][1]
+            if (version_actual or 0) != version_catalogo: return 'catalogo_cambiado', {'categoria': filas[0][0].categoria}
+            total = sum(productos[producto_id].precio * cantidad for producto_id, cantidad in items.items())
+
+            if not debitar_saldo(session_db, usuario.id, total):
+                session_db.rollback(); return 'saldo_insuficiente', {'saldo': usuario.saldo, 'total': total}
+
+            licencias = []
+            # Orden fijo por id para que dos carritos con los mismos productos no se bloqueen mutuamente.
+            for producto_id in sorted(items):
+                producto = productos[producto_id]
+                reclamadas = reclamar_keys(session_db, producto_id, usuario.id, items[producto_id])
+                if len(reclamadas) < items[producto_id]: session_db.rollback(); return 'agotado', {'producto': producto.nombre}
+                for licencia in reclamadas:
+                    registrar_movimiento(session_db, usuario.id, TIPO_COMPRA, -producto.precio, producto_id=producto_id, licencia=licencia, descripcion=producto.nombre)
+                licencias.extend((producto.nombre, licencia) for licencia in reclamadas)
+
+            session_db.commit()
+            session_db.refresh(usuario)
+            return 'ok', {'licencias': licencias, 'saldo': usuario.saldo, 'total': total}
+        except Exception:
+            session_db.rollback()
+            raise
+
+def _suscribir_stock(telegram_id, producto_id):
+    """Suscribe al usuario al aviso de reposición del producto. Retorna 'ok', 'ya_suscrito' o 'sin_sesion'."""
+    with get_session() as session_db:
+        usuario_id = session_db.query(Usuario.id).filter_by(telegram_id=telegram_id).scalar()
+        if not usuario_id: return 'sin_sesion'
+        try:
+            session_db.add(SuscripcionStock(usuario_id=usuario_id, producto_id=producto_id))
+            session_db.commit()
+            return 'ok'
+        except IntegrityError:
+            session_db.rollback()
+            return 'ya_suscrito'
+
+def _resumen_carrito(items):
+    """Retorna ([(producto_id, nombre, precio, cantidad)], versión del catálogo) para mostrar el carrito."""
+    with get_session() as session_db:
+        filas = session_db.query(Producto.id, Producto.nombre, Producto.precio, CatalogoVersion.version).outerjoin(CatalogoVersion, CatalogoVersion.id == 1).filter(Producto.id.in_(list(items))).order_by(Producto.id).all()
+        return [(pid, nombre, precio, items[pid]) for pid, nombre, precio, _ in filas], (filas[0][3] or 0) if filas else 0
+
+def _historial(telegram_id, tipo, despues):
+    """Retorna (movimientos, siguiente_cursor) del usuario, o None si no hay sesión. O(página) vía índice."""
+    with get_session() as session_db:
+        usuario = session_db.query(Usuario).filter_by(telegram_id=telegram_id).first()
+        if not usuario: return None
+        query = session_db.query(Movimiento).filter(Movimiento.usuario_id == usuario.id, Movimiento.tipo == tipo)
+        return paginar_keyset(query, Movimiento.id, despues, HISTORIAL_POR_PAGINA, descendente=True)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Muestra el mensaje de bienvenida y menú (IDÉNTICO AL DISEÑO)."""
     user_id_telegram = update.effective_user.id
-    
-    with get_session() as session_db:
-        usuario = session_db.query(Usuario).filter_by(telegram_id=user_id_telegram).first() 
+    usuario = await run_db(_buscar_usuario, user_id_telegram)
 
     is_logged = usuario is not None
 
@@ -69,8 +286,7 @@ async def handle_login_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return ConversationHandler.END
 
     parts = text.split()
-    
-    session_db = get_session()
+
     try:
         # CORRECCIÓN DE FORMATO (Si el usuario solo pone una palabra)
         if len(parts) != 2:
@@ -79,47 +295,44 @@ async def handle_login_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
         username, login_key_input = parts
         user_id_telegram = update.effective_user.id
-        
-        # BÚSQUEDA ROBUSTA Y CASO-INSENSITIVA (SOLUCIÓN FINAL DE LOGIN)
-        usuario = session_db.query(Usuario).filter(
-            func.lower(Usuario.username) == func.lower(username), 
-            Usuario.login_key == login_key_input
-        ).first()
+        claves = (('telegram', user_id_telegram), ('username', username.lower()))
 
-        if usuario:
-            usuario.telegram_id = user_id_telegram 
-            session_db.commit()
+        espera = LIMITE_LOGIN.espera(*claves)
+        if espera:
+            LOGINS.inc('bloqueado')
+            await update.message.reply_text(f"⏳ Demasiados intentos fallidos. Intenta de nuevo en {int(espera // 60) + 1} minuto(s).")
+            return LOGIN_KEY
 
+        credencial = await run_db(_buscar_credencial, username)
+        correcta, nuevo_hash = await verificar_async(login_key_input, credencial.login_key if credencial else None)
+        if correcta:
+            await run_db(_vincular_telegram, credencial.id, user_id_telegram, nuevo_hash)
+            LIMITE_LOGIN.exito(*claves)
+            LOGINS.inc('ok')
             await update.message.reply_text("✅ ¡Has sido autorizado exitosamente!", reply_markup=get_keyboard_main(True))
             return ConversationHandler.END
         else:
+            LIMITE_LOGIN.fallo(*claves)
+            LOGINS.inc('fallido')
             await update.message.reply_text(
                 "Login failed. Invalid Login Key. Please try again or type /start to go to the main menu."
             )
             return LOGIN_KEY
     except Exception as e:
         logger.error(f"Error en handle_login_key: {e}")
-        session_db.rollback()
         await update.message.reply_text("Ha ocurrido un error inesperado. Intenta de nuevo o usa /start.")
         return ConversationHandler.END
-    finally:
-        session_db.close()
 
 # --- Rutas de Compra (Se mantienen) ---
 
 async def logout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id_telegram = update.effective_user.id
-    with get_session() as session_db:
-        usuario = session_db.query(Usuario).filter_by(telegram_id=user_id_telegram).first()
-        if usuario:
-            usuario.telegram_id = None
-            session_db.commit()
+    await run_db(_cerrar_sesion, user_id_telegram)
     await update.message.reply_text("Sesión cerrada.", reply_markup=get_keyboard_main(False))
 
 async def show_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id_telegram = update.effective_user.id
-    with get_session() as session_db:
-        usuario = session_db.query(Usuario).filter_by(telegram_id=user_id_telegram).first()
+    usuario = await run_db(_buscar_usuario, user_id_telegram)
     if usuario:
         account_message = (f"👤 **Tu Cuenta**:\n" f"• Login: `{usuario.username}`\n" f"• Saldo: `${usuario.saldo:.2f}`\n")
         keyboard = [[InlineKeyboardButton("💰 Canjear código promocional", callback_data="redeem"), InlineKeyboardButton("📜 Historial de Compras", callback_data="history")], [InlineKeyboardButton("⬆️ Historial de Recargas", callback_data="topup_history")]]
@@ -127,83 +340,252 @@ async def show_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     else:
         await update.message.reply_text("Por favor, inicia sesión primero.", reply_markup=get_keyboard_main(False))
 
+async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Historial de compras/recargas paginado desde el ledger (callback_data: 'history[:cursor]' o 'topup_history[:cursor]')."""
+    query = update.callback_query
+    await query.answer()
+    accion, _, cursor = query.data.partition(':')
+    tipo = TIPO_COMPRA if accion == 'history' else TIPO_RECARGA
+
+    resultado = await run_db(_historial, update.effective_user.id, tipo, int(cursor) if cursor else None)
+    if resultado is None: await query.message.reply_text("Por favor, inicia sesión primero.", reply_markup=get_keyboard_main(False)); return
+    movimientos, siguiente = resultado
+
+    # MarkdownV2: descripciones (nombres de producto, "Ajuste de <admin>") y licencias van escapadas.
+    md = lambda texto: escape_markdown(texto, version=2)
+    titulo = "📜 *Historial de Compras*" if tipo == TIPO_COMPRA else "⬆️ *Historial de Recargas*"
+    if tipo == TIPO_COMPRA:
+        lineas = [f"• {md(f'{m.fecha:%d/%m/%Y %H:%M} — {m.descripcion} — ')}`{escape_markdown(m.licencia or '', version=2, entity_type='code')}` {md(f'(${-m.monto:.2f})')}" for m in movimientos]
+    else:
+        lineas = [md(f"• {m.fecha:%d/%m/%Y %H:%M} — {'+' if m.monto >= 0 else '-'}${abs(m.monto):.2f} ({m.descripcion or 'Recarga'})") for m in movimientos]
+    texto = titulo + "\n\n" + ("\n".join(lineas) if lineas else md("Sin movimientos."))
+
+    keyboard = [[InlineKeyboardButton("Más antiguos »", callback_data=f"{accion}:{siguiente}")]] if siguiente else []
+    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+    if cursor: await query.edit_message_text(texto, parse_mode='MarkdownV2', reply_markup=reply_markup)
+    else: await query.message.reply_text(texto, parse_mode='MarkdownV2', reply_markup=reply_markup)
+
 async def show_buy_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     telegram_id = update.effective_user.id
-    db_session = get_session()
-    try:
-        usuario = db_session.query(Usuario).filter_by(telegram_id=telegram_id).first()
-        if not usuario: return await update.message.reply_text("❌ Debes iniciar sesión para comprar."), ConversationHandler.END
+    usuario = await run_db(_buscar_usuario, telegram_id)
+    if not usuario: return await update.message.reply_text("❌ Debes iniciar sesión para comprar."), ConversationHandler.END
+
+    categories = await catalogo_cache.categorias()
+
+    if not categories: await update.message.reply_text("No hay keys disponibles en stock. Intenta más tarde.", reply_markup=get_keyboard_main(True)); return ConversationHandler.END
 
-        categories = db_session.query(Producto.categoria).join(Key, Producto.id == Key.producto_id).filter(Key.estado == 'available').distinct().all()
+    keyboard = [[KeyboardButton(c)] for c in categories]; keyboard.append([KeyboardButton("❌ Cancelar Compra")]); context.user_data['user_id'] = usuario.id
+    await update.message.reply_text("Selecciona una categoría:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    return BUY_CATEGORY
 
-        if not categories: await update.message.reply_text("No hay keys disponibles en stock. Intenta más tarde.", reply_markup=get_keyboard_main(True)); return ConversationHandler.END
+async def _enviar_productos(message, category):
+    """
+    Envía los productos de la categoría como botones inline: 'buy:<producto_id>:<versión del catálogo>'
+    para los que tienen stock y 'sub:<producto_id>' (avisarme cuando haya stock) para los agotados.
+    """
+    productos, version = await catalogo_cache.productos(category)
+    if not productos: return False
 
-        keyboard = [[KeyboardButton(c[0])] for c in categories]; keyboard.append([KeyboardButton("❌ Cancelar Compra")]); context.user_data['user_id'] = usuario.id
-        await update.message.reply_text("Selecciona una categoría:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-        return BUY_CATEGORY
-    finally: db_session.close()
+    keyboard_buttons = []
+    for producto_id, nombre, precio, stock in productos:
+        if stock > 0: keyboard_buttons.append([InlineKeyboardButton(f"{nombre} - ${precio:.2f} (Stock: {stock})", callback_data=f"buy:{producto_id}:{version}")])
+        else: keyboard_buttons.append([InlineKeyboardButton(f"🔔 {nombre} (Agotado) - Avisarme", callback_data=f"sub:{producto_id}")])
+
+    await message.reply_text(f"Productos en **{category}**:", parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard_buttons))
+    return True
 
 async def handle_category_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     category = update.message.text
     if category == "❌ Cancelar Compra": return await start(update, context)
     if category == "« Volver a Categorías": return await show_buy_menu(update, context)
 
-    db_session = get_session()
+    if not await _enviar_productos(update.message, category): await update.message.reply_text(f"❌ No se encontraron productos en la categoría: **{category}**", parse_mode='Markdown'); return BUY_CATEGORY
+    return BUY_PRODUCT
+
+def _carrito(context):
+    """Carrito del usuario en user_data (persistido): {str(producto_id): cantidad}."""
+    return context.user_data.setdefault('carrito', {})
+
+def _texto_entrega(datos, markdown):
+    """Mensaje con las keys compradas: en MarkdownV2 (nombres y licencias escapados) o en texto plano."""
+    licencias = datos['licencias']
+    md = (lambda texto: escape_markdown(texto, version=2)) if markdown else (lambda texto: texto)
+    codigo = (lambda texto: f"`{escape_markdown(texto, version=2, entity_type='code')}`") if markdown else (lambda texto: texto)
+    resumen = md(f"💸 Total: ${datos['total']:.2f}\n💰 Nuevo Saldo: ${datos['saldo']:.2f}")
+    titulo = md("🔐 Tu Key/Licencia:" if len(licencias) == 1 else f"🔐 Tus {len(licencias)} Keys/Licencias:")
+    lineas = "\n".join(f"• {md(nombre)}: {codigo(licencia)}" for nombre, licencia in licencias)
+    encabezado = "🎉 *COMPRA EXITOSA\\!*" if markdown else "🎉 COMPRA EXITOSA!"
+    return f"{encabezado}\n\n{titulo}\n{lineas}\n\n{resumen}"
+
+async def _entregar_licencias(message, datos):
+    """Envía las keys compradas en un solo mensaje, o como archivo .txt si son demasiadas para un mensaje."""
+    licencias = datos['licencias']
+    if len(licencias) <= KEYS_POR_MENSAJE:
+        await message.reply_text(_texto_entrega(datos, markdown=True), parse_mode='MarkdownV2', reply_markup=get_keyboard_main(True))
+    else:
+        resumen = f"💸 Total: ${datos['total']:.2f}\n💰 Nuevo Saldo: ${datos['saldo']:.2f}"
+        contenido = "\n".join(f"{nombre}\t{licencia}" for nombre, licencia in licencias).encode()
+        await message.reply_document(InputFile(BytesIO(contenido), filename=f"keys_{len(licencias)}.txt"), caption=f"🎉 COMPRA EXITOSA! {len(licencias)} keys adjuntas.\n\n{resumen}", reply_markup=get_keyboard_main(True))
+
+async def _entregar_con_respaldo(message, datos, telegram_id):
+    """
+    Entrega las keys de una compra ya confirmada. Si el envío falla se reintenta en texto plano:
+    el cargo ya está hecho, así que un error acá es un fallo de entrega, nunca una compra fallida.
+    """
     try:
-        productos_con_stock = db_session.query(Producto, func.count(Key.id).label('available_stock')).join(Key, Producto.id == Key.producto_id).filter(Producto.categoria == category, Key.estado == 'available').group_by(Producto.id).all()
-
-        if not productos_con_stock: await update.message.reply_text(f"❌ No se encontraron productos en la categoría: **{category}**", parse_mode='Markdown'); return BUY_CATEGORY
-
-        keyboard_buttons = []
-        for producto, stock in productos_con_stock:
-            button_text = f"{producto.nombre} - ${producto.precio:.2f} (Stock: {stock})"
-            keyboard_buttons.append([KeyboardButton(button_text)])
-
-        keyboard_buttons.append([KeyboardButton("« Volver a Categorías")])
-        await update.message.reply_text(f"Productos en **{category}**:", parse_mode='Markdown', reply_markup=ReplyKeyboardMarkup(keyboard_buttons, resize_keyboard=True))
-        return BUY_PRODUCT
-    finally: db_session.close()
-
-async def handle_final_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = update.message.text
-    user_id_telegram = update.effective_user.id
-    if text == "« Volver a Categorías": return await show_buy_menu(update, context)
+        await _entregar_licencias(message, datos)
+        return
+    except Exception as e:
+        ENTREGAS_FALLIDAS.inc('formato')
+        logger.warning(f"Fallo al entregar keys a {telegram_id}, reintentando en texto plano: {e}")
+    try:
+        await message.reply_text(_texto_entrega(datos, markdown=False), reply_markup=get_keyboard_main(True))
+    except Exception as e:
+        ENTREGAS_FALLIDAS.inc('texto_plano')
+        logger.error(f"No se pudieron entregar las keys de una compra confirmada a {telegram_id} ({len(datos['licencias'])} keys): {e}")
 
-    session_db = get_session()
+async def _comprar(update, items, version):
+    """Ejecuta la compra de {producto_id: cantidad} y responde. Retorna el estado de _procesar_compra (o None si falló)."""
+    query = update.callback_query
     try:
-        parts = text.rsplit(' - $', 1); product_name = parts[0].strip()
-        price = float(parts[1].split('(')[0].strip().replace('$', '').replace(',', '.'))
-        
-        usuario = session_db.query(Usuario).filter_by(telegram_id=user_id_telegram).first()
-        producto = session_db.query(Producto).filter_by(nombre=product_name).first()
+        estado, datos = await run_db(_procesar_compra, update.effective_user.id, items, version)
+    except Exception as e:
+        COMPRAS.inc('error')
+        logger.error(f"Error CRÍTICO en la transacción: {e}")
+        await update.effective_message.reply_text("Error procesando la compra.", reply_markup=get_keyboard_main(True))
+        return None, None
+
+    COMPRAS.inc(estado)
+    if estado == 'ok': KEYS_VENDIDAS.inc(n=len(datos['licencias']))
+    if estado == 'catalogo_cambiado': catalogo_cache.invalidar(); return estado, datos
+    if estado == 'agotado': catalogo_cache.invalidar()
+
+    # Se quitan los botones para evitar compras duplicadas por doble toque.
+    try: await query.edit_message_reply_markup(reply_markup=None)
+    except Exception as e: logger.warning(f"No se pudieron quitar los botones de compra: {e}")
+
+    if estado == 'saldo_insuficiente': await query.message.reply_text(f"❌ Saldo insuficiente. El total es ${datos['total']:.2f} y tu saldo es: ${datos['saldo']:.2f}", reply_markup=get_keyboard_main(True))
+    elif estado == 'agotado': await query.message.reply_text(f"❌ No hay claves suficientes de {datos['producto']}. No se realizó ningún cargo.", reply_markup=get_keyboard_main(True))
+    else: await _entregar_con_respaldo(query.message, datos, update.effective_user.id)
+    return estado, datos
+
+async def handle_stock_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Aviso de reposición de un producto agotado (callback_data 'sub:<producto_id>')."""
+    query = update.callback_query
+    estado = await run_db(_suscribir_stock, update.effective_user.id, int(query.data.split(':')[1]))
+    if estado == 'sin_sesion': await query.answer("❌ Debes iniciar sesión primero.", show_alert=True)
+    elif estado == 'ya_suscrito': await query.answer("🔔 Ya estás suscrito: te avisaremos cuando haya stock.")
+    else: await query.answer("🔔 Listo: te avisaremos cuando vuelva a haber stock.")
+
+async def show_quantity_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Menú de cantidad de un producto (callback_data 'buy:<producto_id>:<versión>'): comprar ya o sumar al carrito."""
+    query = update.callback_query
+    await query.answer()
+    _, producto_id, version = query.data.split(':')
+
+    # El nombre y precio se toman del mismo botón tocado, sin consultar la base.
+    boton = next((b.text for fila in query.message.reply_markup.inline_keyboard for b in fila if b.callback_data == query.data), None) if query.message.reply_markup else None
+    cantidades = [n for n in CANTIDADES if n <= MAX_CANTIDAD_COMPRA]
+    keyboard = [[InlineKeyboardButton(f"Comprar {n}", callback_data=f"qty:{producto_id}:{version}:{n}") for n in cantidades[i:i + 3]] for i in range(0, len(cantidades), 3)]
+    keyboard += [[InlineKeyboardButton(f"🛒 +{n}", callback_data=f"cart:{producto_id}:{n}") for n in cantidades[i:i + 3]] for i in range(0, len(cantidades), 3)]
+    keyboard.append([InlineKeyboardButton("🛒 Ver Carrito", callback_data="carrito")])
+    await query.message.reply_text(f"¿Cuántas keys de *{escape_markdown(boton or 'este producto', version=2)}*?", parse_mode='MarkdownV2', reply_markup=InlineKeyboardMarkup(keyboard))
+    return BUY_PRODUCT
 
-        if not usuario or not producto: raise Exception("User or Product not found.")
+async def handle_final_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Compra directa de N keys de un producto (callback_data 'qty:<producto_id>:<versión>:<cantidad>')."""
+    query = update.callback_query
+    await query.answer()
+    _, producto_id, version, cantidad = query.data.split(':')
+    cantidad = max(1, min(int(cantidad), MAX_CANTIDAD_COMPRA))
+
+    estado, datos = await _comprar(update, {int(producto_id): cantidad}, int(version))
+    if estado == 'catalogo_cambiado':
+        await query.message.reply_text("⚠️ El catálogo se actualizó (precios o stock). Revisa la lista actualizada:")
+        if not await _enviar_productos(query.message, datos['categoria']): await query.message.reply_text("❌ Ya no hay productos disponibles en esta categoría.", reply_markup=get_keyboard_main(True)); return ConversationHandler.END
+        return BUY_PRODUCT
+    return ConversationHandler.END
 
-        if usuario.saldo < price: await update.message.reply_text(f"❌ Saldo insuficiente. Tu saldo es: ${usuario.saldo:.2f}", reply_markup=get_keyboard_main(True)); return ConversationHandler.END
+async def handle_add_to_cart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Suma N keys de un producto al carrito (callback_data 'cart:<producto_id>:<cantidad>')."""
+    query = update.callback_query
+    _, producto_id, cantidad = query.data.split(':')
+    carrito = _carrito(context)
+    carrito[producto_id] = min(carrito.get(producto_id, 0) + int(cantidad), MAX_CANTIDAD_COMPRA)
+    await query.answer(f"🛒 Agregado. En el carrito: {carrito[producto_id]} de este producto ({sum(carrito.values())} keys en total).")
+    return BUY_PRODUCT
+
+async def _enviar_carrito(message, context):
+    """Envía el resumen del carrito con precios actuales y el botón 'pagar:<versión>'. Retorna False si está vacío."""
+    carrito = _carrito(context)
+    if not carrito: return False
+    lineas, version = await run_db(_resumen_carrito, {int(pid): cantidad for pid, cantidad in carrito.items()})
+    # Se descartan productos borrados del catálogo desde que se agregaron.
+    context.user_data['carrito'] = carrito = {str(pid): cantidad for pid, _, _, cantidad in lineas}
+    if not carrito: return False
+
+    total = sum(precio * cantidad for _, _, precio, cantidad in lineas)
+    detalle = "\n".join(f"• {cantidad} x {nombre} (${precio:.2f}) = ${precio * cantidad:.2f}" for _, nombre, precio, cantidad in lineas)
+    keyboard = [[InlineKeyboardButton(f"✅ Pagar ${total:.2f}", callback_data=f"pagar:{version}")], [InlineKeyboardButton("🗑 Vaciar Carrito", callback_data="vaciar")]]
+    await message.reply_text(f"🛒 *Tu Carrito*\n\n{escape_markdown(detalle, version=2)}\n\n{escape_markdown(f'💸 Total: ${total:.2f}', version=2)}", parse_mode='MarkdownV2', reply_markup=InlineKeyboardMarkup(keyboard))
+    return True
+
+async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    if not await _enviar_carrito(query.message, context): await query.message.reply_text("🛒 Tu carrito está vacío.")
+    return BUY_PRODUCT
+
+async def handle_cart_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Paga todo el carrito en una transacción (callback_data 'pagar:<versión>')."""
+    query = update.callback_query
+    await query.answer()
+    carrito = _carrito(context)
+    if not carrito: await query.edit_message_reply_markup(reply_markup=None); await query.message.reply_text("🛒 Tu carrito está vacío."); return BUY_PRODUCT
+
+    estado, _ = await _comprar(update, {int(pid): cantidad for pid, cantidad in carrito.items()}, int(query.data.split(':')[1]))
+    if estado == 'catalogo_cambiado':
+        await query.message.reply_text("⚠️ El catálogo se actualizó (precios o stock). Revisa tu carrito actualizado:")
+        if not await _enviar_carrito(query.message, context): await query.message.reply_text("🛒 Tu carrito está vacío.")
+        return BUY_PRODUCT
+    if estado == 'ok': carrito.clear(); return ConversationHandler.END
+    # Saldo insuficiente o agotado: el carrito se conserva y sus botones siguen activos.
+    return BUY_PRODUCT
 
-        available_key = session_db.query(Key).filter_by(producto_id=producto.id, estado='available').with_for_update(nowait=True).first() 
+async def handle_empty_cart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    _carrito(context).clear()
+    await query.edit_message_text("🗑 Carrito vaciado.")
+    return BUY_PRODUCT
 
-        if not available_key: await update.message.reply_text(f"❌ Producto agotado. No hay claves disponibles para {producto.nombre}.", reply_markup=get_keyboard_main(True)); return ConversationHandler.END
 
-        usuario.saldo -= price; available_key.estado = 'used'; available_key.usuario_id = usuario.id; session_db.commit()
-        
-        final_message = (f"🎉 **COMPRA EXITOSA!**\n\n🔐 Tu Key/Licencia: `{available_key.licencia}`\n💰 Nuevo Saldo: ${usuario.saldo:.2f}")
-        await update.message.reply_text(final_message, parse_mode='Markdown', reply_markup=get_keyboard_main(True))
-        return ConversationHandler.END
+# Tareas de fondo del bot (difusiones, ventas), canceladas al detener la Application.
+_tareas_fondo = []
 
-    except Exception as e:
-        session_db.rollback(); logger.error(f"Error CRÍTICO en la transacción: {e}")
-        await update.message.reply_text("Error procesando la compra.", reply_markup=get_keyboard_main(True))
-        return ConversationHandler.END
-    finally: session_db.close()
+async def _iniciar_tareas(application: Application) -> None:
+    """Arranca la cola de envíos, la tarea que procesa las difusiones del panel y la que acumula las ventas del dashboard."""
+    cola_envios.iniciar(application.bot)
+    _tareas_fondo.append(asyncio.create_task(procesar_difusiones(cola_envios)))
+    _tareas_fondo.append(asyncio.create_task(procesar_ventas()))
 
+async def _detener_tareas(application: Application) -> None:
+    for tarea in _tareas_fondo: tarea.cancel()
+    await asyncio.gather(*_tareas_fondo, return_exceptions=True)
+    await cola_envios.detener()
 
 def main() -> None:
-    application = Application.builder().token(TOKEN).build()
+    configurar_engine('bot')
+    builder = Application.builder().token(TOKEN).concurrent_updates(ProcesadorPorUsuario(BOT_CONCURRENCIA)).persistence(PersistenciaDB()).request(RequestMedido(connection_pool_size=256)).post_init(_iniciar_tareas).post_shutdown(_detener_tareas)
+    if TELEGRAM_API_URL: builder = builder.base_url(TELEGRAM_API_URL)
+    application = builder.build()
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.Regex("^👤 Mi Cuenta$"), show_account))
     application.add_handler(MessageHandler(filters.Regex("^🚀 Cerrar Sesión$"), logout_handler))
+    application.add_handler(CallbackQueryHandler(show_history, pattern=r"^(history|topup_history)(:\d+)?$"))
+    # Fuera de la conversación de compra: el botón de aviso sirve también en listas viejas.
+    application.add_handler(CallbackQueryHandler(handle_stock_subscription, pattern=r"^sub:\d+$"))
     application.add_handler(MessageHandler(filters.Regex("^➕ Registrarse$"), lambda u, c: u.message.reply_text("Para crear una cuenta, contacta a un administrador.", reply_markup=get_keyboard_main(False))))
     
     login_conv_handler = ConversationHandler(
@@ -212,21 +594,47 @@ def main() -> None:
             LOGIN_KEY: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_login_key)]
         },
         fallbacks=[CommandHandler("start", start), MessageHandler(filters.Regex("^❌ Cancelar$"), lambda u, c: start(u,c))],
+        name="login", persistent=True,
     )
     application.add_handler(login_conv_handler)
     
+    # Botones inline de compra. También son entry points y valen en BUY_CATEGORY: los mensajes con
+    # botones (y el carrito guardado en user_data) siguen en el chat después de terminar o cambiar de paso.
+    botones_compra = [
+        CallbackQueryHandler(show_quantity_menu, pattern=r"^buy:\d+:\d+$"),
+        CallbackQueryHandler(handle_final_purchase, pattern=r"^qty:\d+:\d+:\d+$"),
+        CallbackQueryHandler(handle_add_to_cart, pattern=r"^cart:\d+:\d+$"),
+        CallbackQueryHandler(show_cart, pattern=r"^carrito$"),
+        CallbackQueryHandler(handle_cart_checkout, pattern=r"^pagar:\d+$"),
+        CallbackQueryHandler(handle_empty_cart, pattern=r"^vaciar$"),
+    ]
     buy_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^🛒 Comprar Keys$"), show_buy_menu)],
+        entry_points=[MessageHandler(filters.Regex("^🛒 Comprar Keys$"), show_buy_menu)] + botones_compra,
         states={
-            BUY_CATEGORY: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_category_selection)],
-            BUY_PRODUCT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_final_purchase)],
+            BUY_CATEGORY: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_category_selection)] + botones_compra,
+            BUY_PRODUCT: botones_compra + [
+                # El teclado de categorías sigue visible: elegir otra categoría vuelve a listar productos.
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_category_selection),
+            ],
         },
         fallbacks=[CommandHandler("start", start), MessageHandler(filters.Regex("^❌ Cancelar Compra$"), lambda u, c: start(u,c))],
-        per_user=True,
+        per_user=True, name="compra", persistent=True,
     )
     application.add_handler(buy_conv_handler)
+
+    for handlers in application.handlers.values(): instrumentar_handlers(handlers)
+    if METRICS_PORT: servir_metricas(int(METRICS_PORT)); logger.info(f"Métricas en http://0.0.0.0:{METRICS_PORT}/metrics")
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODO == 'webhook':
+        if not WEBHOOK_URL: raise RuntimeError("BOT_MODO=webhook requiere WEBHOOK_URL.")
+        logger.info(f"Iniciando en modo webhook en el puerto {WEBHOOK_PORT} (concurrencia: {BOT_CONCURRENCIA}).")
+        application.run_webhook(
+            listen='0.0.0.0', port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+            max_connections=min(BOT_CONCURRENCIA, 100), allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
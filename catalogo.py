@@ -0,0 +1,110 @@
+import os
+import time
+import logging
+from sqlalchemy import func
+from db_models import Producto, StockProducto, get_session, run_db, leer_version_catalogo
+
+logger = logging.getLogger(__name__)
+
+# Segundos que una entrada del catálogo se considera válida.
+CATALOGO_TTL = float(os.getenv('CATALOGO_TTL', '30'))
+# Cada cuántos segundos se consulta la fila catalogo_version para detectar cambios del panel.
+CATALOGO_VERSION_INTERVALO = float(os.getenv('CATALOGO_VERSION_INTERVALO', '2'))
+
+# --- Consultas (se ejecutan en el pool de hilos vía run_db) ---
+
+def _cargar_categorias():
+    """Retorna todas las categorías del catálogo (también las agotadas, para poder suscribirse a sus productos)."""
+    with get_session() as session_db:
+        categorias = session_db.query(Producto.categoria).distinct().order_by(Producto.categoria).all()
+        return [c[0] for c in categorias]
+
+def _cargar_productos(categoria):
+    """Retorna [(id, nombre, precio, stock)] de los productos de la categoría, primero los que tienen stock."""
+    with get_session() as session_db:
+        disponibles = func.coalesce(StockProducto.disponibles, 0)
+        productos = session_db.query(Producto.id, Producto.nombre, Producto.precio, disponibles).outerjoin(StockProducto, Producto.id == StockProducto.producto_id).filter(Producto.categoria == categoria).order_by((disponibles > 0).desc(), Producto.id).all()
+        return [tuple(p) for p in productos]
+
+def _leer_version():
+    with get_session() as session_db:
+        return leer_version_catalogo(session_db)
+
+# --- Caché ---
+
+class CatalogoCache:
+    """Caché en memoria del catálogo del bot, con TTL e invalidación por versión del catálogo."""
+
+    def __init__(self, ttl=CATALOGO_TTL, intervalo_version=CATALOGO_VERSION_INTERVALO):
+        self.ttl = ttl
+        self.intervalo_version = intervalo_version
+        self.hits = 0
+        self.misses = 0
+        self.invalidaciones = 0
+        self._entradas = {}
+        self._version = None
+        self._ultima_verificacion = 0.0
+
+    @property
+    def version(self):
+        """Última versión del catálogo leída de la base (0 si nunca se modificó)."""
+        return self._version or 0
+
+    def invalidar(self):
+        """Descarta todas las entradas y fuerza a releer la versión en el próximo acceso."""
+        self._entradas.clear()
+        self._ultima_verificacion = 0.0
+        self.invalidaciones += 1
+
+    def stats(self):
+        """Retorna los contadores de aciertos y fallos del caché."""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'invalidaciones': self.invalidaciones,
+            'entradas': len(self._entradas),
+            'version': self._version,
+        }
+
+    async def _verificar_version(self):
+        ahora = time.monotonic()
+        if ahora - self._ultima_verificacion < self.intervalo_version:
+            return
+        self._ultima_verificacion = ahora
+        version = await run_db(_leer_version)
+        if version != self._version:
+            if self._version is not None:
+                logger.info(f"Catálogo modificado (versión {self._version} -> {version}), invalidando caché.")
+                self.invalidar()
+                self._ultima_verificacion = ahora
+            self._version = version
+
+    async def _obtener(self, clave, cargar, *args):
+        """Retorna (valor, versión del catálogo con la que se cargó)."""
+        await self._verificar_version()
+        entrada = self._entradas.get(clave)
+        if entrada and time.monotonic() < entrada[0]:
+            self.hits += 1
+            return entrada[1], entrada[2]
+
+        self.misses += 1
+        # La versión se toma antes de cargar: las filas son de esa versión o de una posterior, nunca
+        # de una anterior. Si difiere, la compra la rechaza como catalogo_cambiado.
+        invalidaciones, version = self.invalidaciones, self.version
+        valor = await run_db(cargar, *args)
+        # Si el caché se invalidó mientras se cargaba, no se guarda un valor potencialmente viejo.
+        if invalidaciones == self.invalidaciones:
+            self._entradas[clave] = (time.monotonic() + self.ttl, valor, version)
+        return valor, version
+
+    async def categorias(self):
+        categorias, _ = await self._obtener(('categorias',), _cargar_categorias)
+        return categorias
+
+    async def productos(self, categoria):
+        """Retorna ([(id, nombre, precio, stock)], versión): los botones de compra deben usar esa versión, no self.version."""
+        return await self._obtener(('productos', categoria), _cargar_productos, categoria)
+
+catalogo_cache = CatalogoCache()
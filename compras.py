@@ -0,0 +1,54 @@
+import logging
+from sqlalchemy import select, update
+from db_models import Usuario, Key, ajustar_stock
+from metricas import Contador
+
+logger = logging.getLogger(__name__)
+
+# Reintentos del reclamo cuando otro comprador gana alguna de las filas candidatas.
+MAX_INTENTOS_RECLAMO = 5
+
+RECLAMOS_PARCIALES = Contador('compras_reclamos_parciales_total', 'Reclamos de keys reintentados porque otro comprador ganó filas candidatas.')
+
+def debitar_saldo(session_db, usuario_id, monto):
+    """Descuenta el monto con un único UPDATE atómico. Retorna False si el saldo no alcanza."""
+    result = session_db.execute(
+        update(Usuario)
+        .where(Usuario.id == usuario_id, Usuario.saldo >= monto)
+        .values(saldo=Usuario.saldo - monto)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+def reclamar_keys(session_db, producto_id, usuario_id, cantidad=1):
+    """
+    Marca como vendidas hasta `cantidad` keys disponibles distintas del producto y retorna sus licencias.
+    Si retorna menos de las pedidas no hay stock suficiente y el llamador debe hacer rollback.
+
+    Un solo UPDATE ... WHERE id IN (SELECT ... LIMIT n) RETURNING: en PostgreSQL el subselect lleva
+    FOR UPDATE SKIP LOCKED, así compradores concurrentes reciben filas distintas; en SQLite las
+    escrituras ya están serializadas. La condición estado='available' protege en cualquier motor.
+    """
+    licencias = []
+    for _ in range(MAX_INTENTOS_RECLAMO):
+        faltan = cantidad - len(licencias)
+        candidatas = (
+            select(Key.id).where(Key.producto_id == producto_id, Key.estado == 'available')
+            .order_by(Key.id).limit(faltan).with_for_update(skip_locked=True).scalar_subquery()
+        )
+        filas = session_db.execute(
+            update(Key)
+            .where(Key.id.in_(candidatas), Key.estado == 'available')
+            .values(estado='used', usuario_id=usuario_id)
+            .returning(Key.licencia)
+            .execution_options(synchronize_session=False)
+        ).all()
+        licencias.extend(f[0] for f in filas)
+        if len(licencias) == cantidad or not filas:
+            break
+        RECLAMOS_PARCIALES.inc()
+        logger.info(f"Reclamo parcial de keys del producto {producto_id} ({len(licencias)}/{cantidad}), reintentando.")
+
+    if licencias:
+        ajustar_stock(session_db, producto_id, disponibles=-len(licencias), usadas=len(licencias))
+    return licencias
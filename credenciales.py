@@ -0,0 +1,115 @@
+"""
+Credenciales de los socios: login_key guardada como hash y límite de intentos de login.
+
+Hash: PBKDF2-SHA256 con sal aleatoria, en el formato pbkdf2_sha256$<iteraciones>$<sal>$<hash>
+(cabe en usuarios.login_key). Las filas en texto plano se siguen aceptando y se reemplazan por
+el hash en el próximo login correcto del usuario (ver necesita_rehash). Verificar un hash cuesta
+cientos de milisegundos de CPU a propósito: el bot lo hace en hash_executor (verificar_async)
+para no detener el event loop; hashlib libera el GIL, así que los hilos alcanzan.
+
+Intentos: LimitadorIntentos cuenta fallos recientes por clave (telegram_id, username) en
+memoria y rechaza el intento antes de tocar la base ni calcular hashes. Es por proceso: con
+varios workers el límite efectivo se multiplica por la cantidad de procesos.
+"""
+import os
+import hmac
+import time
+import base64
+import asyncio
+import hashlib
+import secrets
+import threading
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+ALGORITMO = 'pbkdf2_sha256'
+HASH_ITERACIONES = int(os.getenv('HASH_ITERACIONES', '600000'))
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', '2'))
+LOGIN_MAX_INTENTOS = int(os.getenv('LOGIN_MAX_INTENTOS', '5'))
+LOGIN_VENTANA_SEGUNDOS = int(os.getenv('LOGIN_VENTANA_SEGUNDOS', '300'))
+# Claves registradas a partir de las cuales se purgan las que ya no tienen fallos vigentes.
+MAX_CLAVES_LIMITADOR = 10000
+
+def _b64(datos):
+    return base64.urlsafe_b64encode(datos).rstrip(b'=').decode()
+
+def _pbkdf2(clave, sal, iteraciones):
+    return hashlib.pbkdf2_hmac('sha256', clave.encode(), sal, iteraciones)
+
+def hashear(clave, iteraciones=None):
+    """Hash de `clave` listo para guardar en usuarios.login_key."""
+    iteraciones = iteraciones or HASH_ITERACIONES
+    sal = secrets.token_bytes(16)
+    return f"{ALGORITMO}${iteraciones}${_b64(sal)}${_b64(_pbkdf2(clave, sal, iteraciones))}"
+
+def es_hash(almacenada):
+    return (almacenada or '').startswith(ALGORITMO + '$')
+
+@lru_cache(maxsize=1)
+def _hash_ficticio():
+    """Se verifica contra este hash cuando el usuario no existe, así la respuesta tarda lo mismo y no revela qué usernames están registrados."""
+    return hashear(secrets.token_urlsafe(16))
+
+def verificar(clave, almacenada):
+    """True si `clave` corresponde a `almacenada` (hash o, en filas viejas, texto plano). almacenada=None: usuario inexistente."""
+    if almacenada is None:
+        verificar(clave, _hash_ficticio())
+        return False
+    if not es_hash(almacenada):
+        return hmac.compare_digest(clave.encode(), almacenada.encode())
+    try:
+        _, iteraciones, sal, esperado = almacenada.split('$')
+        calculado = _pbkdf2(clave, base64.urlsafe_b64decode(sal + '=' * (-len(sal) % 4)), int(iteraciones))
+    except ValueError:
+        return False
+    return hmac.compare_digest(_b64(calculado), esperado)
+
+def necesita_rehash(almacenada):
+    """True si la credencial está en texto plano o con menos iteraciones que las configuradas."""
+    return not es_hash(almacenada) or int(almacenada.split('$')[1]) < HASH_ITERACIONES
+
+# --- Pool de Verificación (Bot) ---
+hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='hash')
+
+async def verificar_async(clave, almacenada):
+    """verificar() en hash_executor. Retorna (correcta, nuevo_hash o None si no hay que reemplazarla)."""
+    def tarea():
+        if not verificar(clave, almacenada):
+            return False, None
+        return True, hashear(clave) if necesita_rehash(almacenada) else None
+    return await asyncio.get_running_loop().run_in_executor(hash_executor, tarea)
+
+
+class LimitadorIntentos:
+    """Hasta `max_intentos` fallos por clave en `ventana` segundos; luego se rechaza hasta que venza el más viejo."""
+
+    def __init__(self, max_intentos=LOGIN_MAX_INTENTOS, ventana=LOGIN_VENTANA_SEGUNDOS):
+        self.max_intentos = max_intentos
+        self.ventana = ventana
+        self._fallos = {}
+        self._lock = threading.Lock()
+
+    def espera(self, *claves):
+        """Segundos que faltan para poder intentar de nuevo con cualquiera de las claves (0: permitido)."""
+        ahora = time.monotonic()
+        with self._lock:
+            esperas = [self.ventana - (ahora - fallos[0]) for fallos in map(self._fallos.get, claves)
+                       if fallos is not None and len(fallos) >= self.max_intentos]
+        return max([0.0] + esperas)
+
+    def fallo(self, *claves):
+        ahora = time.monotonic()
+        with self._lock:
+            for clave in claves:
+                fallos = self._fallos.get(clave)
+                if fallos is None:
+                    fallos = self._fallos[clave] = deque(maxlen=self.max_intentos)
+                fallos.append(ahora)
+            if len(self._fallos) > MAX_CLAVES_LIMITADOR:
+                self._fallos = {c: f for c, f in self._fallos.items() if ahora - f[-1] < self.ventana}
+
+    def exito(self, *claves):
+        with self._lock:
+            for clave in claves:
+                self._fallos.pop(clave, None)
@@ -1,23 +1,106 @@
 import os
+import sys
+import asyncio
 import logging
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, BigInteger, ForeignKey
+import contextvars
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, event, update, func, Index, Column, Integer, String, Float, Boolean, Date, DateTime, BigInteger, ForeignKey, Text, UniqueConstraint
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship, scoped_session
 from datetime import datetime
 from dotenv import load_dotenv
+from metricas import instrumentar_engine
+from credenciales import hashear
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///socios_bot.db') 
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# Pool de hilos del bot para las consultas bloqueantes (ver run_db); define el pool del perfil 'bot'.
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', '8'))
+
+# --- Engine ---
+# Pool de conexiones por tipo de proceso (ver configurar_engine):
+# - web: cada worker de gunicorn atiende GUNICORN_THREADS solicitudes a la vez (workers x (pool + overflow) <= max_connections).
+# - bot: todas las consultas pasan por db_executor, así que alcanza una conexión por hilo.
+# - script: comandos de línea (migraciones, reconciliación) y benchmarks.
+PERFILES_POOL = {
+    'web': {'pool_size': int(os.getenv('GUNICORN_THREADS', '4')), 'max_overflow': 4},
+    'bot': {'pool_size': DB_EXECUTOR_WORKERS, 'max_overflow': 2},
+    'script': {'pool_size': 2, 'max_overflow': 4},
+}
+DB_PERFIL = os.getenv('DB_PERFIL', 'script')
+# Segundos tras los que se recicla una conexión (evita conexiones cortadas por proxies o el servidor)
+# y máximo de espera por una conexión libre antes de fallar.
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '10'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '10000'))
+
+def _pragmas_sqlite(dbapi_conn, connection_record):
+    """
+    WAL: los lectores no bloquean al escritor; NORMAL es seguro con WAL; busy_timeout espera al escritor en vez de fallar.
+    case_sensitive_like: LIKE distingue mayúsculas como en PostgreSQL y las búsquedas por prefijo del panel usan los índices.
+    """
+    cursor = dbapi_conn.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    cursor.execute('PRAGMA case_sensitive_like=ON')
+    cursor.close()
+
+def crear_engine(url=None, perfil=None):
+    """Crea un engine con el pool del perfil ('web', 'bot' o 'script'), pragmas de SQLite y métricas."""
+    url = make_url(url or DATABASE_URL)
+    pool = PERFILES_POOL[perfil or DB_PERFIL]
+    opciones = {'pool_pre_ping': True}
+    es_sqlite = url.get_backend_name() == 'sqlite'
+    # SQLite en memoria usa un pool de una conexión por hilo: no admite tamaño de pool.
+    if not (es_sqlite and url.database in (None, '', ':memory:')):
+        opciones.update(pool, pool_recycle=DB_POOL_RECYCLE, pool_timeout=DB_POOL_TIMEOUT)
+    nuevo = create_engine(url, **opciones)
+    if es_sqlite:
+        event.listen(nuevo, 'connect', _pragmas_sqlite)
+    instrumentar_engine(nuevo)
+    return nuevo
+
+engine = crear_engine()
 Base = declarative_base()
 SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
 
+def configurar_engine(perfil, url=None):
+    """
+    Reemplaza el engine compartido por uno con el pool del perfil. Se llama una vez al arrancar
+    el proceso (panel: 'web', bot: 'bot'), antes de abrir sesiones.
+    """
+    global engine
+    anterior, engine = engine, crear_engine(url, perfil)
+    SessionLocal.remove()
+    SessionLocal.configure(bind=engine)
+    anterior.dispose()
+    return engine
+
+def _descartar_conexiones_heredadas():
+    """Tras un fork (gunicorn --preload) el hijo no debe usar los sockets del padre: abre los suyos al pedirlos."""
+    engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=_descartar_conexiones_heredadas)
+
 def get_session():
     """Retorna una nueva sesión de SQLAlchemy."""
     return SessionLocal()
 
+# --- Acceso Asíncrono (Bot) ---
+# Pool de hilos acotado para que las consultas bloqueantes no detengan el event loop del bot.
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+
+async def run_db(func, *args, **kwargs):
+    """Ejecuta una función síncrona de base de datos en el pool de hilos y espera su resultado."""
+    loop = asyncio.get_running_loop()
+    # Se copia el contexto para que las consultas se sumen a las métricas del handler que las pidió.
+    return await loop.run_in_executor(db_executor, partial(contextvars.copy_context().run, func, *args, **kwargs))
+
 # --- Modelos de Datos ---
 
 class Usuario(Base):
@@ -25,24 +108,37 @@ class Usuario(Base):
     id = Column(Integer, primary_key=True)
     telegram_id = Column(BigInteger, unique=True, nullable=True) 
     username = Column(String(50), unique=True, nullable=False)
-    login_key = Column(String(100), nullable=False) 
+    login_key = Column(String(100), nullable=False)  # hash de credenciales.hashear (filas viejas: texto plano)
     saldo = Column(Float, default=0.00)
     es_admin = Column(Boolean, default=False)
     fecha_registro = Column(DateTime, default=datetime.now)
     keys_usadas = relationship("Key", back_populates="usuario")
 
+# Login caso-insensitivo: WHERE lower(username) = lower(:username)
+Index('ix_usuarios_username_lower', func.lower(Usuario.username))
+# Búsqueda por prefijo del panel (username LIKE 'prefijo%'). En PostgreSQL el índice único usa la
+# collation de la base y no sirve para LIKE; en SQLite alcanza con el único (ver _pragmas_sqlite).
+Index('ix_usuarios_username_prefijo', Usuario.username, postgresql_ops={'username': 'text_pattern_ops'}).ddl_if(dialect='postgresql')
+
 class Producto(Base):
     __tablename__ = 'productos'
     id = Column(Integer, primary_key=True)
-    nombre = Column(String(100), nullable=False)
-    categoria = Column(String(50), nullable=False)
+    nombre = Column(String(100), nullable=False, index=True)
+    categoria = Column(String(50), nullable=False, index=True)
     precio = Column(Float, nullable=False)
     descripcion = Column(String(255)) 
     fecha_creacion = Column(DateTime, default=datetime.now)
     keys = relationship("Key", back_populates="producto")
+    stock = relationship("StockProducto", back_populates="producto", uselist=False)
 
 class Key(Base):
     __tablename__ = 'keys'
+    __table_args__ = (
+        # Listados paginados del panel: keys de un producto por estado, ordenadas por id.
+        Index('ix_keys_producto_estado_id', 'producto_id', 'estado', 'id'),
+        # Búsqueda por prefijo de licencia en el panel (ver ix_usuarios_username_prefijo).
+        Index('ix_keys_licencia_prefijo', 'licencia', postgresql_ops={'licencia': 'text_pattern_ops'}).ddl_if(dialect='postgresql'),
+    )
     id = Column(Integer, primary_key=True)
     licencia = Column(String(255), unique=True, nullable=False)
     estado = Column(String(20), default='available')
@@ -51,30 +147,282 @@ class Key(Base):
     producto = relationship("Producto", back_populates="keys")
     usuario = relationship("Usuario", back_populates="keys_usadas")
 
+class StockProducto(Base):
+    """Contadores de keys por producto, mantenidos en la misma transacción que importa, vende o borra keys."""
+    __tablename__ = 'stock_productos'
+    producto_id = Column(Integer, ForeignKey('productos.id'), primary_key=True)
+    disponibles = Column(Integer, nullable=False, default=0)
+    usadas = Column(Integer, nullable=False, default=0)
+    producto = relationship("Producto", back_populates="stock")
+
+class CatalogoVersion(Base):
+    """Fila única con la generación del catálogo; el bot la consulta para invalidar su caché."""
+    __tablename__ = 'catalogo_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+TIPO_COMPRA = 'compra'
+TIPO_RECARGA = 'recarga'
+
+class Movimiento(Base):
+    """Ledger append-only de compras y recargas/ajustes de saldo. Nunca se modifica ni se borra."""
+    __tablename__ = 'movimientos'
+    __table_args__ = (
+        # Historiales del bot: movimientos de un usuario por tipo, del más reciente al más antiguo.
+        Index('ix_movimientos_usuario_tipo_id', 'usuario_id', 'tipo', 'id'),
+    )
+    id = Column(Integer, primary_key=True)
+    usuario_id = Column(Integer, ForeignKey('usuarios.id'), nullable=False)
+    tipo = Column(String(20), nullable=False)
+    monto = Column(Float, nullable=False)  # Negativo para compras, positivo/negativo para ajustes.
+    producto_id = Column(Integer)  # Sin FK: el historial sobrevive al borrado del producto.
+    licencia = Column(String(255))
+    descripcion = Column(String(255))
+    fecha = Column(DateTime, default=datetime.now, nullable=False)
+
+@event.listens_for(Movimiento, 'before_update')
+@event.listens_for(Movimiento, 'before_delete')
+def _movimiento_inmutable(mapper, connection, target):
+    raise ValueError("Los movimientos del ledger son de solo inserción.")
+
+class ConversacionBot(Base):
+    """Estado persistido de los ConversationHandler del bot (ver persistencia.py)."""
+    __tablename__ = 'bot_conversaciones'
+    nombre = Column(String(50), primary_key=True)
+    clave = Column(String(100), primary_key=True)  # JSON de la tupla (chat_id, user_id)
+    estado = Column(Text, nullable=False)  # JSON
+
+class DatosBot(Base):
+    """user_data / chat_data / bot_data persistidos del bot, serializados como JSON."""
+    __tablename__ = 'bot_datos'
+    tipo = Column(String(10), primary_key=True)  # 'user', 'chat' o 'bot'
+    entidad_id = Column(BigInteger, primary_key=True)
+    datos = Column(Text, nullable=False)
+
+class Difusion(Base):
+    """Mensaje del panel para todos los usuarios con Telegram vinculado; lo envía el bot (ver difusiones.py)."""
+    __tablename__ = 'difusiones'
+    id = Column(Integer, primary_key=True)
+    texto = Column(Text, nullable=False)
+    creada_por = Column(String(50))
+    fecha = Column(DateTime, default=datetime.now, nullable=False)
+    ultimo_usuario_id = Column(Integer, default=0, nullable=False)  # Cursor: destinatarios ya encolados hasta este Usuario.id
+    encolados = Column(Integer, default=0, nullable=False)
+    completada = Column(Boolean, default=False, nullable=False)
+
+class SuscripcionStock(Base):
+    """Usuario que pidió aviso cuando el producto vuelva a tener stock. Se borra al notificarlo."""
+    __tablename__ = 'suscripciones_stock'
+    __table_args__ = (
+        UniqueConstraint('usuario_id', 'producto_id', name='uq_suscripciones_usuario_producto'),
+        # Aviso en orden de suscripción: recorre las de un producto por id.
+        Index('ix_suscripciones_producto_id', 'producto_id', 'id'),
+    )
+    id = Column(Integer, primary_key=True)
+    usuario_id = Column(Integer, ForeignKey('usuarios.id'), nullable=False)
+    producto_id = Column(Integer, ForeignKey('productos.id'), nullable=False)
+    fecha = Column(DateTime, default=datetime.now, nullable=False)
+
+class Reposicion(Base):
+    """Keys importadas para un producto; el bot avisa a sus suscriptores (ver difusiones.py)."""
+    __tablename__ = 'reposiciones'
+    id = Column(Integer, primary_key=True)
+    producto_id = Column(Integer, nullable=False)  # Sin FK: el producto puede borrarse antes de avisar.
+    cantidad = Column(Integer, nullable=False)
+    fecha = Column(DateTime, default=datetime.now, nullable=False)
+    notificados = Column(Integer, default=0, nullable=False)
+    completada = Column(Boolean, default=False, nullable=False)
+
+class VentaPorHora(Base):
+    """Keys vendidas e ingresos por hora y producto, acumulados desde el ledger (ver analitica.py)."""
+    __tablename__ = 'ventas_por_hora'
+    hora = Column(DateTime, primary_key=True)  # Inicio de la hora
+    producto_id = Column(Integer, primary_key=True)  # Sin FK, como en movimientos
+    cantidad = Column(Integer, nullable=False, default=0)
+    ingresos = Column(Float, nullable=False, default=0)
+
+class VentaPorDia(Base):
+    """Keys vendidas e ingresos por día y producto (ver analitica.py)."""
+    __tablename__ = 'ventas_por_dia'
+    dia = Column(Date, primary_key=True)
+    producto_id = Column(Integer, primary_key=True)
+    cantidad = Column(Integer, nullable=False, default=0)
+    ingresos = Column(Float, nullable=False, default=0)
+
+class VentaPorUsuario(Base):
+    """Compras acumuladas por usuario (ver analitica.py)."""
+    __tablename__ = 'ventas_por_usuario'
+    __table_args__ = (
+        # Ranking de compradores: ORDER BY gastado DESC LIMIT n recorre solo el principio del índice.
+        Index('ix_ventas_por_usuario_gastado', 'gastado'),
+    )
+    usuario_id = Column(Integer, primary_key=True)
+    cantidad = Column(Integer, nullable=False, default=0)
+    gastado = Column(Float, nullable=False, default=0)
+    ultima_compra = Column(DateTime)
+
+class CursorVentas(Base):
+    """Fila única: último movimiento del ledger acumulado en las tablas de ventas y totales históricos."""
+    __tablename__ = 'cursor_ventas'
+    id = Column(Integer, primary_key=True)
+    ultimo_movimiento_id = Column(Integer, nullable=False, default=0)
+    cantidad = Column(Integer, nullable=False, default=0)
+    ingresos = Column(Float, nullable=False, default=0)
+    actualizado = Column(DateTime)  # Fecha del último movimiento acumulado
+
+class SchemaVersion(Base):
+    """Migraciones aplicadas (ver migraciones.py)."""
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
+    descripcion = Column(String(255), nullable=False)
+    fecha_aplicada = Column(DateTime, default=datetime.now)
+
+# --- Contadores de Stock ---
+
+def _contar_stock(session_db, producto_id):
+    """Calcula los contadores de un producto directamente desde la tabla keys."""
+    conteos = dict(session_db.query(Key.estado, func.count(Key.id)).filter(Key.producto_id == producto_id).group_by(Key.estado).all())
+    return StockProducto(producto_id=producto_id, disponibles=conteos.get('available', 0), usadas=conteos.get('used', 0))
+
+def ajustar_stock(session_db, producto_id, disponibles=0, usadas=0):
+    """Aplica un delta a los contadores del producto dentro de la transacción actual (sin commit)."""
+    result = session_db.execute(
+        update(StockProducto)
+        .where(StockProducto.producto_id == producto_id)
+        .values(disponibles=StockProducto.disponibles + disponibles, usadas=StockProducto.usadas + usadas)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        # Producto sin contador (creado antes de esta tabla): se recalcula incluyendo los cambios pendientes.
+        session_db.flush()
+        session_db.add(_contar_stock(session_db, producto_id))
+        session_db.flush()
+
+def reconciliar_stock(session_db):
+    """Reconstruye los contadores de todos los productos a partir de la tabla keys (sin commit)."""
+    conteos = {}
+    for producto_id, estado, total in session_db.query(Key.producto_id, Key.estado, func.count(Key.id)).group_by(Key.producto_id, Key.estado):
+        conteos[(producto_id, estado)] = total
+
+    session_db.query(StockProducto).delete(synchronize_session=False)
+    productos = [producto_id for (producto_id,) in session_db.query(Producto.id)]
+    session_db.add_all([
+        StockProducto(producto_id=pid, disponibles=conteos.get((pid, 'available'), 0), usadas=conteos.get((pid, 'used'), 0))
+        for pid in productos
+    ])
+    session_db.flush()
+    return len(productos)
+
+
+# --- Ledger de Saldo ---
+
+def registrar_movimiento(session_db, usuario_id, tipo, monto, **datos):
+    """Agrega un movimiento al ledger dentro de la transacción actual (sin commit)."""
+    session_db.add(Movimiento(usuario_id=usuario_id, tipo=tipo, monto=monto, **datos))
+
+def ajustar_saldo(session_db, usuario_id, monto, descripcion=None):
+    """Suma (o resta) saldo con un UPDATE atómico y lo registra como recarga en el ledger (sin commit)."""
+    session_db.execute(
+        update(Usuario).where(Usuario.id == usuario_id).values(saldo=func.coalesce(Usuario.saldo, 0) + monto)
+        .execution_options(synchronize_session=False)
+    )
+    registrar_movimiento(session_db, usuario_id, TIPO_RECARGA, monto, descripcion=descripcion)
+
+def verificar_saldos(session_db, tolerancia=0.005):
+    """Retorna [(usuario_id, username, saldo, suma_ledger)] de los usuarios cuyo saldo no coincide con el ledger."""
+    sumas = session_db.query(Movimiento.usuario_id, func.sum(Movimiento.monto).label('suma')).group_by(Movimiento.usuario_id).subquery()
+    filas = session_db.query(Usuario.id, Usuario.username, Usuario.saldo, func.coalesce(sumas.c.suma, 0)).outerjoin(sumas, sumas.c.usuario_id == Usuario.id)
+    return [fila for fila in filas if abs((fila[2] or 0) - fila[3]) > tolerancia]
+
+# --- Paginación por Cursor (Keyset) ---
+
+def paginar_keyset(query, columna, despues=None, limite=50, descendente=False):
+    """
+    Retorna (filas, siguiente_cursor) usando WHERE columna > cursor en lugar de OFFSET,
+    así el costo de cada página no crece con el tamaño de la tabla.
+    siguiente_cursor es None en la última página.
+    """
+    if despues is not None:
+        query = query.filter(columna < despues if descendente else columna > despues)
+    query = query.order_by(columna.desc() if descendente else columna.asc())
+    filas = query.limit(limite + 1).all()
+    if len(filas) <= limite:
+        return filas, None
+    filas = filas[:limite]
+    return filas, getattr(filas[-1], columna.key)
+
+# --- Versión del Catálogo ---
+
+def incrementar_version_catalogo(session_db):
+    """Marca el catálogo como modificado dentro de la transacción actual (sin commit)."""
+    result = session_db.execute(
+        update(CatalogoVersion).where(CatalogoVersion.id == 1).values(version=CatalogoVersion.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        session_db.add(CatalogoVersion(id=1, version=1))
+        session_db.flush()
+
+def leer_version_catalogo(session_db):
+    """Retorna la generación actual del catálogo (0 si nunca se modificó)."""
+    return session_db.query(CatalogoVersion.version).filter(CatalogoVersion.id == 1).scalar() or 0
+
 
 def inicializar_db(target_engine=None):
-    """Crea las tablas y el usuario administrador si no existen."""
+    """
+    Crea las tablas, aplica las migraciones pendientes y crea el usuario administrador si no existen.
+    No corre al importar: se ejecuta una vez por deploy con `python migraciones.py`. Retorna las migraciones aplicadas.
+    """
+    from migraciones import migrar
+
     current_engine = target_engine if target_engine is not None else engine
     Base.metadata.create_all(current_engine)
-    
+    aplicadas = migrar(current_engine)
+
     Session = sessionmaker(bind=current_engine)
     with Session() as session:
         if session.query(Usuario).count() == 0:
             logging.info("Insertando SOLAMENTE el usuario administrador: admin/adminpass")
-            admin_user = Usuario(username='admin', login_key='adminpass', saldo=1000.00, es_admin=True)
+            admin_user = Usuario(username='admin', login_key=hashear('adminpass'), saldo=1000.00, es_admin=True)
             session.add(admin_user)
+            session.flush()
+            registrar_movimiento(session, admin_user.id, TIPO_RECARGA, admin_user.saldo, descripcion='Saldo inicial')
             session.commit()
             print("Base de datos inicializada con usuario administrador: admin/adminpass.")
         else:
              print("Base de datos verificada. Usuario administrador existente.")
 
+        if session.query(StockProducto).first() is None and session.query(Producto).first() is not None:
+            logging.info("Inicializando contadores de stock desde la tabla keys.")
+            reconciliar_stock(session)
+            session.commit()
+    return aplicadas
+
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'reconciliar_stock':
+        # Uso: python db_models.py reconciliar_stock  (sobre DATABASE_URL)
+        Base.metadata.create_all(engine)
+        with get_session() as session_db:
+            total = reconciliar_stock(session_db)
+            session_db.commit()
+        print(f"Contadores de stock reconstruidos para {total} productos.")
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'verificar_saldos':
+        # Uso: python db_models.py verificar_saldos  (compara usuarios.saldo con la suma del ledger)
+        with get_session() as session_db:
+            diferencias = verificar_saldos(session_db)
+        for usuario_id, username, saldo, suma in diferencias:
+            print(f"Usuario {usuario_id} ({username}): saldo ${saldo or 0:.2f} != ledger ${suma:.2f}")
+        print(f"{len(diferencias)} saldos no coinciden con el ledger." if diferencias else "Todos los saldos coinciden con el ledger.")
+        sys.exit(1 if diferencias else 0)
+
     DATABASE_URL_LOCAL = 'sqlite:///socios_bot.db'
     print(f"Inicializando DB: {DATABASE_URL_LOCAL}")
 
     try:
-        engine_temp = create_engine(DATABASE_URL_LOCAL)
+        engine_temp = crear_engine(DATABASE_URL_LOCAL)
         inicializar_db(engine_temp) 
         print("¡Proceso de creación de tablas finalizado con éxito!")
     
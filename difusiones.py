@@ -0,0 +1,148 @@
+"""
+Avisos masivos que el panel registra en la base y el bot envía por la cola de envíos (envios.py).
+
+Difusiones: el bot recorre los destinatarios (usuarios con telegram_id) por lotes en orden de
+Usuario.id. El avance se guarda en difusiones.ultimo_usuario_id, así una difusión sobrevive a
+reinicios, y solo se lee el siguiente lote cuando la cola se vació lo suficiente: nunca se
+cargan todos los destinatarios en memoria.
+
+Reposiciones: al importar keys se registra una reposición y el bot avisa a los suscriptores del
+producto en orden de suscripción, solo tantos como keys disponibles haya (no se despierta a miles
+de usuarios por diez keys). Cada suscripción avisada se borra; el resto espera la próxima reposición.
+"""
+import os
+import asyncio
+import logging
+from sqlalchemy import update
+from db_models import Usuario, Producto, StockProducto, Difusion, SuscripcionStock, Reposicion, get_session, run_db
+
+logger = logging.getLogger(__name__)
+
+DIFUSION_LOTE = int(os.getenv('DIFUSION_LOTE', '500'))
+# Segundos entre consultas por difusiones nuevas cuando no hay ninguna en curso.
+DIFUSION_INTERVALO = float(os.getenv('DIFUSION_INTERVALO', '5'))
+# No se leen más destinatarios mientras la cola de envíos tenga al menos esta cantidad pendiente.
+DIFUSION_MAX_PENDIENTES = 2 * DIFUSION_LOTE
+
+def crear_difusion(session_db, texto, creada_por=None):
+    """Registra una difusión para todos los usuarios con Telegram vinculado (sin commit)."""
+    difusion = Difusion(texto=texto, creada_por=creada_por)
+    session_db.add(difusion)
+    session_db.flush()
+    return difusion
+
+def registrar_reposicion(session_db, producto_id, cantidad):
+    """Registra keys nuevas de un producto para avisar a sus suscriptores (sin commit)."""
+    if cantidad > 0 and session_db.query(SuscripcionStock.id).filter(SuscripcionStock.producto_id == producto_id).first():
+        session_db.add(Reposicion(producto_id=producto_id, cantidad=cantidad))
+
+def _tomar_lote_difusion(limite):
+    """
+    Reserva el próximo lote de destinatarios de la difusión pendiente más antigua.
+    Retorna (texto, [telegram_id]) o None si no hay difusiones pendientes.
+    """
+    with get_session() as session_db:
+        try:
+            difusion = session_db.query(Difusion.id, Difusion.texto, Difusion.ultimo_usuario_id).filter(Difusion.completada == False).order_by(Difusion.id).first()
+            if not difusion:
+                return None
+
+            filas = (
+                session_db.query(Usuario.id, Usuario.telegram_id)
+                .filter(Usuario.id > difusion.ultimo_usuario_id, Usuario.telegram_id.isnot(None))
+                .order_by(Usuario.id).limit(limite).all()
+            )
+            if filas:
+                valores = {'ultimo_usuario_id': filas[-1][0], 'encolados': Difusion.encolados + len(filas)}
+            else:
+                valores = {'completada': True}
+
+            # Avance condicional del cursor: si otro proceso del bot tomó este lote primero, no se envía dos veces.
+            result = session_db.execute(
+                update(Difusion)
+                .where(Difusion.id == difusion.id, Difusion.ultimo_usuario_id == difusion.ultimo_usuario_id, Difusion.completada == False)
+                .values(**valores)
+                .execution_options(synchronize_session=False)
+            )
+            session_db.commit()
+            if result.rowcount != 1:
+                return difusion.texto, []
+            if not filas:
+                logger.info(f"Difusión {difusion.id} completada.")
+            return difusion.texto, [telegram_id for _, telegram_id in filas]
+        except Exception:
+            session_db.rollback()
+            raise
+
+def _tomar_lote_reposicion(limite):
+    """
+    Reserva el próximo lote de suscriptores a avisar de la reposición pendiente más antigua.
+    El lote se acota por las keys de la reposición que faltan avisar y por el stock disponible
+    actual: si las keys ya se vendieron, la reposición se da por terminada.
+    Retorna (texto, [telegram_id]) o None si no hay reposiciones pendientes.
+    """
+    with get_session() as session_db:
+        try:
+            fila = (
+                session_db.query(Reposicion.id, Reposicion.producto_id, Reposicion.cantidad, Reposicion.notificados, Producto.nombre, StockProducto.disponibles)
+                .outerjoin(Producto, Producto.id == Reposicion.producto_id)
+                .outerjoin(StockProducto, StockProducto.producto_id == Reposicion.producto_id)
+                .filter(Reposicion.completada == False).order_by(Reposicion.id).first()
+            )
+            if not fila:
+                return None
+            reposicion_id, producto_id, cantidad, notificados, nombre, disponibles = fila
+
+            cupo = min(limite, cantidad - notificados, disponibles or 0) if nombre else 0
+            suscripciones = []
+            if cupo > 0:
+                suscripciones = (
+                    session_db.query(SuscripcionStock.id, Usuario.telegram_id)
+                    .join(Usuario, Usuario.id == SuscripcionStock.usuario_id)
+                    .filter(SuscripcionStock.producto_id == producto_id, Usuario.telegram_id.isnot(None))
+                    .order_by(SuscripcionStock.id).limit(cupo).all()
+                )
+            valores = {'notificados': notificados + len(suscripciones)} if suscripciones else {'completada': True}
+
+            # Igual que en las difusiones: el avance condicional evita avisar dos veces desde dos procesos.
+            result = session_db.execute(
+                update(Reposicion)
+                .where(Reposicion.id == reposicion_id, Reposicion.notificados == notificados, Reposicion.completada == False)
+                .values(**valores)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount != 1:
+                session_db.rollback()
+                return '', []
+            if suscripciones:
+                session_db.query(SuscripcionStock).filter(SuscripcionStock.id.in_([s for s, _ in suscripciones])).delete(synchronize_session=False)
+            session_db.commit()
+            if not suscripciones:
+                logger.info(f"Reposición {reposicion_id} completada ({notificados} suscriptores avisados).")
+            texto = f"🔔 ¡Volvió el stock de {nombre}! Entra a 🛒 Comprar Keys para conseguirlo antes de que se agote."
+            return texto, [telegram_id for _, telegram_id in suscripciones]
+        except Exception:
+            session_db.rollback()
+            raise
+
+async def procesar_difusiones(cola, intervalo=DIFUSION_INTERVALO, lote=DIFUSION_LOTE):
+    """Tarea de fondo del bot: pasa los destinatarios de las difusiones y reposiciones pendientes a la cola de envíos."""
+    while True:
+        while cola.pendientes() >= DIFUSION_MAX_PENDIENTES:
+            await asyncio.sleep(1)
+        # Los avisos de reposición van primero: pierden valor si se demoran.
+        reservado = None
+        for tomar_lote in (_tomar_lote_reposicion, _tomar_lote_difusion):
+            try:
+                reservado = await run_db(tomar_lote, lote)
+            except Exception as e:
+                logger.error(f"Error leyendo avisos pendientes ({tomar_lote.__name__}): {e}")
+            if reservado is not None:
+                break
+
+        if reservado is None:
+            await asyncio.sleep(intervalo)
+            continue
+        texto, destinatarios = reservado
+        for telegram_id in destinatarios:
+            cola.encolar(telegram_id, texto)
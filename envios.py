@@ -0,0 +1,187 @@
+"""
+Cola de mensajes salientes del bot con límite de tasa.
+
+Los avisos que no responden a un update (difusiones del panel, avisos de reposición) se
+encolan acá en lugar de enviarse desde los handlers, así un envío masivo no bloquea al bot
+ni dispara el control de flood de Telegram (~30 mensajes/s en total y ~1 mensaje/s por chat):
+
+- Token bucket global y un intervalo mínimo por chat.
+- Ante un 429 (RetryAfter) se pausan todos los envíos el tiempo indicado y el mensaje se reintenta.
+- Mensajes pendientes para un mismo chat se agrupan en un solo sendMessage (hasta 4096 caracteres).
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from telegram.error import RetryAfter, Forbidden, BadRequest
+
+logger = logging.getLogger(__name__)
+
+ENVIOS_POR_SEGUNDO = float(os.getenv('ENVIOS_POR_SEGUNDO', '25'))
+ENVIOS_POR_CHAT_POR_SEGUNDO = float(os.getenv('ENVIOS_POR_CHAT_POR_SEGUNDO', '1'))
+ENVIOS_CONCURRENCIA = int(os.getenv('ENVIOS_CONCURRENCIA', '8'))
+MAX_INTENTOS_ENVIO = 3
+LARGO_MAXIMO_MENSAJE = 4096
+# Entradas del registro de último envío por chat a partir de las cuales se purgan las vencidas.
+MAX_CHATS_REGISTRADOS = 10000
+
+
+class TokenBucket:
+    """Token bucket: `tasa` tokens por segundo, acumulables hasta `capacidad` (1 = sin ráfagas)."""
+
+    def __init__(self, tasa, capacidad=1.0):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self._tokens = capacidad
+        self._ultimo = time.monotonic()
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.tasa)
+        self._ultimo = ahora
+
+    def tomar(self):
+        """Consume un token si hay uno disponible. Retorna True si se pudo."""
+        self._recargar()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def espera(self):
+        """Segundos hasta que haya un token disponible."""
+        self._recargar()
+        return max(0.0, (1 - self._tokens) / self.tasa)
+
+    async def adquirir(self):
+        while not self.tomar():
+            await asyncio.sleep(self.espera())
+
+
+class ColaEnvios:
+    """
+    Cola de envíos por chat. Cada chat con mensajes pendientes está una sola vez en `_listos`,
+    así un mismo chat nunca se procesa en dos trabajadores a la vez y sus mensajes salen en orden.
+    """
+
+    def __init__(self, tasa_global=ENVIOS_POR_SEGUNDO, tasa_por_chat=ENVIOS_POR_CHAT_POR_SEGUNDO, concurrencia=ENVIOS_CONCURRENCIA):
+        self.concurrencia = concurrencia
+        self._global = TokenBucket(tasa_global)
+        self._intervalo_chat = 1 / tasa_por_chat
+        # {chat_id: deque[(texto, opciones, intentos)]}
+        self._pendientes = {}
+        # {chat_id: momento (monotonic) a partir del cual se puede volver a enviar a ese chat}
+        self._proximo_por_chat = {}
+        self._listos = asyncio.Queue()
+        self._pausa_hasta = 0.0
+        self._total_pendientes = 0
+        self._tareas = []
+        self.enviados = 0
+        self.fallidos = 0
+        self.reintentos = 0
+
+    def encolar(self, chat_id, texto, **opciones):
+        """Agrega un mensaje para `chat_id`; `opciones` se pasan a bot.send_message (parse_mode, reply_markup...)."""
+        cola = self._pendientes.get(chat_id)
+        if cola is None:
+            cola = self._pendientes[chat_id] = deque()
+            self._listos.put_nowait(chat_id)
+        cola.append((texto, opciones, 0))
+        self._total_pendientes += 1
+
+    def pendientes(self):
+        """Cantidad de mensajes encolados todavía sin enviar."""
+        return self._total_pendientes
+
+    def stats(self):
+        return {'pendientes': self._total_pendientes, 'chats': len(self._pendientes), 'enviados': self.enviados, 'fallidos': self.fallidos, 'reintentos': self.reintentos}
+
+    def iniciar(self, bot):
+        """Arranca los trabajadores en el event loop actual."""
+        loop = asyncio.get_running_loop()
+        self._tareas = [loop.create_task(self._trabajador(bot)) for _ in range(self.concurrencia)]
+
+    async def detener(self):
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+        if self._total_pendientes:
+            logger.warning(f"Cola de envíos detenida con {self._total_pendientes} mensajes sin enviar.")
+
+    def _armar_lote(self, chat_id):
+        """Saca de la cola del chat los mensajes consecutivos con las mismas opciones que caben en un solo mensaje."""
+        cola = self._pendientes[chat_id]
+        textos, opciones, intentos = [cola[0][0]], cola[0][1], cola[0][2]
+        cola.popleft()
+        largo = len(textos[0])
+        while cola and cola[0][1] == opciones and largo + 2 + len(cola[0][0]) <= LARGO_MAXIMO_MENSAJE:
+            texto, _, intentos_msg = cola.popleft()
+            textos.append(texto)
+            largo += 2 + len(texto)
+            intentos = max(intentos, intentos_msg)
+        return textos, opciones, intentos
+
+    def _devolver_lote(self, chat_id, textos, opciones, intentos):
+        """Reinserta un lote al frente de la cola del chat (como un único mensaje ya agrupado)."""
+        self._pendientes[chat_id].appendleft(("\n\n".join(textos), opciones, intentos))
+        self._total_pendientes -= len(textos) - 1
+
+    def _liberar_chat(self, chat_id):
+        if self._pendientes[chat_id]:
+            self._listos.put_nowait(chat_id)
+        else:
+            del self._pendientes[chat_id]
+
+    def _purgar_chats(self, ahora):
+        if len(self._proximo_por_chat) > MAX_CHATS_REGISTRADOS:
+            self._proximo_por_chat = {c: t for c, t in self._proximo_por_chat.items() if t > ahora}
+
+    async def _trabajador(self, bot):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self._listos.get()
+
+            # El chat todavía no puede recibir otro mensaje: se reprograma sin ocupar al trabajador.
+            espera = self._proximo_por_chat.get(chat_id, 0) - time.monotonic()
+            if espera > 0:
+                loop.call_later(espera, self._listos.put_nowait, chat_id)
+                continue
+
+            while (pausa := self._pausa_hasta - time.monotonic()) > 0:
+                await asyncio.sleep(pausa)
+            await self._global.adquirir()
+
+            textos, opciones, intentos = self._armar_lote(chat_id)
+            ahora = time.monotonic()
+            self._proximo_por_chat[chat_id] = ahora + self._intervalo_chat
+            self._purgar_chats(ahora)
+            try:
+                await bot.send_message(chat_id, "\n\n".join(textos), **opciones)
+                self.enviados += len(textos)
+                self._total_pendientes -= len(textos)
+            except RetryAfter as e:
+                segundos = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+                logger.warning(f"Flood control de Telegram: pausando envíos {segundos:.0f}s.")
+                self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+                self.reintentos += 1
+                self._devolver_lote(chat_id, textos, opciones, intentos)
+            except (Forbidden, BadRequest) as e:
+                # Bot bloqueado por el usuario o chat inexistente: reintentar no sirve.
+                logger.info(f"Descartando {len(textos)} mensajes para el chat {chat_id}: {e}")
+                self.fallidos += len(textos)
+                self._total_pendientes -= len(textos)
+            except Exception as e:
+                if intentos + 1 < MAX_INTENTOS_ENVIO:
+                    self.reintentos += 1
+                    self._devolver_lote(chat_id, textos, opciones, intentos + 1)
+                else:
+                    logger.error(f"Error enviando al chat {chat_id} tras {MAX_INTENTOS_ENVIO} intentos: {e}")
+                    self.fallidos += len(textos)
+                    self._total_pendientes -= len(textos)
+            finally:
+                self._liberar_chat(chat_id)
+
+
+cola_envios = ColaEnvios()
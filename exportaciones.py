@@ -0,0 +1,109 @@
+"""
+Exportaciones del panel (keys, socios y ventas) en CSV o JSONL, enviadas por streaming.
+
+Cada exportación es un generador: la consulta se recorre con yield_per (en Postgres, un cursor
+del lado del servidor) y las filas se convierten a texto en bloques de EXPORTACION_LOTE, así la
+memoria del worker no depende de cuántas filas se exporten. La sesión se abre y se cierra dentro
+del generador porque la respuesta se sigue enviando después de que la vista retornó.
+"""
+import io
+import os
+import csv
+import json
+from datetime import date, datetime, timedelta
+from sqlalchemy import func
+from db_models import Key, Producto, Usuario, Movimiento, TIPO_COMPRA, get_session
+
+EXPORTACION_LOTE = int(os.getenv('EXPORTACION_LOTE', '1000'))
+FORMATOS = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/x-ndjson; charset=utf-8'}
+ESTADOS_KEY = ('available', 'used')
+
+def _usuario_id(session_db, username):
+    """Id del usuario (username sin distinguir mayúsculas) o -1 si no existe, para que el filtro no devuelva filas."""
+    usuario_id = session_db.query(Usuario.id).filter(func.lower(Usuario.username) == func.lower(username)).scalar()
+    return usuario_id if usuario_id is not None else -1
+
+def _rango(query, columna, desde, hasta):
+    """Filtra `columna` entre los días `desde` y `hasta` inclusive (cualquiera puede ser None)."""
+    if desde:
+        query = query.filter(columna >= datetime.combine(desde, datetime.min.time()))
+    if hasta:
+        query = query.filter(columna < datetime.combine(hasta + timedelta(days=1), datetime.min.time()))
+    return query
+
+# Cada consulta recibe todos los filtros y aplica los que tienen sentido para sus filas.
+
+def _consulta_keys(session_db, producto_id=None, estado=None, usuario=None, desde=None, hasta=None):
+    """Keys por producto, estado y comprador (las keys no tienen fecha: el rango se aplica en ventas)."""
+    query = (
+        session_db.query(Key.id, Key.licencia, Key.estado, Key.producto_id, Producto.nombre, Key.usuario_id)
+        .outerjoin(Producto, Producto.id == Key.producto_id)
+    )
+    if producto_id is not None:
+        query = query.filter(Key.producto_id == producto_id)
+    if estado:
+        query = query.filter(Key.estado == estado)
+    if usuario:
+        query = query.filter(Key.usuario_id == _usuario_id(session_db, usuario))
+    return query.order_by(Key.id)
+
+def _consulta_usuarios(session_db, producto_id=None, estado=None, usuario=None, desde=None, hasta=None):
+    """Socios por fecha de registro. No incluye login_key."""
+    query = session_db.query(Usuario.id, Usuario.username, Usuario.telegram_id, Usuario.saldo, Usuario.es_admin, Usuario.fecha_registro)
+    if usuario:
+        query = query.filter(Usuario.id == _usuario_id(session_db, usuario))
+    return _rango(query, Usuario.fecha_registro, desde, hasta).order_by(Usuario.id)
+
+def _consulta_ventas(session_db, producto_id=None, estado=None, usuario=None, desde=None, hasta=None):
+    """Compras del ledger (una fila por key vendida) por producto, comprador y fecha."""
+    query = (
+        session_db.query(Movimiento.id, Movimiento.fecha, Movimiento.usuario_id, Usuario.username, Movimiento.producto_id,
+                         Movimiento.descripcion, Movimiento.licencia, -Movimiento.monto)
+        .outerjoin(Usuario, Usuario.id == Movimiento.usuario_id)
+        .filter(Movimiento.tipo == TIPO_COMPRA)
+    )
+    if producto_id is not None:
+        query = query.filter(Movimiento.producto_id == producto_id)
+    if usuario:
+        query = query.filter(Movimiento.usuario_id == _usuario_id(session_db, usuario))
+    return _rango(query, Movimiento.fecha, desde, hasta).order_by(Movimiento.id)
+
+# {tipo: (columnas del archivo, consulta)}
+EXPORTACIONES = {
+    'keys': (('id', 'licencia', 'estado', 'producto_id', 'producto', 'usuario_id'), _consulta_keys),
+    'usuarios': (('id', 'username', 'telegram_id', 'saldo', 'es_admin', 'fecha_registro'), _consulta_usuarios),
+    'ventas': (('id', 'fecha', 'usuario_id', 'username', 'producto_id', 'producto', 'licencia', 'monto'), _consulta_ventas),
+}
+
+def _valor(valor):
+    return valor.isoformat() if isinstance(valor, (date, datetime)) else valor
+
+def _csv(filas, columnas):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(columnas)
+    for i, fila in enumerate(filas, 1):
+        escritor.writerow([_valor(v) for v in fila])
+        if i % EXPORTACION_LOTE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _jsonl(filas, columnas):
+    bloque = []
+    for fila in filas:
+        bloque.append(json.dumps(dict(zip(columnas, map(_valor, fila))), ensure_ascii=False))
+        if len(bloque) == EXPORTACION_LOTE:
+            yield '\n'.join(bloque) + '\n'
+            bloque = []
+    if bloque:
+        yield '\n'.join(bloque) + '\n'
+
+def generar_exportacion(tipo, formato, **filtros):
+    """Generador con el contenido de la exportación `tipo` en `formato` ('csv' o 'jsonl'), en bloques de texto."""
+    columnas, consulta = EXPORTACIONES[tipo]
+    serializar = _csv if formato == 'csv' else _jsonl
+    with get_session() as session_db:
+        filas = consulta(session_db, **filtros).execution_options(yield_per=EXPORTACION_LOTE)
+        yield from serializar(filas, columnas)
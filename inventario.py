@@ -0,0 +1,68 @@
+import logging
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+from db_models import Key, ajustar_stock
+
+logger = logging.getLogger(__name__)
+
+# Filas por INSERT (executemany) y por transacción durante la importación.
+TAMANO_LOTE_IMPORTACION = 5000
+LARGO_MAXIMO_LICENCIA = Key.__table__.c.licencia.type.length
+
+def _insert_ignorando_duplicados(session_db):
+    """INSERT de keys que omite licencias ya existentes (ON CONFLICT DO NOTHING)."""
+    dialecto = session_db.get_bind().dialect.name
+    if dialecto == 'postgresql':
+        # Con RETURNING, psycopg2 agrupa el lote en pocos INSERT multi-VALUES (insertmanyvalues).
+        return postgresql.insert(Key).on_conflict_do_nothing(index_elements=['licencia']).returning(Key.id)
+    if dialecto == 'sqlite':
+        return sqlite.insert(Key).on_conflict_do_nothing(index_elements=['licencia'])
+    return insert(Key)
+
+def _insertar_lote(session_db, stmt, producto_id, lote):
+    """Inserta un lote, actualiza el stock y confirma. Retorna cuántas keys se insertaron."""
+    filas = [{'licencia': licencia, 'producto_id': producto_id, 'estado': 'available'} for licencia in lote]
+    result = session_db.connection().execute(stmt, filas)
+    insertadas = len(result.all()) if result.returns_rows else result.rowcount
+    if insertadas:
+        ajustar_stock(session_db, producto_id, disponibles=insertadas)
+    session_db.commit()
+    return insertadas
+
+def importar_keys(session_db, producto_id, lineas, tamano_lote=TAMANO_LOTE_IMPORTACION):
+    """
+    Importa licencias desde cualquier iterable de líneas (str o bytes) sin cargarlas todas en memoria.
+    Cada lote se inserta con executemany en su propia transacción; las duplicadas se omiten.
+    Retorna un dict con los totales 'insertadas', 'duplicadas' e 'invalidas'.
+    """
+    stmt = _insert_ignorando_duplicados(session_db)
+    resultado = {'insertadas': 0, 'duplicadas': 0, 'invalidas': 0}
+    lote = {}
+
+    for linea in lineas:
+        if isinstance(linea, bytes):
+            linea = linea.decode('utf-8', errors='replace')
+        licencia = linea.strip()
+        if not licencia:
+            continue
+        if len(licencia) > LARGO_MAXIMO_LICENCIA:
+            resultado['invalidas'] += 1
+            continue
+        if licencia in lote:
+            resultado['duplicadas'] += 1
+            continue
+        lote[licencia] = None
+
+        if len(lote) >= tamano_lote:
+            insertadas = _insertar_lote(session_db, stmt, producto_id, lote)
+            resultado['insertadas'] += insertadas
+            resultado['duplicadas'] += len(lote) - insertadas
+            lote = {}
+
+    if lote:
+        insertadas = _insertar_lote(session_db, stmt, producto_id, lote)
+        resultado['insertadas'] += insertadas
+        resultado['duplicadas'] += len(lote) - insertadas
+
+    logger.info(f"Importación de keys para producto {producto_id}: {resultado}")
+    return resultado
@@ -0,0 +1,251 @@
+"""
+Métricas en formato de texto de Prometheus, sin dependencias externas.
+
+Contadores, histogramas y medidores con una etiqueta opcional, pensados para dejarse activos
+en producción: registrar una observación es un lock sin contención y un bisect. Cada proceso
+(panel o bot) exporta sus propias métricas; con varios workers de gunicorn, Prometheus
+scrapea cada uno por separado.
+
+Las consultas SQL se miden con eventos del engine (instrumentar_engine) y se acumulan por
+solicitud en una ContextVar, así cada handler o ruta reporta cuántas consultas hizo y cuánto
+tiempo pasó en la base (run_db copia el contexto al pool de hilos).
+"""
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from contextvars import Context, ContextVar
+from sqlalchemy import event
+
+TIPO_CONTENIDO = 'text/plain; version=0.0.4; charset=utf-8'
+BUCKETS_SEGUNDOS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_CONSULTAS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REGISTRO = []
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _etiquetas(pares):
+    pares = [(k, v) for k, v in pares if k]
+    return '{' + ','.join(f'{k}="{_escapar(v)}"' for k, v in pares) + '}' if pares else ''
+
+
+class _Metrica:
+    tipo = 'untyped'
+
+    def __init__(self, nombre, ayuda, etiqueta=None):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiqueta = etiqueta
+        self._lock = threading.Lock()
+        self._valores = {}
+        REGISTRO.append(self)
+
+    def _encabezado(self):
+        return [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} {self.tipo}']
+
+
+class Contador(_Metrica):
+    tipo = 'counter'
+
+    def inc(self, valor_etiqueta=None, n=1):
+        with self._lock:
+            self._valores[valor_etiqueta] = self._valores.get(valor_etiqueta, 0) + n
+
+    def valor(self, valor_etiqueta=None):
+        return self._valores.get(valor_etiqueta, 0)
+
+    def exportar(self):
+        with self._lock:
+            valores = list(self._valores.items())
+        return self._encabezado() + [f'{self.nombre}{_etiquetas([(self.etiqueta, v)])} {n}' for v, n in valores]
+
+
+class Histograma(_Metrica):
+    tipo = 'histogram'
+
+    def __init__(self, nombre, ayuda, etiqueta=None, buckets=BUCKETS_SEGUNDOS):
+        super().__init__(nombre, ayuda, etiqueta)
+        self.buckets = tuple(buckets)
+
+    def observar(self, valor, valor_etiqueta=None):
+        i = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            datos = self._valores.get(valor_etiqueta)
+            if datos is None:
+                # [conteos por bucket (+Inf al final), suma, cantidad]
+                datos = self._valores[valor_etiqueta] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            datos[0][i] += 1
+            datos[1] += valor
+            datos[2] += 1
+
+    def exportar(self):
+        with self._lock:
+            valores = [(v, list(d[0]), d[1], d[2]) for v, d in self._valores.items()]
+        lineas = self._encabezado()
+        for v, conteos, suma, cantidad in valores:
+            acumulado = 0
+            for limite, conteo in zip(self.buckets + ('+Inf',), conteos):
+                acumulado += conteo
+                lineas.append(f'{self.nombre}_bucket{_etiquetas([(self.etiqueta, v), ("le", limite)])} {acumulado}')
+            lineas.append(f'{self.nombre}_sum{_etiquetas([(self.etiqueta, v)])} {suma}')
+            lineas.append(f'{self.nombre}_count{_etiquetas([(self.etiqueta, v)])} {cantidad}')
+        return lineas
+
+
+class Medidor(_Metrica):
+    """Valor instantáneo que se lee de `funcion` al exportar (p. ej. mensajes pendientes en la cola)."""
+    tipo = 'gauge'
+
+    def __init__(self, nombre, ayuda, funcion):
+        super().__init__(nombre, ayuda)
+        self.funcion = funcion
+
+    def exportar(self):
+        return self._encabezado() + [f'{self.nombre} {self.funcion()}']
+
+
+def exportar():
+    """Todas las métricas registradas en formato de texto de Prometheus."""
+    return '\n'.join(linea for metrica in REGISTRO for linea in metrica.exportar()) + '\n'
+
+
+# --- SQL ---
+
+SQL_CONSULTAS = Contador('sql_consultas_total', 'Consultas SQL ejecutadas.')
+SQL_SEGUNDOS = Histograma('sql_consulta_segundos', 'Duración de cada consulta SQL.')
+SQL_ERRORES = Contador('sql_errores_total', 'Consultas SQL que fallaron, por tipo de excepción.', 'tipo')
+
+# [consultas, segundos] de la solicitud en curso (None fuera de una solicitud medida).
+_sql_solicitud = ContextVar('sql_solicitud', default=None)
+
+def _registrar_consulta(duracion):
+    SQL_CONSULTAS.inc()
+    SQL_SEGUNDOS.observar(duracion)
+    acumulado = _sql_solicitud.get()
+    if acumulado is not None:
+        acumulado[0] += 1
+        acumulado[1] += duracion
+
+def _medir_ejecucion(ejecutar):
+    def medido(cursor, statement, *args):
+        inicio = time.perf_counter()
+        try:
+            ejecutar(cursor, statement, *args)
+        finally:
+            _registrar_consulta(time.perf_counter() - inicio)
+        return True  # La consulta ya se ejecutó: el dialecto no la repite.
+    return medido
+
+def instrumentar_engine(engine):
+    """
+    Mide cada consulta del engine. Se usan los eventos do_execute* del dialecto (el listener ejecuta
+    la consulta y retorna True) porque before/after_cursor_execute sacan a SQLAlchemy de su camino
+    rápido y cuestan varias veces más por consulta (ver benchmarks/bench_metricas.py).
+    """
+    dialecto = engine.dialect
+    event.listen(engine, 'do_execute', _medir_ejecucion(dialecto.do_execute))
+    event.listen(engine, 'do_executemany', _medir_ejecucion(dialecto.do_executemany))
+    event.listen(engine, 'do_execute_no_params', _medir_ejecucion(dialecto.do_execute_no_params))
+
+    @event.listens_for(engine, 'handle_error')
+    def _error(contexto):
+        SQL_ERRORES.inc(type(contexto.original_exception).__name__)
+
+
+# --- Solicitudes (handlers del bot y rutas del panel) ---
+
+class MedidorSolicitudes:
+    """Latencia, cantidad de consultas SQL y tiempo en SQL por solicitud, etiquetados por handler o ruta."""
+
+    def __init__(self, prefijo, etiqueta):
+        self.segundos = Histograma(f'{prefijo}_segundos', 'Latencia por solicitud.', etiqueta)
+        self.sql_consultas = Histograma(f'{prefijo}_sql_consultas', 'Consultas SQL por solicitud.', etiqueta, BUCKETS_CONSULTAS)
+        self.sql_segundos = Histograma(f'{prefijo}_sql_segundos', 'Tiempo en SQL por solicitud.', etiqueta)
+        self.errores = Contador(f'{prefijo}_errores_total', 'Solicitudes que terminaron con una excepción.', etiqueta)
+
+    def iniciar(self):
+        """Empieza a medir una solicitud; retorna el estado que se pasa a terminar()."""
+        acumulado = [0, 0.0]
+        return _sql_solicitud.set(acumulado), acumulado, time.perf_counter()
+
+    def terminar(self, estado, nombre, error=False):
+        token, acumulado, inicio = estado
+        self.segundos.observar(time.perf_counter() - inicio, nombre)
+        self.sql_consultas.observar(acumulado[0], nombre)
+        self.sql_segundos.observar(acumulado[1], nombre)
+        if error:
+            self.errores.inc(nombre)
+        _sql_solicitud.reset(token)
+
+    def cancelar(self, estado):
+        """Descarta una medición iniciada sin registrarla."""
+        _sql_solicitud.reset(estado[0])
+
+    @contextmanager
+    def medir(self, nombre):
+        estado = self.iniciar()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.terminar(estado, nombre, error)
+
+    def medir_iterable(self, iterable, nombre):
+        """
+        Itera `iterable` midiéndolo como una solicitud. Para respuestas por streaming, cuyo cuerpo se genera
+        después de que la vista retornó: corre en un contexto propio para que las consultas de cada bloque se
+        cuenten aunque el servidor pida los bloques desde otro contexto.
+        """
+        contexto = Context()
+        estado = contexto.run(self.iniciar)
+        iterador = iter(iterable)
+        error = False
+        try:
+            while True:
+                try:
+                    bloque = contexto.run(next, iterador)
+                except StopIteration:
+                    return
+                yield bloque
+        except GeneratorExit:
+            raise  # El cliente cortó la descarga: no es un error del servidor.
+        except BaseException:
+            error = True
+            raise
+        finally:
+            if hasattr(iterador, 'close'):
+                contexto.run(iterador.close)
+            contexto.run(self.terminar, estado, nombre, error)
+
+
+# --- Endpoint de scrape para procesos sin servidor web (bot en polling) ---
+
+def servir_metricas(puerto, host='0.0.0.0'):
+    """Sirve GET /metrics en un hilo aparte. Retorna el servidor."""
+    # Import diferido: http.server solo hace falta si el bot expone métricas y pesa en el arranque de cada proceso.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class ManejadorMetricas(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            cuerpo = exportar().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', TIPO_CONTENIDO)
+            self.send_header('Content-Length', str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+    servidor = ThreadingHTTPServer((host, puerto), ManejadorMetricas)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name='metricas', daemon=True).start()
+    return servidor
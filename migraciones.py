@@ -0,0 +1,106 @@
+"""
+Migraciones de esquema en el lugar.
+
+create_all solo crea tablas que no existen; los índices y columnas nuevos de tablas
+existentes se agregan aquí. Cada migración tiene un número de versión creciente, se
+aplica una sola vez en su propia transacción y queda registrada en schema_version.
+Deben ser idempotentes: en una base nueva create_all ya pudo haber creado el objeto.
+
+Uso: python migraciones.py  (sobre DATABASE_URL: crea las tablas, aplica las migraciones pendientes
+     y crea el administrador si la base está vacía; ver db_models.inicializar_db)
+
+Es el único paso que toca el esquema: el panel y el bot no lo hacen al arrancar. En producción
+corre una vez por deploy como fase "release" del Procfile, antes de levantar web y worker.
+"""
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.exc import IntegrityError
+import db_models
+from db_models import Usuario, Producto, Key, SchemaVersion
+
+logger = logging.getLogger(__name__)
+
+MIGRACIONES = []
+
+def migracion(version, descripcion):
+    """Registra una función fn(conn) como la migración `version`."""
+    def decorador(fn):
+        MIGRACIONES.append((version, descripcion, fn))
+        MIGRACIONES.sort(key=lambda m: m[0])
+        return fn
+    return decorador
+
+# --- Utilidades ---
+
+def crear_indice(conn, index):
+    """Crea un índice declarado en los modelos si todavía no existe."""
+    # IF NOT EXISTS en lugar de checkfirst: la reflexión no detecta índices por expresión.
+    conn.execute(CreateIndex(index, if_not_exists=True))
+
+def agregar_columna(conn, tabla, columna, ddl):
+    """Agrega una columna (ALTER TABLE ... ADD COLUMN ddl) si todavía no existe."""
+    if columna not in {c['name'] for c in inspect(conn).get_columns(tabla)}:
+        conn.execute(text(f'ALTER TABLE {tabla} ADD COLUMN {columna} {ddl}'))
+
+def _indice(tabla, nombre):
+    return next(i for i in tabla.indexes if i.name == nombre)
+
+# --- Migraciones ---
+
+@migracion(1, "Índices de las rutas calientes: keys(producto_id, estado, id), productos(categoria), productos(nombre), lower(username)")
+def _indices_rutas_calientes(conn):
+    crear_indice(conn, _indice(Key.__table__, 'ix_keys_producto_estado_id'))
+    crear_indice(conn, _indice(Producto.__table__, 'ix_productos_categoria'))
+    crear_indice(conn, _indice(Producto.__table__, 'ix_productos_nombre'))
+    crear_indice(conn, _indice(Usuario.__table__, 'ix_usuarios_username_lower'))
+
+@migracion(2, "Movimiento de apertura en el ledger con el saldo previo de cada usuario existente")
+def _apertura_ledger(conn):
+    conn.execute(text(
+        "INSERT INTO movimientos (usuario_id, tipo, monto, descripcion, fecha) "
+        "SELECT u.id, 'recarga', u.saldo, 'Saldo previo al historial', CURRENT_TIMESTAMP FROM usuarios u "
+        "WHERE COALESCE(u.saldo, 0) <> 0 AND NOT EXISTS (SELECT 1 FROM movimientos m WHERE m.usuario_id = u.id)"
+    ))
+
+@migracion(3, "Índices text_pattern_ops (solo PostgreSQL) para las búsquedas por prefijo de username y licencia")
+def _indices_prefijo(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+    crear_indice(conn, _indice(Usuario.__table__, 'ix_usuarios_username_prefijo'))
+    crear_indice(conn, _indice(Key.__table__, 'ix_keys_licencia_prefijo'))
+
+# --- Ejecución ---
+
+def versiones_aplicadas(conn):
+    return {v for (v,) in conn.execute(SchemaVersion.__table__.select().with_only_columns(SchemaVersion.version))}
+
+def migrar(target_engine=None):
+    """Aplica en orden las migraciones pendientes. Retorna la lista de versiones aplicadas."""
+    current_engine = target_engine if target_engine is not None else db_models.engine
+    SchemaVersion.__table__.create(current_engine, checkfirst=True)
+
+    with current_engine.connect() as conn:
+        aplicadas = versiones_aplicadas(conn)
+
+    nuevas = []
+    for version, descripcion, fn in MIGRACIONES:
+        if version in aplicadas:
+            continue
+        try:
+            with current_engine.begin() as conn:
+                fn(conn)
+                conn.execute(SchemaVersion.__table__.insert().values(version=version, descripcion=descripcion))
+        except IntegrityError:
+            # Otro proceso aplicó la misma migración en paralelo.
+            logger.info(f"Migración {version} ya aplicada por otro proceso.")
+            continue
+        logger.info(f"Migración {version} aplicada: {descripcion}")
+        nuevas.append(version)
+    return nuevas
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    aplicadas = db_models.inicializar_db()
+    print(f"Migraciones aplicadas: {aplicadas or 'ninguna (esquema al día)'}")
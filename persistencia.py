@@ -0,0 +1,164 @@
+"""
+Persistencia del bot en la base de datos (BasePersistence de python-telegram-bot).
+
+Guarda los estados de los ConversationHandler y user_data/chat_data/bot_data en las
+tablas bot_conversaciones y bot_datos, así un reinicio o deploy no corta a los usuarios
+a mitad de una compra y otro proceso puede retomar las conversaciones.
+
+Escritura diferida: la Application entrega los cambios cada `update_interval` segundos;
+los update_* solo los acumulan en memoria y se escriben todos juntos en una transacción.
+Carga: cada tabla se lee con una única consulta al arrancar.
+"""
+import os
+import json
+import asyncio
+import logging
+from sqlalchemy import insert, delete, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from telegram.ext import BasePersistence, PersistenceInput
+from db_models import ConversacionBot, DatosBot, get_session, run_db
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCIA_INTERVALO = float(os.getenv('PERSISTENCIA_INTERVALO', '2'))
+
+def _upsert(session_db, modelo, filas):
+    """INSERT ... ON CONFLICT (pk) DO UPDATE para una lista de filas (executemany)."""
+    if not filas:
+        return
+    tabla = modelo.__table__
+    pk = [c.name for c in tabla.primary_key.columns]
+    dialecto = session_db.get_bind().dialect.name
+    if dialecto in ('postgresql', 'sqlite'):
+        stmt = (postgresql if dialecto == 'postgresql' else sqlite).insert(tabla)
+        stmt = stmt.on_conflict_do_update(index_elements=pk, set_={c.name: stmt.excluded[c.name] for c in tabla.columns if c.name not in pk})
+        session_db.execute(stmt, filas)
+    else:
+        claves = [tuple(f[c] for c in pk) for f in filas]
+        session_db.execute(delete(tabla).where(tuple_(*tabla.primary_key.columns).in_(claves)))
+        session_db.execute(insert(tabla), filas)
+
+
+class PersistenciaDB(BasePersistence):
+    """BasePersistence respaldada por db_models, con escritura diferida por lotes."""
+
+    def __init__(self, store_data=None, update_interval=PERSISTENCIA_INTERVALO):
+        super().__init__(store_data=store_data or PersistenceInput(bot_data=False, chat_data=False, callback_data=False), update_interval=update_interval)
+        # Cambios pendientes: {(nombre, clave_json): estado_json o None para borrar}
+        self._conversaciones = {}
+        # {(tipo, entidad_id): datos_json o None para borrar}
+        self._datos = {}
+        self._tarea = None
+
+    # --- Carga ---
+
+    @staticmethod
+    def _leer_conversaciones(nombre):
+        with get_session() as session_db:
+            filas = session_db.query(ConversacionBot.clave, ConversacionBot.estado).filter(ConversacionBot.nombre == nombre).all()
+        return {tuple(json.loads(clave)): json.loads(estado) for clave, estado in filas}
+
+    @staticmethod
+    def _leer_datos(tipo):
+        with get_session() as session_db:
+            filas = session_db.query(DatosBot.entidad_id, DatosBot.datos).filter(DatosBot.tipo == tipo).all()
+        return {entidad_id: json.loads(datos) for entidad_id, datos in filas}
+
+    async def get_conversations(self, name):
+        conversaciones = await run_db(self._leer_conversaciones, name)
+        logger.info(f"Persistencia: {len(conversaciones)} conversaciones '{name}' restauradas.")
+        return conversaciones
+
+    async def get_user_data(self):
+        return await run_db(self._leer_datos, 'user')
+
+    async def get_chat_data(self):
+        return await run_db(self._leer_datos, 'chat')
+
+    async def get_bot_data(self):
+        return (await run_db(self._leer_datos, 'bot')).get(0, {})
+
+    async def get_callback_data(self):
+        return None
+
+    # --- Escritura diferida ---
+
+    def _programar_escritura(self):
+        if self._tarea is None or self._tarea.done():
+            self._tarea = asyncio.get_running_loop().create_task(self._escribir_pendientes())
+
+    async def _escribir_pendientes(self):
+        # Cede el control para que el resto de update_* del mismo lote se acumulen antes de escribir.
+        await asyncio.sleep(0)
+        while self._conversaciones or self._datos:
+            conversaciones, self._conversaciones = self._conversaciones, {}
+            datos, self._datos = self._datos, {}
+            try:
+                await run_db(self._escribir_lote, conversaciones, datos)
+            except Exception as e:
+                logger.error(f"Error escribiendo la persistencia del bot, se reintentará: {e}")
+                # Se reencolan sin pisar cambios más nuevos que hayan llegado mientras tanto.
+                for clave, valor in conversaciones.items(): self._conversaciones.setdefault(clave, valor)
+                for clave, valor in datos.items(): self._datos.setdefault(clave, valor)
+                return
+
+    @staticmethod
+    def _escribir_lote(conversaciones, datos):
+        with get_session() as session_db:
+            try:
+                borrar = [clave for clave, estado in conversaciones.items() if estado is None]
+                if borrar:
+                    session_db.execute(delete(ConversacionBot).where(tuple_(ConversacionBot.nombre, ConversacionBot.clave).in_(borrar)))
+                _upsert(session_db, ConversacionBot, [{'nombre': n, 'clave': c, 'estado': e} for (n, c), e in conversaciones.items() if e is not None])
+
+                borrar = [clave for clave, valor in datos.items() if valor is None]
+                if borrar:
+                    session_db.execute(delete(DatosBot).where(tuple_(DatosBot.tipo, DatosBot.entidad_id).in_(borrar)))
+                _upsert(session_db, DatosBot, [{'tipo': t, 'entidad_id': i, 'datos': d} for (t, i), d in datos.items() if d is not None])
+                session_db.commit()
+            except Exception:
+                session_db.rollback()
+                raise
+
+    async def update_conversation(self, name, key, new_state):
+        self._conversaciones[(name, json.dumps(list(key)))] = None if new_state is None else json.dumps(new_state)
+        self._programar_escritura()
+
+    async def update_user_data(self, user_id, data):
+        self._datos[('user', user_id)] = json.dumps(data)
+        self._programar_escritura()
+
+    async def update_chat_data(self, chat_id, data):
+        self._datos[('chat', chat_id)] = json.dumps(data)
+        self._programar_escritura()
+
+    async def update_bot_data(self, data):
+        self._datos[('bot', 0)] = json.dumps(data)
+        self._programar_escritura()
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._datos[('user', user_id)] = None
+        self._programar_escritura()
+
+    async def drop_chat_data(self, chat_id):
+        self._datos[('chat', chat_id)] = None
+        self._programar_escritura()
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """Escribe todo lo pendiente (la Application lo llama al detenerse)."""
+        if self._tarea is not None and not self._tarea.done():
+            await self._tarea
+        if self._conversaciones or self._datos:
+            await self._escribir_pendientes()